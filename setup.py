@@ -59,6 +59,7 @@ if __name__ == '__main__':
             'selenium',
             'requests',
             'pillow',
+            'numpy',
             'enum34',
             'coveralls'
         ],
@@ -0,0 +1,88 @@
+"""Content-addressed storage for captured images
+    - Blobs are stored once by the hash of their content
+    - Capture paths are hardlinks to the blobs, so identical screenshots
+      across builds and configs take the space of one file
+"""
+import os
+import hashlib
+
+import settings
+import logger
+import cache
+
+
+BLOB_DIR = os.path.join(settings.OUTPUT_DIR, ".blobs")
+LOGGER = logger.Logger(name=__name__, writefile=False).get()
+
+
+class BlobStore(object):
+    """Stores files by content hash and links them to their output paths
+    Blobs must never be written in place, outputs are replaced by renaming
+    a new link over them.
+    """
+
+    def __init__(self, directory=BLOB_DIR):
+        if not directory:
+            raise ValueError("directory is undefined!")
+        self.directory = directory
+
+    def __str__(self):
+        return "BlobStore: {}".format(self.directory)
+
+    def blobpath(self, digest, ext=".png"):
+        return os.path.join(self.directory, digest[:2], digest + ext)
+
+    def put(self, data, output_path):
+        """
+        Stores data and links it to output_path, replacing any file there
+        :param data: the file contents
+        :param output_path: where the file should be visible
+        :return: the sha1 hex digest of data, same as cache.file_digest
+        """
+        digest = hashlib.sha1(data).hexdigest()
+        blobpath = self.blobpath(digest, os.path.splitext(output_path)[1])
+        # The blob keeps the mtime of its first capture, its inode is shared
+        # with every capture of the same content
+        if not os.path.exists(blobpath):
+            cache.write_atomic(blobpath, data)
+        tmppath = output_path + ".tmp"
+        if os.path.lexists(tmppath):
+            os.remove(tmppath)
+        try:
+            os.link(blobpath, tmppath)
+        except OSError as e:
+            # i.e. a different filesystem or too many links to the blob
+            LOGGER.debug("Could not link %s, writing a copy: %s", blobpath, e)
+            with open(tmppath, 'wb') as f:
+                f.write(data)
+        os.rename(tmppath, output_path)
+        return digest
+
+    def gc(self):
+        """
+        Removes the blobs that no output links to anymore, i.e. after their
+        builds were removed or their captures replaced
+        :return: the number of blobs removed
+        """
+        removed = 0
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                # Blobs that cache.write_atomic is still writing
+                if filename.startswith(cache.TMP_PREFIX):
+                    continue
+                filepath = os.path.join(dirpath, filename)
+                try:
+                    if os.stat(filepath).st_nlink > 1:
+                        continue
+                    os.remove(filepath)
+                except OSError:
+                    continue
+                removed += 1
+        if removed:
+            LOGGER.info("Removed %s unreferenced blobs from %s",
+                        removed, self.directory)
+        return removed
+
+
+if __name__ == '__main__':
+    BlobStore().gc()
@@ -0,0 +1,256 @@
+"""Persistent caches for tagcompare
+    - CompareCache stores compare scores and rendered matrix tiles by the
+      content hash of the images that produced them
+    - TagCache stores the tag HTML fetched from PlaceLocal
+"""
+import os
+import io
+import json
+import time
+import hashlib
+import errno
+import tempfile
+
+from PIL import Image
+
+import settings
+import logger
+
+
+CACHE_DIR = os.path.join(settings.OUTPUT_DIR, ".cache")
+COMPARE_CACHE_DIR = os.path.join(CACHE_DIR, "compare")
+TAG_CACHE_DIR = os.path.join(CACHE_DIR, "tags")
+DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+DEFAULT_TAG_TTL = 60 * 60
+# Prefix of the temp files of write_atomic
+TMP_PREFIX = '.tmp'
+LOGGER = logger.Logger(name=__name__, writefile=False).get()
+
+
+def make_key(*parts):
+    """
+    Makes a cache key out of a list of parts, i.e. content hashes and versions
+    :return: a hex digest for the parts
+    """
+    h = hashlib.sha1()
+    for p in parts:
+        h.update(str(p))
+        h.update('\0')
+    return h.hexdigest()
+
+
+def file_digest(filepath, blocksize=65536):
+    """
+    :return: the sha1 hex digest of the file contents
+    """
+    h = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def write_atomic(filepath, data):
+    """Writes to a temp file and renames it so readers, including other
+    processes, never see a partial file
+    """
+    dirpath = os.path.dirname(os.path.abspath(filepath))
+    _makedirs(dirpath)
+    fd, tmppath = tempfile.mkstemp(dir=dirpath, prefix=TMP_PREFIX)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmppath, filepath)
+
+
+def _makedirs(dirpath):
+    try:
+        os.makedirs(dirpath)
+    except OSError as e:
+        # Another worker might have created it already
+        if e.errno != errno.EEXIST:
+            raise
+
+
+class CompareCache(object):
+    """Content-addressed cache for compare results
+    Entries are files under the cache directory, so the cache can be shared
+    by compare jobs running in different processes.  Eviction is least
+    recently used by file mtime, which is refreshed on every hit.
+    """
+
+    def __init__(self, directory=COMPARE_CACHE_DIR, max_size=DEFAULT_MAX_SIZE,
+                 cache_tiles=True):
+        if not directory:
+            raise ValueError("directory is undefined!")
+        self.directory = directory
+        self.max_size = max_size
+        self.cache_tiles = cache_tiles
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return "CompareCache (hits={}, misses={}): {}".format(
+            self.hits, self.misses, self.directory)
+
+    @property
+    def args(self):
+        """
+        Picklable constructor args, used to make a cache in another process
+        """
+        return (self.directory, self.max_size, self.cache_tiles)
+
+    def _entrypath(self, key, ext):
+        return os.path.join(self.directory, key[:2], key + ext)
+
+    def _lookup(self, filepath):
+        if not os.path.exists(filepath):
+            self.misses += 1
+            return None
+        try:
+            # Refresh mtime for LRU eviction
+            os.utime(filepath, None)
+        except OSError:
+            # Evicted by someone else in the meantime
+            self.misses += 1
+            return None
+        self.hits += 1
+        return filepath
+
+    def get_score(self, key):
+        """
+        :return: the cached score for key, None if it's not cached
+        """
+        filepath = self._lookup(self._entrypath(key, ".score"))
+        if not filepath:
+            return None
+        try:
+            with open(filepath, 'r') as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            LOGGER.warn("Invalid cache entry at %s", filepath)
+            return None
+
+    def set_score(self, key, score):
+        write_atomic(self._entrypath(key, ".score"), str(int(score)))
+
+    def get_tile(self, key):
+        """
+        :return: the cached PIL.Image tile for key, None if it's not cached
+        """
+        if not self.cache_tiles:
+            return None
+        filepath = self._lookup(self._entrypath(key, ".png"))
+        if not filepath:
+            return None
+        try:
+            tile = Image.open(filepath)
+            tile.load()
+            return tile
+        except IOError:
+            LOGGER.warn("Invalid cache entry at %s", filepath)
+            return None
+
+    def set_tile(self, key, tile):
+        if not self.cache_tiles:
+            return
+        data = io.BytesIO()
+        tile.save(data, format="PNG")
+        write_atomic(self._entrypath(key, ".png"), data.getvalue())
+
+    def _entries(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(filepath)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filepath))
+        return entries
+
+    def size(self):
+        """
+        :return: the total size of the cache entries in bytes
+        """
+        return sum(e[1] for e in self._entries())
+
+    def evict(self, max_size=None):
+        """
+        Removes least recently used entries until the cache fits in max_size
+        :return: the number of entries removed
+        """
+        if max_size is None:
+            max_size = self.max_size
+        entries = self._entries()
+        total = sum(e[1] for e in entries)
+        removed = 0
+        for mtime, size, filepath in sorted(entries):
+            if total <= max_size:
+                break
+            try:
+                os.remove(filepath)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        if removed:
+            LOGGER.debug("Evicted %s entries from %s", removed, self.directory)
+        return removed
+
+
+class TagCache(object):
+    """Persistent cache for campaign tags with a TTL
+    Entries keep the ETag and Last-Modified headers of the response, so
+    expired entries can be revalidated with a conditional request.
+    """
+
+    def __init__(self, directory=TAG_CACHE_DIR, ttl=DEFAULT_TAG_TTL):
+        if not directory:
+            raise ValueError("directory is undefined!")
+        self.directory = directory
+        self.ttl = ttl
+
+    def __str__(self):
+        return "TagCache (ttl={}): {}".format(self.ttl, self.directory)
+
+    @staticmethod
+    def make_key(domain, cid, ispreview, animationtime):
+        return make_key(domain, cid, ispreview, animationtime)
+
+    def _entrypath(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key):
+        """
+        :return: the cached entry dict with 'tags', 'fetched', 'etag' and
+            'last_modified', None if it's not cached
+        """
+        filepath = self._entrypath(key)
+        if not os.path.exists(filepath):
+            return None
+        try:
+            with open(filepath, 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            LOGGER.warn("Invalid cache entry at %s", filepath)
+            return None
+
+    def is_fresh(self, entry):
+        return entry is not None and \
+            time.time() - entry.get('fetched', 0) < self.ttl
+
+    def set(self, key, tags, etag=None, last_modified=None):
+        entry = {
+            'tags': tags,
+            'fetched': time.time(),
+            'etag': etag,
+            'last_modified': last_modified
+        }
+        write_atomic(self._entrypath(key), json.dumps(entry))
+        return entry
+
+    def touch(self, key, entry):
+        """Marks a revalidated entry as freshly fetched"""
+        return self.set(key, entry['tags'], etag=entry.get('etag'),
+                        last_modified=entry.get('last_modified'))
@@ -1,40 +1,391 @@
 #!/usr/bin/env python
 
+from collections import deque
 from multiprocessing.pool import ThreadPool
+import math
 import os
+import json
+import time
+import threading
 
 import selenium
 
 import placelocal
 import webdriver
 from webdriver import WebDriverType
+from webdriver import TagReadiness
 import output
 import settings
 import logger
+import cache
+import index
+import image
+import blobstore
+
+
+LOGGER = logger.Logger(name="capture", writefile=True).get()
+
+
+def check_local_configs(configs, all_configs=None):
+    """
+    Checks that configs can be captured with WebDriverType.LOCAL, only the
+    browserName of a config applies to local browsers
+    :raises ValueError: for configs with browsers that can't run locally
+    """
+    if not all_configs:
+        all_configs = settings.DEFAULT.all_configs
+    unsupported = []
+    ignored = []
+    for configname in configs:
+        if configname == 'phantomjs':
+            continue
+        caps = all_configs[configname].get('capabilities', {})
+        if caps.get('browserName') not in webdriver.LOCAL_BROWSERS:
+            unsupported.append(configname)
+        elif caps.get('version') or caps.get('platform'):
+            ignored.append(configname)
+    if unsupported:
+        raise ValueError(
+            "Configs {} can't be captured with local browsers, only {} can. "
+            "Pick comparisons without them or capture them remotely".format(
+                unsupported, list(webdriver.LOCAL_BROWSERS)))
+    if ignored:
+        LOGGER.warn("The version and platform of configs %s are ignored for "
+                    "local captures, they all use the installed browsers",
+                    ignored)
+
+
+def get_capture_units(tags, tagsizes=settings.DEFAULT.tagsizes,
+                      tagtypes=settings.DEFAULT.tagtypes):
+    """
+    Flattens the tags to capture into work units
+    :param tags: the tags per campaign, from PlaceLocalApi
+    :return: list of (cid, tagsize, tagtype)
+    """
+    units = []
+    for cid in tags:
+        tags_per_campaign = tags[cid]
+        for tagsize in tagsizes:
+            if tagsize not in tags_per_campaign:
+                LOGGER.warn(
+                    "No tagsize '%s' found for campaign: %s. Skipping",
+                    tagsize, cid)
+                continue
+            for tagtype in tagtypes:
+                units.append((cid, tagsize, tagtype))
+    return units
+
+
+class CaptureJournal(object):
+    """Checkpoint journal of the units captured in a build
+    Every capture with a complete tag image is appended to the journal, so a
+    run that died can be resumed where it stopped.  A unit stays done only
+    while its image is complete and has the hash it was journaled with,
+    partially written images are captured again.
+    """
+    FILENAME = ".journal"
+
+    def __init__(self, buildpath, resume=False):
+        """
+        :param buildpath: the path of the capture build
+        :param resume: keep the units journaled by an earlier run of the
+            build, otherwise the journal starts over
+        """
+        if not buildpath:
+            raise ValueError("buildpath is undefined!")
+        if not os.path.exists(buildpath):
+            os.makedirs(buildpath)
+        self.filepath = os.path.join(buildpath, CaptureJournal.FILENAME)
+        self._lock = threading.Lock()
+        self._done = {}
+        if resume:
+            self._load()
+        elif os.path.exists(self.filepath):
+            os.remove(self.filepath)
+
+    def __len__(self):
+        return len(self._done)
+
+    def __str__(self):
+        return "CaptureJournal ({} units): {}".format(len(self),
+                                                      self.filepath)
+
+    @staticmethod
+    def make_key(pathbuilder):
+        return (pathbuilder.config, str(pathbuilder.cid), pathbuilder.tagsize,
+                pathbuilder.tagtype)
+
+    def _load(self):
+        if not os.path.exists(self.filepath):
+            return
+        with open(self.filepath, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line of a run that died might be cut off
+                    LOGGER.warn("Invalid journal entry in %s: %s",
+                                self.filepath, line)
+                    continue
+                self._done[tuple(entry['unit'])] = entry['hash']
+
+    def is_done(self, pathbuilder):
+        """
+        :param pathbuilder: pathbuilder for the capture, including config
+        :return: True if the unit was captured and its image is still valid
+        """
+        key = CaptureJournal.make_key(pathbuilder)
+        with self._lock:
+            if key not in self._done:
+                return False
+            digest = self._done[key]
+        tagimage = pathbuilder.tagimage
+        if image.is_complete_png(tagimage) and \
+                cache.file_digest(tagimage) == digest:
+            return True
+        LOGGER.warn("Invalid capture at %s, capturing it again", tagimage)
+        with self._lock:
+            self._done.pop(key, None)
+        return False
+
+    def record(self, pathbuilder, digest=None):
+        """
+        Marks a unit as done if its tag image is complete
+        :param digest: the content hash of the tag image, computed if not set
+        :return: the content hash of the tag image, None if it's incomplete
+        """
+        tagimage = pathbuilder.tagimage
+        if not image.is_complete_png(tagimage):
+            LOGGER.warn("Incomplete capture at %s", tagimage)
+            return None
+        if digest is None:
+            digest = cache.file_digest(tagimage)
+        key = CaptureJournal.make_key(pathbuilder)
+        line = json.dumps({'unit': key, 'hash': digest}) + '\n'
+        with self._lock:
+            with open(self.filepath, 'a') as f:
+                f.write(line)
+            self._done[key] = digest
+        return digest
+
+
+class RetryPolicy(object):
+    """Retries failed capture units and quarantines failing campaigns
+    A unit is retried with exponential backoff after a WebDriverException.
+    Its session is replaced when it stops responding, or after
+    recycle_after failures in a row.  A campaign that failed on
+    quarantine_after configs without a single capture is quarantined, and
+    its remaining units are skipped for the rest of the run.
+    One policy is shared by all the sessions of a run.
+    """
+
+    def __init__(self, max_retries=2, backoff=1.0, max_backoff=30,
+                 recycle_after=2, quarantine_after=2, sleep=time.sleep):
+        """
+        :param max_retries: max retries of a unit after its first attempt
+        :param backoff: seconds to wait before the first retry, doubled for
+            every retry after it
+        :param max_backoff: max seconds to wait before a retry
+        :param recycle_after: failures in a row after which the session is
+            replaced even if it still responds
+        :param quarantine_after: configs a campaign has to fail on, with no
+            captures on any config, before it's quarantined
+        """
+        if max_retries < 0:
+            raise ValueError("max_retries can't be negative!")
+        if recycle_after < 1:
+            raise ValueError("recycle_after must be at least 1!")
+        if quarantine_after < 1:
+            raise ValueError("quarantine_after must be at least 1!")
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.recycle_after = recycle_after
+        self.quarantine_after = quarantine_after
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._failed_configs = {}
+        self._captured = set()
+        self.quarantined = set()
+        self.retries = 0
+        self.recycled = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def __str__(self):
+        return "RetryPolicy (retries={}, recycled={}, failed={}, " \
+            "quarantined={}, skipped={})".format(
+                self.retries, self.recycled, self.failed,
+                sorted(self.quarantined), self.skipped)
+
+    def wait(self, retry):
+        """Waits before the retry-th retry of a unit, counting from 0"""
+        with self._lock:
+            self.retries += 1
+        delay = min(self.max_backoff, self.backoff * (2 ** retry))
+        if delay > 0:
+            self._sleep(delay)
+
+    def should_recycle(self, failures):
+        """
+        :param failures: the failures in a row on the session
+        """
+        return failures >= self.recycle_after
+
+    def count_recycled(self):
+        with self._lock:
+            self.recycled += 1
+
+    def is_quarantined(self, cid):
+        """
+        :return: True if the units of cid should be skipped, they are counted
+            as skipped
+        """
+        with self._lock:
+            if str(cid) not in self.quarantined:
+                return False
+            self.skipped += 1
+            return True
+
+    def record(self, cid, configname, captured):
+        """
+        Records the outcome of a unit once its retries are done
+        :param captured: False if the unit failed
+        """
+        cid = str(cid)
+        with self._lock:
+            if captured:
+                self._captured.add(cid)
+                return
+            self.failed += 1
+            configs = self._failed_configs.setdefault(cid, set())
+            configs.add(configname)
+            if cid in self._captured or cid in self.quarantined or \
+                    len(configs) < self.quarantine_after:
+                return
+            self.quarantined.add(cid)
+        LOGGER.error("Quarantined campaign %s after it failed on %s",
+                     cid, sorted(configs))
+
+    def summary(self):
+        """
+        :return: dict of the retries, replaced sessions, failed units,
+            quarantined campaigns and units skipped by the quarantine
+        """
+        with self._lock:
+            return {
+                'retries': self.retries,
+                'recycled': self.recycled,
+                'failed': self.failed,
+                'quarantined': sorted(self.quarantined),
+                'skipped': self.skipped
+            }
 
 
 class TagCapture(object):
     """TagCapture uses webdriver to capture tags for campaigns"""
 
     def __init__(self, configname, driver, caps=None,
-                 wait_for_load=True, wait_time=3):
+                 wait_for_load=True, wait_time=3,
+                 readiness=TagReadiness.FIXED, output_index=None,
+                 blob_store=None, batch_size=1, drivertype=None,
+                 session_pool=None, journal=None, retry_policy=None):
+        """
+        :param output_index: optional index.OutputIndex to record captures in
+        :param blob_store: optional blobstore.BlobStore to store captures in
+        :param batch_size: max number of tags to display and screenshot in
+            one page load, see capture_batch
+        :param drivertype: the WebDriverType of driver, needed to replace the
+            session after a WebDriverException
+        :param session_pool: optional webdriver.SessionPool that driver came
+            from, it is returned there on close()
+        :param journal: optional CaptureJournal to checkpoint captures in,
+            journaled units are skipped
+        :param retry_policy: RetryPolicy for failed units, share one over the
+            sessions of a run so campaigns are quarantined over all configs
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1!")
         self.logger = logger.Logger(name="capture", writefile=True).get()
         self._configname = configname
         self._driver = driver
         self._caps = caps
         self._wait_time = wait_time
         self._wait_for_load = wait_for_load
+        self._readiness = readiness
+        self._output_index = output_index
+        self._blob_store = blob_store
+        self.batch_size = batch_size
+        self._drivertype = drivertype
+        self._session_pool = session_pool
+        self._journal = journal
+        self._retry_policy = retry_policy or RetryPolicy()
+        # WebDriverExceptions in a row on the session
+        self._failures = 0
+        # Page loads on the driver, sessions are replaced after a max number
+        self._commands = 0
 
     def close(self):
-        if self._driver:
+        if not self._driver:
+            return
+        if self._session_pool:
+            self._session_pool.release(self._driver, commands=self._commands)
+        else:
             self._driver.quit()
+        self._driver = None
+
+    @staticmethod
+    def _open_driver(drivertype, caps=None, session_pool=None):
+        if session_pool:
+            return session_pool.acquire(drivertype, capabilities=caps)
+        return webdriver.setup_webdriver(drivertype=drivertype,
+                                         capabilities=caps)
+
+    def _recycle(self):
+        """
+        Replaces the session after a WebDriverException
+        :return: True if there is a new session
+        """
+        if not self._drivertype:
+            return False
+        if self._session_pool:
+            self._session_pool.discard(self._driver)
+        else:
+            try:
+                self._driver.quit()
+            except Exception as e:
+                self.logger.debug("Could not quit session: %s", e)
+        self._driver = None
+        self._commands = 0
+        self._failures = 0
+        self._retry_policy.count_recycled()
+        caps = None if self._drivertype == WebDriverType.PHANTOM_JS \
+            else self._caps
+        try:
+            self._driver = TagCapture._open_driver(
+                self._drivertype, caps, self._session_pool)
+        except Exception:
+            self.logger.exception("Could not replace session for %s",
+                                  self._configname)
+            return False
+        self.logger.info("Replaced session for %s", self._configname)
+        return True
 
     @classmethod
     def from_config(cls, configname, buildname=None,
-                    wait_time=3, wait_for_load=True):
+                    wait_time=3, wait_for_load=True,
+                    readiness=TagReadiness.FIXED, output_index=None,
+                    blob_store=None, batch_size=1, session_pool=None,
+                    drivertype=WebDriverType.REMOTE, journal=None,
+                    retry_policy=None):
+        """
+        :param drivertype: WebDriverType.REMOTE or LOCAL, the backend for all
+            configs but phantomjs
+        """
         if configname == 'phantomjs':
-            driver = webdriver.setup_webdriver(
-                drivertype=WebDriverType.PHANTOM_JS)
+            drivertype = WebDriverType.PHANTOM_JS
+            driver = TagCapture._open_driver(drivertype,
+                                             session_pool=session_pool)
             caps = configname
             # Override wait_for_load since it doesn't work with phantomjs
             # Override wait_time on tag render for phantomjs to be shorter
@@ -43,10 +394,13 @@ class TagCapture(object):
         else:
             caps = TagCapture.__get_capabilities_for_config(
                 configname, buildname)
-            driver = webdriver.setup_webdriver(drivertype=WebDriverType.REMOTE,
-                                               capabilities=caps)
+            driver = TagCapture._open_driver(drivertype, caps, session_pool)
         return cls(configname, driver, caps,
-                   wait_time=wait_time, wait_for_load=wait_for_load)
+                   wait_time=wait_time, wait_for_load=wait_for_load,
+                   readiness=readiness, output_index=output_index,
+                   blob_store=blob_store, batch_size=batch_size,
+                   drivertype=drivertype, session_pool=session_pool,
+                   journal=journal, retry_policy=retry_policy)
 
     @classmethod
     def from_caps(cls, caps):
@@ -55,7 +409,7 @@ class TagCapture(object):
         configname = browsername + browserversion
         driver = webdriver.setup_webdriver(drivertype=WebDriverType.REMOTE,
                                            capabilities=caps)
-        return cls(configname, driver, caps)
+        return cls(configname, driver, caps, drivertype=WebDriverType.REMOTE)
 
     def capture_tag(self, tag_html, output_path, tagtype='iframe'):
         """
@@ -66,16 +420,26 @@ class TagCapture(object):
         :param tagtype:
         :return:
         """
+        return self._capture(tag_html, output_path, tagtype)[0]
+
+    def _capture(self, tag_html, output_path, tagtype='iframe'):
+        """
+        :return: a tuple of the browser errors and the content hash of the
+            image if it went to the blob store, None otherwise
+        """
+        self._commands += 1
         errors = webdriver.display_tag(self._driver, tag_html,
-                                       wait_time=self._wait_time)
+                                       wait_for_load=self._wait_for_load,
+                                       wait_time=self._wait_time,
+                                       readiness=self._readiness)
         tag_element = self._driver.find_element_by_tag_name(tagtype)
-        webdriver.screenshot_element(
-            self._driver, tag_element, output_path)
+        img = webdriver.screenshot_element(self._driver, tag_element)
+        digest = self._save(img, output_path)
         if errors:
             self.logger.warn(
                 'Found browser errors while capturing %s:\n%s',
                 output_path, errors)
-        return errors
+        return errors, digest
 
     def _capture_tag(self, pathbuilder, tags_per_campaign,
                      capture_existing=False):
@@ -90,62 +454,196 @@ class TagCapture(object):
                 False on error, None on skip
         """
         # Check if we already have the files from default path
-        default_pb = pathbuilder.clone(build=output.DEFAULT_BUILD_NAME)
-        if default_pb.pathexists() and not capture_existing:
-            self.logger.debug("Skipping existing captures %s", default_pb.path)
+        if self._is_captured(pathbuilder, capture_existing):
+            self.logger.debug("Skipping existing captures %s", pathbuilder.path)
             return None
 
         tag_html = tags_per_campaign[pathbuilder.tagsize][pathbuilder.tagtype]
         pathbuilder.create()
         output_path = pathbuilder.tagimage
-        errors = self.capture_tag(tag_html=tag_html, output_path=output_path,
-                                  tagtype=pathbuilder.tagtype)
+        errors, digest = self._capture(tag_html=tag_html,
+                                       output_path=output_path,
+                                       tagtype=pathbuilder.tagtype)
+        self._record(pathbuilder, tag_html, digest)
+        return errors
+
+    def _record(self, pathbuilder, tag_html, digest=None):
         self.__write_html(
             tag_html=tag_html, output_path=pathbuilder.taghtml)
-        return errors
+        if self._journal is not None:
+            digest = self._journal.record(pathbuilder, digest) or digest
+        if self._output_index:
+            # The blob store already hashed the image
+            self._output_index.add_capture(pathbuilder, digest=digest)
+
+    def _save(self, img, output_path):
+        """
+        :return: the content hash of the image if it went to the blob store,
+            None otherwise
+        """
+        data = image.encode_png(img)
+        if self._blob_store:
+            return self._blob_store.put(data, output_path)
+        # The old file might be a link to a blob, which is shared with other
+        # builds and must not be written in place
+        cache.write_atomic(output_path, data)
+        return None
+
+    def _is_captured(self, pathbuilder, capture_existing=False):
+        """
+        :return: True if the unit was captured in this build, or in an
+            earlier build unless capture_existing is set
+        """
+        if self._journal is not None and self._journal.is_done(pathbuilder):
+            return True
+        if capture_existing:
+            return False
+        default_pb = pathbuilder.clone(build=output.DEFAULT_BUILD_NAME)
+        return image.is_complete_png(default_pb.tagimage)
+
+    def capture_batch(self, tags, pathbuilder, units, capture_existing=False):
+        """
+        Captures several work units with one page load, one wait and one
+        screenshot.  Tags that can't be cropped out of the screenshot, i.e.
+        below the fold, and batches that fail are captured one at a time.
+        :param tags: the tags per campaign, from PlaceLocalApi
+        :param pathbuilder: pathbuilder with the build and config set
+        :param units: list of (cid, tagsize, tagtype), see get_capture_units
+        :return: list of results in the order of units, see capture_unit.
+            The browser errors of a batch can't be told apart, they are all
+            reported for the first unit of the batch.
+        """
+        results = [None] * len(units)
+        pending = []
+        for i, unit in enumerate(units):
+            cid, tagsize, tagtype = unit
+            if self._retry_policy.is_quarantined(cid):
+                results[i] = False
+                continue
+            pb = pathbuilder.clone(cid=cid, tagsize=tagsize, tagtype=tagtype)
+            if self._is_captured(pb, capture_existing):
+                self.logger.debug("Skipping existing captures %s", pb.path)
+                self._retry_policy.record(cid, self._configname,
+                                          captured=True)
+                continue
+            pending.append((i, pb, tags[cid][tagsize][tagtype]))
+
+        if len(pending) > 1 and self._driver:
+            try:
+                pending = self._capture_pending(pending, results)
+            except (selenium.common.exceptions.WebDriverException,
+                    ValueError):
+                self.logger.exception(
+                    "Exception while capturing a batch of %s tags, "
+                    "capturing them one at a time", len(pending))
+
+        for i, pb, _ in pending:
+            results[i] = self.capture_unit(
+                tags, pathbuilder, units[i], capture_existing=True)
+        return results
+
+    def _capture_pending(self, pending, results):
+        """
+        Displays and screenshots the pending tags together
+        :return: the pending tags that could not be captured
+        """
+        self._commands += 1
+        errors = webdriver.display_tags(
+            self._driver, [tag_html for _, _, tag_html in pending],
+            wait_for_load=self._wait_for_load, wait_time=self._wait_time,
+            readiness=self._readiness)
+        elements = webdriver.find_batch_elements(
+            self._driver, [pb.tagtype for _, pb, _ in pending])
+        images = webdriver.screenshot_elements(self._driver, elements)
+        if errors:
+            self.logger.warn('Found browser errors while capturing %s:\n%s',
+                             [pb.path for _, pb, _ in pending], errors)
+
+        remaining = []
+        for (i, pb, tag_html), img in zip(pending, images):
+            if img is None:
+                remaining.append((i, pb, tag_html))
+                continue
+            pb.create()
+            digest = self._save(img, pb.tagimage)
+            self._record(pb, tag_html, digest)
+            self._retry_policy.record(pb.cid, self._configname, captured=True)
+            results[i] = errors
+            errors = []
+        self.logger.debug("Captured %s of %s tags in one batch",
+                          len(pending) - len(remaining), len(pending))
+        return remaining
 
     def capture_tags(self, tags, pathbuilder,
                      tagsizes=settings.DEFAULT.tagsizes,
                      tagtypes=settings.DEFAULT.tagtypes,
                      capture_existing=False):
+        units = get_capture_units(tags, tagsizes, tagtypes)
+        return self.capture_units(tags, pathbuilder, units,
+                                  capture_existing=capture_existing)
+
+    def capture_unit(self, tags, pathbuilder, unit, capture_existing=False):
+        """
+        Captures a single work unit
+        :param tags: the tags per campaign, from PlaceLocalApi
+        :param pathbuilder: pathbuilder with the build and config set
+        :param unit: (cid, tagsize, tagtype), see get_capture_units
+        :param capture_existing: capture even if the images already exist
+        :return: list of browser errors during capture.
+                False on error, None on skip
+        """
+        cid, tagsize, tagtype = unit
+        policy = self._retry_policy
+        if policy.is_quarantined(cid):
+            self.logger.debug("Skipping quarantined campaign %s", cid)
+            return False
+        pb = pathbuilder.clone(cid=cid, tagsize=tagsize, tagtype=tagtype)
+        for attempt in xrange(policy.max_retries + 1):
+            if attempt:
+                policy.wait(attempt - 1)
+            if not self._driver and not self._recycle():
+                break
+            try:
+                result = self._capture_tag(pathbuilder=pb,
+                                           tags_per_campaign=tags[cid],
+                                           capture_existing=capture_existing)
+            except selenium.common.exceptions.WebDriverException:
+                self.logger.exception(
+                    "Exception while capturing %s, attempt %s of %s",
+                    pb.path, attempt + 1, policy.max_retries + 1)
+                self._failures += 1
+                if policy.should_recycle(self._failures) or \
+                        not webdriver.is_session_alive(self._driver):
+                    self._recycle()
+                continue
+            self._failures = 0
+            policy.record(cid, self._configname, captured=True)
+            return result
+        policy.record(cid, self._configname, captured=False)
+        return False
+
+    def capture_units(self, tags, pathbuilder, units, capture_existing=False):
+        """
+        Captures a list of work units
+        :return: list of browser errors during capture
+        """
         num_existing_skipped = 0
         num_captured = 0
         browser_errors = []
 
-        for cid in tags:
-            pathbuilder.cid = cid
-            tags_per_campaign = tags[cid]
-            # LOGGER.debug("tags_per_campaign: %s", str(tags_per_campaign))
-            # TODO: Refactor better with _capture_tag
-            # It's weird that we pass in a pathbuilder object and do two
-            # nested loops here
-            for tagsize in tagsizes:
-                if tagsize not in tags_per_campaign:
-                    self.logger.warn(
-                        "No tagsize '%s' found for campaign: %s. Skipping",
-                        tagsize, cid)
-                    continue
-                pathbuilder.tagsize = tagsize
-                for tagtype in tagtypes:
-                    pathbuilder.tagtype = tagtype
-                    try:
-                        r = self._capture_tag(
-                            pathbuilder=pathbuilder,
-                            tags_per_campaign=tags_per_campaign,
-                            capture_existing=capture_existing)
-                    except selenium.common.exceptions.WebDriverException:
-                        self.logger.exception(
-                            "Exception while capturing tags!")
-                        continue
-                    if r is None:
-                        num_existing_skipped += 1
-                    elif r is False:
-                        continue
-                    else:
-                        browser_errors += r
-                        num_captured += 1
-            self.logger.debug(
-                "Captured tags for campaign %s on %s", cid, self._caps)
+        results = []
+        for i in xrange(0, len(units), self.batch_size):
+            results += self.capture_batch(
+                tags, pathbuilder, units[i:i + self.batch_size],
+                capture_existing=capture_existing)
+        for r in results:
+            if r is None:
+                num_existing_skipped += 1
+            elif r is False:
+                continue
+            else:
+                browser_errors += r
+                num_captured += 1
         self.logger.info(
             "Captured %s tags, skipped %s existing tags for config=%s.",
             num_captured, num_existing_skipped, self._caps)
@@ -181,15 +679,224 @@ class TagCapture(object):
             f.write(tag_html)
 
 
+class CaptureScheduler(object):
+    """Schedules capture units over browser sessions
+    Each config has a queue of (cid, tagsize, tagtype) units.  A free worker
+    opens a session for the config with the longest remaining backlog that
+    is below sessions_per_config, then pulls batches of up to batch_size units
+    off that config's queue until it's empty.  Sessions of the same config share their
+    queue, and workers move on to the slow configs as the fast ones drain, so
+    the run takes as long as the total work rather than the slowest config.
+    """
+
+    def __init__(self, open_session, sessions_per_config=1,
+                 max_sessions=6, batch_size=1):
+        """
+        :param open_session: callable(configname) returning a session with a
+            close() method, i.e. TagCapture.from_config
+        :param sessions_per_config: max concurrent sessions for one config
+        :param max_sessions: max concurrent sessions over all configs
+        :param batch_size: max units handed to a session at once
+        """
+        self._open_session = open_session
+        self.sessions_per_config = sessions_per_config
+        self.max_sessions = max_sessions
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._sessions = {}
+        # Max sessions of each config, lowered when a session fails to open
+        self._limits = {}
+        self.dispatched = 0
+
+    def add(self, configname, units):
+        with self._lock:
+            self._queues.setdefault(configname, deque()).extend(units)
+            self._sessions.setdefault(configname, 0)
+            self._limits.setdefault(configname, self.sessions_per_config)
+
+    def queue_depth(self, configname=None):
+        """
+        :return: the number of queued units for configname, or over all
+            configs if configname is None
+        """
+        with self._lock:
+            if configname is not None:
+                return len(self._queues.get(configname, ()))
+            return sum(len(q) for q in self._queues.values())
+
+    def _acquire_config(self):
+        """
+        :return: the config with the longest backlog that can take another
+            session, None if there is none
+        """
+        with self._lock:
+            candidates = [c for c in self._queues
+                          if self._queues[c] and
+                          self._sessions[c] < self._limits[c]]
+            if not candidates:
+                return None
+            configname = max(candidates, key=lambda c: len(self._queues[c]))
+            self._sessions[configname] += 1
+            return configname
+
+    def _release_config(self, configname, failed=False):
+        with self._lock:
+            self._sessions[configname] -= 1
+            queue = self._queues[configname]
+            if failed:
+                # The sessions that are still open drain the queue, opening
+                # more would retry the failed open right away
+                self._limits[configname] = self._sessions[configname]
+            if failed and not self._sessions[configname] and queue:
+                LOGGER.error("No sessions for %s, dropping %s units",
+                             configname, len(queue))
+                queue.clear()
+
+    def _pop(self, configname):
+        """
+        :return: list of up to batch_size units, empty if the queue is empty
+        """
+        with self._lock:
+            queue = self._queues[configname]
+            units = [queue.popleft()
+                     for _ in xrange(min(self.batch_size, len(queue)))]
+            self.dispatched += len(units)
+            return units
+
+    def _work(self, capture_units):
+        errors = []
+        while True:
+            configname = self._acquire_config()
+            if configname is None:
+                return errors
+            try:
+                session = self._open_session(configname)
+            except Exception:
+                LOGGER.exception("Could not open session for %s", configname)
+                self._release_config(configname, failed=True)
+                continue
+            try:
+                units = self._pop(configname)
+                while units:
+                    errors += capture_units(session, configname, units) or []
+                    LOGGER.debug("Capture queue depth: %s",
+                                 self.queue_depth())
+                    units = self._pop(configname)
+            finally:
+                session.close()
+                self._release_config(configname)
+
+    def run(self, capture_units):
+        """
+        Captures all queued units
+        :param capture_units: callable(session, configname, units) returning
+            a list of browser errors for the units
+        :return: list of browser errors over all units
+        """
+        pool = ThreadPool(processes=self.max_sessions)
+        workers = [pool.apply_async(func=self._work, args=(capture_units,))
+                   for _ in xrange(self.max_sessions)]
+        pool.close()
+        errors = []
+        for w in workers:
+            errors += w.get()
+        pool.join()
+        return errors
+
+
 class CaptureManager(object):
     MAX_REMOTE_JOBS = 6
 
-    def __init__(self, domain=None):
+    def __init__(self, domain=None, readiness=TagReadiness.FIXED,
+                 sessions_per_config=None, max_sessions=MAX_REMOTE_JOBS,
+                 tag_cache=None, refresh_tags=False, on_captured=None,
+                 output_index=None, blob_store=None, batch_size=1,
+                 session_pool=None, drivertype=WebDriverType.REMOTE,
+                 retry_policy=None):
+        """
+        :param sessions_per_config: max browser sessions for each config,
+            see CaptureScheduler.  By default 1 for remote runs, and
+            max_sessions spread over the configs for local runs.
+        :param max_sessions: cap on concurrent browser sessions over all
+            configs, i.e. the remote concurrency limit
+        :param tag_cache: optional cache.TagCache for the campaign tags
+        :param refresh_tags: refetch the tags even if they are cached
+        :param on_captured: optional callable(pathbuilder) called for every
+            tag captured or skipped, i.e. compare.ComparePipeline.captured
+        :param output_index: optional index.OutputIndex to record captures in
+        :param blob_store: optional blobstore.BlobStore to store captures in
+        :param batch_size: max tags to capture with one page load, see
+            TagCapture.capture_batch
+        :param session_pool: optional webdriver.SessionPool to reuse browser
+            sessions from
+        :param drivertype: WebDriverType.REMOTE to capture on SauceLabs,
+            WebDriverType.LOCAL to capture with local headless browsers
+        :param retry_policy: RetryPolicy for the failed units of all sessions
+        """
         self.domain = domain
         if not self.domain:
             self.domain = settings.DEFAULT.domain
+        if sessions_per_config is not None and sessions_per_config < 1:
+            raise ValueError("sessions_per_config must be at least 1!")
+        if max_sessions < 1:
+            raise ValueError("max_sessions must be at least 1!")
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1!")
+        if drivertype not in (WebDriverType.REMOTE, WebDriverType.LOCAL):
+            raise ValueError('Unsupported `drivertype`!  see WebDriverType')
+        self.readiness = readiness
+        self.sessions_per_config = sessions_per_config
+        self.max_sessions = max_sessions
+        self.batch_size = batch_size
+        self.session_pool = session_pool
+        self.drivertype = drivertype
+        self.retry_policy = retry_policy or RetryPolicy()
+        # Set by capture(), captures are aggregated as they are written
+        self.aggregate_manifest = None
+        # Set by capture(), captures are checkpointed as they are written
+        self.journal = None
+        self.output_index = output_index
+        self.blob_store = blob_store
+        self.on_captured = on_captured
         self.logger = logger.Logger(name="capture", writefile=True).get()
-        self.placelocal_api = placelocal.PlaceLocalApi(domain=self.domain)
+        self.placelocal_api = placelocal.PlaceLocalApi(
+            domain=self.domain, tag_cache=tag_cache, refresh_tags=refresh_tags)
+
+    def _notify_captured(self, pathbuilder, configname, unit, skipped=False):
+        cid, tagsize, tagtype = unit
+        pb = pathbuilder.clone(config=configname, cid=cid, tagsize=tagsize,
+                               tagtype=tagtype)
+        if not skipped and self.aggregate_manifest:
+            # The tag image might be a link to an older blob, so its mtime
+            # is not the capture time
+            output.aggregate_tag(pb, manifest=self.aggregate_manifest,
+                                 timestamp=time.time())
+        if not self.on_captured:
+            return
+        try:
+            self.on_captured(pb)
+        except Exception:
+            self.logger.exception("on_captured failed for %s", pb.path)
+
+    def _get_sessions_per_config(self, configs):
+        if self.sessions_per_config is not None:
+            return self.sessions_per_config
+        if self.drivertype != WebDriverType.LOCAL or not configs:
+            return 1
+        # Local browsers are sized to the cores, so every core gets a session
+        return int(math.ceil(float(self.max_sessions) / len(configs)))
+
+    def _open_session(self, configname, buildname):
+        return TagCapture.from_config(configname, buildname,
+                                      readiness=self.readiness,
+                                      output_index=self.output_index,
+                                      blob_store=self.blob_store,
+                                      batch_size=self.batch_size,
+                                      session_pool=self.session_pool,
+                                      drivertype=self.drivertype,
+                                      journal=self.journal,
+                                      retry_policy=self.retry_policy)
 
     def _capture_tags_for_configs(self, cids, pathbuilder,
                                   configs,
@@ -201,59 +908,132 @@ class CaptureManager(object):
             self.logger.warn("No tags found to capture!")
             return
 
+        buildname = 'tagcompare_' + pathbuilder.build
+        sessions_per_config = self._get_sessions_per_config(configs)
+        scheduler = CaptureScheduler(
+            open_session=lambda c: self._open_session(c, buildname),
+            sessions_per_config=sessions_per_config,
+            max_sessions=self.max_sessions, batch_size=self.batch_size)
+        units = get_capture_units(all_tags, tagsizes, tagtypes)
+        for configname in configs:
+            scheduler.add(configname, units)
         self.logger.info(
-            "Capturing tags for %s campaigns over %s configs", len(cids),
-            len(configs))
-        # TODO: Implement progress bar
-        errors = []
+            "Capturing %s tags for %s campaigns over %s configs "
+            "with up to %s sessions per config, max %s sessions",
+            scheduler.queue_depth(), len(all_tags), len(configs),
+            sessions_per_config, self.max_sessions)
 
-        # multi-thread the compare part because it's slow
-        pool = ThreadPool(processes=CaptureManager.MAX_REMOTE_JOBS)
-        captures = {}
+        def capture_units(tagcapture, configname, units):
+            results = tagcapture.capture_batch(
+                all_tags, pathbuilder.clone(config=configname), units,
+                capture_existing=capture_existing)
+            errors = []
+            for unit, r in zip(units, results):
+                if r is False:
+                    continue
+                self._notify_captured(pathbuilder, configname, unit,
+                                      skipped=r is None)
+                errors += r or []
+            return errors
 
-        buildname = 'tagcompare_' + pathbuilder.build
-        for configname in configs:
-            tagcapture = TagCapture.from_config(configname, buildname)
-            pathbuilder.config = configname
-            cpb = pathbuilder.clone()
-            captures[configname] = pool.apply_async(
-                func=tagcapture.capture_tags,
-                args=(all_tags, cpb,
-                      tagsizes, tagtypes,
-                      capture_existing))
-
-        for configname in captures:
-            errors += captures[configname].get()
+        errors = scheduler.run(capture_units)
+        self.logger.info("Ran %s capture units for %s",
+                         scheduler.dispatched, pathbuilder.build)
+        summary = self.retry_policy.summary()
+        self.logger.info(
+            "Capture summary for %s: %s retries, %s sessions replaced, "
+            "%s units failed, %s units skipped for %s quarantined "
+            "campaigns: %s", pathbuilder.build, summary['retries'],
+            summary['recycled'], summary['failed'], summary['skipped'],
+            len(summary['quarantined']), summary['quarantined'])
         if errors:
             self.logger.error(
                 "%s found console errors:\n%s", pathbuilder.build, errors)
         return errors
 
-    def capture(self):
+    def capture(self, build=None, resume=False):
         """
         Runs capture, returns the job name for the capture job
-        :param cids:
-        :param pids:
+        :param build: optional build string, generated if not set
+        :param resume: continue an earlier run of build, capturing only the
+            units that are not in its journal
         :return: the original build string
         """
+        if resume and not build:
+            raise ValueError("build must be defined to resume a capture!")
+        configs = settings.DEFAULT.configs_in_comparisons()
+        if self.drivertype == WebDriverType.LOCAL:
+            check_local_configs(configs)
 
-        original_build = output.generate_build_string()
-        build = "capture_" + original_build
+        original_build = build or output.generate_build_string()
+        build = output.CAPTURE_BUILD_PREFIX + original_build
         pathbuilder = output.create(build=build)
-        cids = self.placelocal_api.get_cids_from_settings()
-        self.logger.info("Starting capture against %s for %s campaigns: %s...",
-                         settings.DEFAULT.domain,
-                         len(cids), cids)
-        output.aggregate()
+        if resume and not os.path.exists(pathbuilder.buildpath):
+            raise ValueError("No capture to resume at {}".format(
+                pathbuilder.buildpath))
+        self.journal = CaptureJournal(pathbuilder.buildpath, resume=resume)
+        if resume:
+            self.logger.info("Resuming capture %s with %s units captured",
+                             build, len(self.journal))
+        # Tags are fetched as the campaigns of the publishers are found
+        cids = self.placelocal_api.iter_cids_from_settings()
+        self.logger.info("Starting capture against %s...",
+                         settings.DEFAULT.domain)
+        self.aggregate_manifest = output.AggregateManifest(
+            output.DEFAULT_BUILD_PATH)
+        output.aggregate(manifest=self.aggregate_manifest)
 
-        configs = settings.DEFAULT.configs_in_comparisons()
-        self._capture_tags_for_configs(
-            cids=cids, pathbuilder=pathbuilder, configs=configs)
+        try:
+            self._capture_tags_for_configs(
+                cids=cids, pathbuilder=pathbuilder, configs=configs)
+        finally:
+            self.aggregate_manifest.set_indexed(build)
+            self.aggregate_manifest.save()
         return original_build
 
 
-def main():
-    CaptureManager().capture()
+def main(readiness=TagReadiness.FIXED, sessions_per_config=None,
+         max_sessions=None, use_tag_cache=True,
+         refresh_tags=False, build=None, on_captured=None,
+         use_blob_store=False, batch_size=1,
+         drivertype=WebDriverType.REMOTE, resume=False, max_retries=2,
+         quarantine_after=2, session_pool=None):
+    """
+    :param session_pool: webdriver.SessionPool of the process, kept open so
+        a later capture with the same configs can reuse its sessions.  A pool
+        is made and closed for this capture if it's not set.
+    """
+    if max_sessions is None:
+        max_sessions = webdriver.LOCAL_MAX_SESSIONS \
+            if drivertype == WebDriverType.LOCAL \
+            else CaptureManager.MAX_REMOTE_JOBS
+    tag_cache = cache.TagCache() if use_tag_cache else None
+    blob_store = blobstore.BlobStore() if use_blob_store else None
+    retry_policy = RetryPolicy(max_retries=max_retries,
+                               quarantine_after=quarantine_after)
+    own_pool = session_pool is None
+    if own_pool:
+        session_pool = webdriver.SessionPool()
+    manager = CaptureManager(readiness=readiness,
+                             sessions_per_config=sessions_per_config,
+                             max_sessions=max_sessions,
+                             tag_cache=tag_cache,
+                             refresh_tags=refresh_tags,
+                             on_captured=on_captured,
+                             output_index=index.OutputIndex(),
+                             blob_store=blob_store,
+                             batch_size=batch_size,
+                             session_pool=session_pool,
+                             drivertype=drivertype,
+                             retry_policy=retry_policy)
+    try:
+        return manager.capture(build=build, resume=resume)
+    finally:
+        if own_pool:
+            session_pool.close()
+        if blob_store:
+            # Captures that were replaced release their blobs
+            blob_store.gc()
 
 if __name__ == '__main__':
     main()
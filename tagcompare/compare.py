@@ -1,5 +1,9 @@
 import os
+import json
+import time
 import itertools
+import multiprocessing
+import threading
 from multiprocessing.pool import ThreadPool
 
 import settings
@@ -7,14 +11,25 @@ import placelocal
 import logger
 import output
 import image
+import cache
+import index
 
 
 LOGGER = logger.Logger("compare", writefile=True).get()
 NUM_COMPARE_PROCESSES = 8
+# Part of the cache keys, bump this when compare scores or rendering change
+COMPARE_VERSION = 1
 
 placelocal_api = placelocal.PlaceLocalApi()
 
 
+class CompareExecutor(object):
+    """Backends for running compare jobs"""
+    SERIAL = "SERIAL"
+    THREADS = "THREADS"
+    PROCESSES = "PROCESSES"
+
+
 class CompareResult(object):
     def __init__(self):
         self.result = {
@@ -39,6 +54,114 @@ class CompareResult(object):
         return self.result
 
 
+class RenderPolicy(object):
+    """When to render the compare matrix image for a tag"""
+    # Render every tag as soon as it's compared
+    ALWAYS = "ALWAYS"
+    # Only render tags with an ImageErrorLevel of SLIGHT and above
+    FLAGGED = "FLAGGED"
+    # Don't render while comparing, see render_deferred()
+    DEFERRED = "DEFERRED"
+
+
+def _should_render(level, render):
+    if level == settings.ImageErrorLevel.INVALID:
+        return False
+    if render == RenderPolicy.ALWAYS:
+        return True
+    elif render == RenderPolicy.FLAGGED:
+        return level >= settings.ImageErrorLevel.SLIGHT
+    elif render == RenderPolicy.DEFERRED:
+        return False
+    raise ValueError('Unsupported `render`!  see RenderPolicy')
+
+
+class CompareManifest(object):
+    """Keeps track of compare runs per comparison, stored as json in the
+    output directory next to the builds
+    """
+    FILENAME = "compare_manifest.json"
+
+    def __init__(self, basepath=output.OUTPUT_DIR):
+        self.filepath = os.path.join(basepath, CompareManifest.FILENAME)
+        self._data = {}
+        if os.path.exists(self.filepath):
+            with open(self.filepath, 'r') as f:
+                self._data = json.load(f)
+
+    def _comparison(self, comparison):
+        return self._data.setdefault(comparison, {})
+
+    def last_run(self, comparison):
+        """
+        :return: the start time of the last completed run, None if never run
+        """
+        return self._data.get(comparison, {}).get('last_run')
+
+    def set_last_run(self, comparison, timestamp):
+        self._comparison(comparison)['last_run'] = timestamp
+
+    def get_tags(self, comparison):
+        """
+        :return: the score rows for comparison, keyed by tag name
+        """
+        return self._data.get(comparison, {}).get('tags', {})
+
+    def set_tag(self, comparison, tagname, row):
+        """
+        Records the score row for a tag, i.e. from _run_compare_job
+        """
+        self._comparison(comparison).setdefault('tags', {})[tagname] = row
+
+    def save(self):
+        tmppath = self.filepath + ".tmp"
+        with open(tmppath, 'w') as f:
+            json.dump(self._data, f, indent=2)
+        os.rename(tmppath, self.filepath)
+
+
+def get_changed_tags(basepath=output.OUTPUT_DIR, comparison="latest",
+                     capture_build=None, manifest=None, output_index=None):
+    """
+    Gets the tags that need to be compared again
+    :param capture_build: optional build name, all tags captured by it count
+        as changed
+    :param manifest: the CompareManifest with the last run for comparison
+    :param output_index: optional index.OutputIndex, used instead of walking
+        the builds if it has the captures of capture_build
+    :return: a set of (cid, tagsize, tagtype), None if everything has to be
+        compared
+    """
+    if not manifest:
+        manifest = CompareManifest(basepath)
+    last_run = manifest.last_run(comparison)
+    if last_run is None:
+        LOGGER.info("No previous '%s' compare run, comparing all tags",
+                    comparison)
+        return None
+
+    captured = None
+    if output_index and capture_build:
+        captured = output_index.get_tags(build=capture_build)
+    if captured:
+        tags = output_index.get_tags(since=last_run) | captured
+        LOGGER.info("Found %s changed tags since the last '%s' compare in %s",
+                    len(tags), comparison, output_index)
+        return tags
+
+    tags = set()
+    if capture_build and \
+            os.path.exists(os.path.join(basepath, capture_build)):
+        tags |= output.get_tags(capture_build, basedir=basepath)
+    default_path = os.path.join(basepath, output.DEFAULT_BUILD_NAME)
+    if os.path.exists(default_path):
+        tags |= output.get_tags(output.DEFAULT_BUILD_NAME, basedir=basepath,
+                                since=last_run)
+    LOGGER.info("Found %s changed tags since the last '%s' compare",
+                len(tags), comparison)
+    return tags
+
+
 def __write_result_image(pathbuilder, result_image,
                          outputdir=None, info=None, prefix="merged"):
     if not outputdir:
@@ -54,28 +177,74 @@ def __write_result_image(pathbuilder, result_image,
     result_image.save(open(filename, 'wb'))
 
 
-def _get_compare_matrix(pathbuilder, configs):
+def _get_tag_images(pathbuilder, configs):
+    """
+    Gets the working set of captured images for a tag, keyed by config
+    """
     compare_pb = pathbuilder.clone(build=output.DEFAULT_BUILD_NAME)
+    files = {}
+    for cfg in configs:
+        files[cfg] = compare_pb.clone(config=cfg).tagimage
+    return image.ImageSet(files)
+
+
+def _draw_reference_tile(canvas, images, position, cfg):
+    # The label is drawn on a copy to keep the shared image clean.
+    tagimage = images.get(cfg).copy()
+    image.add_label(image=tagimage, label=cfg)
+    # Use 4-tuple for "draw_position"? Shouldn't be necessary since width and
+    # height are invariant.
+    image.draw_reference_copy(canvas=canvas, srcimg=tagimage, position=position)
+
+
+def _draw_diff_tile(canvas, images, position, a_cfg, b_cfg, overlay_mask):
+    cfgstring = a_cfg + " x " + b_cfg
+    image.draw_visual_diff(canvas=canvas, img1=images.get(a_cfg),
+                           img2=images.get(b_cfg), position=position,
+                           cfgstring=cfgstring, overlay_mask=overlay_mask)
+
 
+def _draw_tile(canvas, images, position, configs, overlay_mask=None,
+               compare_cache=None):
+    """
+    Draws a tile of the compare matrix, reusing a cached copy when possible
+    :param configs: one config for a reference tile, two for a diff tile
+    """
+    key = None
+    if compare_cache:
+        kind = "reference" if len(configs) == 1 else "diff"
+        key = _get_cache_key(kind, images, *configs)
+        tile = compare_cache.get_tile(key)
+        if tile:
+            canvas.paste(tile, box=position)
+            return
+
+    if len(configs) == 1:
+        _draw_reference_tile(canvas, images, position, configs[0])
+    else:
+        _draw_diff_tile(canvas, images, position, configs[0], configs[1],
+                        overlay_mask)
+
+    if compare_cache:
+        width, height = images.size(configs[0])
+        box = (position[0], position[1],
+               position[0] + width, position[1] + height)
+        compare_cache.set_tile(key, canvas.crop(box))
+
+
+def _get_compare_matrix(pathbuilder, configs, images=None, compare_cache=None):
     # Assumes all compared images will have the same dimensions, also that there is at
     # least one config.
     if len(configs) <= 0:
         LOGGER.error("Cannot build comparison matrix, no configs.")
         return None
 
-    test_image = image.normalize_img(
-        compare_pb.clone(config=configs[0]).tagimage)
-    single_image_width = test_image.width
-    single_image_height = test_image.height
+    # Each image is decoded once and reused n times
+    if not images:
+        images = _get_tag_images(pathbuilder, configs)
+    single_image_width, single_image_height = images.size(configs[0])
     num_configs = len(configs)
 
-    # Small optimization: we will reuse each image n times, so loading in advance
-    # reduces number of loads to n from n^2.
-    images_by_config = {}
-    for cfg in configs:
-        images_by_config[cfg] = image.normalize_img(
-            compare_pb.clone(config=cfg).tagimage)
-
     # 2x2 comparison matrix, so it'll be kinda big.
     compare_image = image.blank_compare_matrix(num_configs, single_image_width,
                                                single_image_height)
@@ -94,111 +263,444 @@ def _get_compare_matrix(pathbuilder, configs):
         if a == b:
             # Special case, we know they'll be same image, so just render the
             # image.
-            tagimage = image.normalize_img(
-                compare_pb.clone(config=a_cfg).tagimage)
-            image.add_label(image=tagimage, label=a_cfg)
-            # Use 4-tuple for "draw_position"? Shouldn't be necessary since width and
-            # height are invariant.
-            image.draw_reference_copy(canvas=compare_image, srcimg=tagimage,
-                                      position=draw_position)
+            tile_configs = [a_cfg]
         else:
             # Normal case, so we do a "comparison"
-            a_img = images_by_config[a_cfg]
-            b_img = images_by_config[b_cfg]
-            cfgstring = a_cfg + " x " + b_cfg
-            image.draw_visual_diff(canvas=compare_image, img1=a_img, img2=b_img,
-                                   position=draw_position, cfgstring=cfgstring,
-                                   overlay_mask=difference_overlay_mask)
+            tile_configs = [a_cfg, b_cfg]
+        _draw_tile(canvas=compare_image, images=images, position=draw_position,
+                   configs=tile_configs, overlay_mask=difference_overlay_mask,
+                   compare_cache=compare_cache)
 
     return compare_image
 
 
-def _compare_configs(pathbuilder, configs, comparison, result):
-    diff = _compare_configs_internal(pathbuilder=pathbuilder, configs=configs)
+def _get_cache_key(kind, images, *configs):
+    """
+    Makes a cache key from the content of the images for the configs.
+    The config names are part of the key since they're drawn as labels.
+    """
+    parts = [COMPARE_VERSION, kind]
+    for cfg in configs:
+        parts += [cfg, images.digest(cfg)]
+    return cache.make_key(*parts)
+
+
+def _compare_configs(pathbuilder, configs, comparison, compare_cache=None,
+                     render=RenderPolicy.ALWAYS):
+    """
+    Compares a tag over the configs and writes the comparison matrix
+    :param compare_cache: optional cache.CompareCache for scores and tiles
+    :param render: the RenderPolicy for the comparison matrix
+    :return: a tuple of the ImageErrorLevel for the tag, the average diff and
+        whether the comparison matrix was rendered
+    """
+    images = _get_tag_images(pathbuilder, configs)
+    diff = _compare_configs_internal(pathbuilder=pathbuilder, configs=configs,
+                                     images=images, compare_cache=compare_cache)
     if diff == settings.ImageErrorLevel.INVALID:
-        result.increment(key=diff)
-        return False
+        return diff, diff, False
+
+    level = _get_error_level(diff)
+    if not _should_render(level, render):
+        return level, diff, False
+
+    _render(pathbuilder, configs, comparison, diff, images=images,
+            compare_cache=compare_cache)
+    return level, diff, True
 
+
+def _render(pathbuilder, configs, comparison, diff, images=None,
+            compare_cache=None):
     result_image = _get_compare_matrix(
-        pathbuilder=pathbuilder, configs=configs)
+        pathbuilder=pathbuilder, configs=configs, images=images,
+        compare_cache=compare_cache)
 
     prefix_label = comparison + "_"
-    r = __handle_output(pathbuilder=pathbuilder, result_image=result_image,
-                        diff=diff, prefix=prefix_label)
-    result.increment(key=r)
+    return __handle_output(pathbuilder=pathbuilder, result_image=result_image,
+                           diff=diff, prefix=prefix_label)
 
 
-def _compare_configs_internal(pathbuilder, configs):
+def _make_compare_job(pathbuilder, configs, comparison, compare_cache=None,
+                      render=RenderPolicy.ALWAYS):
+    """
+    Makes a picklable description of a compare job so it can be sent to
+    another process
+    """
+    return {
+        "parts": pathbuilder.parts,
+        "basepath": pathbuilder.basepath,
+        "configs": tuple(configs),
+        "comparison": comparison,
+        "cache_args": compare_cache.args if compare_cache else None,
+        "render": render
+    }
+
+
+def _run_compare_job(job):
+    """
+    Runs a job made by _make_compare_job
+    :return: the result row for the tag, with the ImageErrorLevel as an int,
+        the diff, whether it was rendered and the cache hits and misses
+    """
+    pathbuilder = output.PathBuilder(parts=list(job["parts"]),
+                                     basepath=job["basepath"])
+    # Each job counts its own cache stats, the parent adds them up
+    cache_args = job["cache_args"]
+    compare_cache = cache.CompareCache(*cache_args) if cache_args else None
+    level, diff, rendered = _compare_configs(
+        pathbuilder=pathbuilder, configs=list(job["configs"]),
+        comparison=job["comparison"], compare_cache=compare_cache,
+        render=job["render"])
+    return {
+        "comparison": job["comparison"],
+        "tagname": pathbuilder.tagname,
+        "build": pathbuilder.build,
+        "cid": pathbuilder.cid,
+        "tagsize": pathbuilder.tagsize,
+        "tagtype": pathbuilder.tagtype,
+        "configs": list(job["configs"]),
+        "level": int(level),
+        "diff": int(diff),
+        "rendered": rendered,
+        "hits": compare_cache.hits if compare_cache else 0,
+        "misses": compare_cache.misses if compare_cache else 0
+    }
+
+
+def _create_pool(executor, processes=None):
+    """
+    Creates the worker pool for a CompareExecutor
+    :param processes: number of workers, defaults to a size for the executor
+    :return: the pool, or None for serial execution
+    """
+    if executor == CompareExecutor.SERIAL:
+        return None
+    elif executor == CompareExecutor.THREADS:
+        return ThreadPool(processes=processes or NUM_COMPARE_PROCESSES)
+    elif executor == CompareExecutor.PROCESSES:
+        return multiprocessing.Pool(
+            processes=processes or multiprocessing.cpu_count())
+    raise ValueError('Unsupported `executor`!  see CompareExecutor')
+
+
+def _compare_configs_internal(pathbuilder, configs, images=None,
+                              compare_cache=None):
     """
     Compares a given tag for all combinations of the specified list of configs
     :param pathbuilder: the pathbuilder pointing to the tag to compare
     :param configs: the list of configs to compare
+    :param images: optional image.ImageSet for the tag, shared with other passes
+    :param compare_cache: optional cache.CompareCache for the scores
     :return: the average diff from image comparison
     """
+    if not images:
+        images = _get_tag_images(pathbuilder, configs)
     total_diff = 0
-    compare_pb = pathbuilder.clone(build=output.DEFAULT_BUILD_NAME)
     combo_count = 0
     for a, b in itertools.combinations(configs, 2):
-        pba = compare_pb.clone(config=a)
-        pbb = compare_pb.clone(config=b)
-        pba_image = pba.tagimage
-        pbb_image = pbb.tagimage
-        if not os.path.exists(pba_image):
-            LOGGER.error("File not found: %s", pba_image)
+        if not images.exists(a):
+            LOGGER.error("File not found: %s", images.path(a))
             return settings.ImageErrorLevel.INVALID
-        if not os.path.exists(pbb_image):
-            LOGGER.error("File not found: %s", pbb_image)
+        if not images.exists(b):
+            LOGGER.error("File not found: %s", images.path(b))
             return settings.ImageErrorLevel.INVALID
-        total_diff += image.compare(pba.tagimage, pbb.tagimage)
+        total_diff += _compare_pair(images, a, b, compare_cache)
         combo_count += 1
     return total_diff / combo_count
 
 
+def _compare_pair(images, a, b, compare_cache=None):
+    if not compare_cache:
+        return images.compare(a, b)
+
+    key = cache.make_key(COMPARE_VERSION, "score",
+                         images.digest(a), images.digest(b))
+    score = compare_cache.get_score(key)
+    if score is None:
+        score = images.compare(a, b)
+        if score is not False:
+            compare_cache.set_score(key, score)
+    return score
+
+
+def _make_compare_jobs(pb, cids, sizes, types, configs, comparison,
+                       compare_cache=None, tags=None, render=RenderPolicy.ALWAYS):
+    jobs = []
+    num_skipped = 0
+    for cid in cids:
+        for s in sizes:
+            for t in types:
+                if tags is not None and (str(cid), s, t) not in tags:
+                    num_skipped += 1
+                    continue
+                newpb = pb.clone(cid=cid, tagsize=s, tagtype=t)
+                jobs.append(_make_compare_job(newpb, configs, comparison,
+                                              compare_cache, render=render))
+    if num_skipped:
+        LOGGER.info("Skipping %s unchanged tags", num_skipped)
+    return jobs
+
+
+def _merge_compare_row(row, result, compare_cache=None, manifest=None,
+                       output_index=None):
+    result.increment(key=settings.ImageErrorLevel(row["level"]))
+    hits = row.pop("hits")
+    misses = row.pop("misses")
+    if compare_cache:
+        compare_cache.hits += hits
+        compare_cache.misses += misses
+    # Only the parent writes to the index, workers never wait on its lock
+    if output_index:
+        output_index.add_compare(row)
+    if manifest:
+        manifest.set_tag(row.pop("comparison"), row.pop("tagname"), row)
+
+
+def _run_compare_jobs(jobs, pool, result, compare_cache=None, manifest=None,
+                      output_index=None):
+    if pool:
+        job_results = pool.imap_unordered(_run_compare_job, jobs)
+    else:
+        job_results = itertools.imap(_run_compare_job, jobs)
+    try:
+        # Results are merged here so workers never share the CompareResult
+        for row in job_results:
+            _merge_compare_row(row, result, compare_cache, manifest,
+                               output_index)
+    except Exception:
+        if pool:
+            pool.terminate()
+        raise
+    else:
+        if pool:
+            pool.close()
+    finally:
+        if pool:
+            pool.join()
+    return result
+
+
 def compare(pb, cids, sizes=settings.DEFAULT.tagsizes,
             types=settings.DEFAULT.tagtypes,
             comparison="latest",  # TODO: Don't hardcode
-            configs=None):
+            configs=None, executor=CompareExecutor.PROCESSES, processes=None,
+            compare_cache=None, tags=None, render=RenderPolicy.ALWAYS,
+            manifest=None, output_index=None):
+    """
+    Compares tags for all the cids, sizes and types over the configs
+    :param tags: optional set of (cid, tagsize, tagtype) to restrict the
+        compare to, i.e. from get_changed_tags()
+    :param render: the RenderPolicy for the comparison matrix images
+    :param manifest: optional CompareManifest to record the score rows in
+    :param output_index: optional index.OutputIndex to record the results in
+    :return: the CompareResult
+    """
     if not configs:
         configs = settings.DEFAULT.all_comparisons[comparison]
 
-    pool = ThreadPool(processes=NUM_COMPARE_PROCESSES)
-    compare_threads = []
+    pool = _create_pool(executor, processes=processes)
     result = CompareResult()
-    LOGGER.info("Starting compare for %s campaigns over %s configs...",
-                len(cids), len(configs))
-
-    for cid in cids:
-        for s in sizes:
-            for t in types:
-                newpb = pb.clone(cid=cid, tagsize=s, tagtype=t)
-                compare_threads.append(pool.apply_async(func=_compare_configs,
-                                                        args=(newpb, configs,
-                                                              comparison, result)))
-    for ct in compare_threads:
-        ct.get()
+    LOGGER.info("Starting compare for %s campaigns over %s configs (%s)...",
+                len(cids), len(configs), executor)
+
+    jobs = _make_compare_jobs(pb, cids, sizes, types, configs, comparison,
+                              compare_cache=compare_cache, tags=tags,
+                              render=render)
+    _run_compare_jobs(jobs, pool, result, compare_cache=compare_cache,
+                      manifest=manifest, output_index=output_index)
+    if compare_cache:
+        LOGGER.info("%s", compare_cache)
+        compare_cache.evict()
     LOGGER.info("Compare over configs=%s, result=%s", configs, result)
     return result
 
 
-def __handle_output(pathbuilder, result_image, diff, prefix=""):
-    info = {"name": pathbuilder.tagname, "diff": diff}
-    result = settings.ImageErrorLevel.NONE
+class ComparePipeline(object):
+    """Compares tags while they are still being captured
+    Capture calls captured() for every tag it finishes for a config, after
+    aggregating it to the 'default' build.  The tag's compare job is queued
+    as soon as every config in the comparison has it, so diffing overlaps
+    with the browser time of the remaining captures.
+    """
 
+    def __init__(self, build, comparison="latest", configs=None,
+                 executor=CompareExecutor.PROCESSES, processes=None,
+                 compare_cache=None, render=RenderPolicy.ALWAYS,
+                 manifest=None, basepath=output.OUTPUT_DIR,
+                 output_index=None):
+        """
+        :param build: the capture build string, see capture.main()
+        :param manifest: optional CompareManifest to record the score rows
+            and the run in
+        :param output_index: optional index.OutputIndex to record the results
+        """
+        if not configs:
+            configs = settings.DEFAULT.all_comparisons[comparison]
+        self.pathbuilder = output.create(build="compare_" + build,
+                                         basepath=basepath)
+        self.comparison = comparison
+        self.configs = list(configs)
+        self.compare_cache = compare_cache
+        self.render = render
+        self.manifest = manifest
+        self.output_index = output_index
+        self.result = CompareResult()
+        self._pool = _create_pool(executor, processes=processes)
+        self._lock = threading.Lock()
+        self._captured = {}
+        self._queued = set()
+        self._jobs = []
+        # Anything captured after this will be picked up by the next run
+        self._started = time.time()
+
+    @property
+    def num_queued(self):
+        return len(self._queued)
+
+    def captured(self, pathbuilder):
+        """
+        Called when a tag was captured, or skipped because it already exists
+        :param pathbuilder: pathbuilder of the capture, including config
+        """
+        if pathbuilder.config not in self.configs:
+            return
+        tag = (pathbuilder.cid, pathbuilder.tagsize, pathbuilder.tagtype)
+        with self._lock:
+            configs = self._captured.setdefault(tag, set())
+            configs.add(pathbuilder.config)
+            if len(configs) < len(self.configs) or tag in self._queued:
+                return
+            self._queued.add(tag)
+        self._queue(tag)
+
+    def _queue(self, tag):
+        cid, tagsize, tagtype = tag
+        pb = self.pathbuilder.clone(cid=cid, tagsize=tagsize, tagtype=tagtype)
+        job = _make_compare_job(pb, self.configs, self.comparison,
+                                self.compare_cache, render=self.render)
+        # Serial jobs run right away, in the calling capture thread
+        if self._pool:
+            job = self._pool.apply_async(_run_compare_job, (job,))
+        else:
+            job = _run_compare_job(job)
+        with self._lock:
+            self._jobs.append(job)
+
+    def close(self):
+        """
+        Compares the tags that were not captured for every config, i.e. on
+        capture errors, and waits for all the compare jobs
+        :return: the CompareResult
+        """
+        with self._lock:
+            remaining = [t for t in self._captured if t not in self._queued]
+            self._queued.update(remaining)
+        try:
+            for tag in remaining:
+                self._queue(tag)
+            for job in self._jobs:
+                row = job.get() if self._pool else job
+                _merge_compare_row(row, self.result, self.compare_cache,
+                                   self.manifest, self.output_index)
+        except Exception:
+            if self._pool:
+                self._pool.terminate()
+            if self.manifest:
+                # Keeps the rows merged so far, the run is not completed
+                self.manifest.save()
+            raise
+        else:
+            if self._pool:
+                self._pool.close()
+        finally:
+            if self._pool:
+                self._pool.join()
+        if self.compare_cache:
+            LOGGER.info("%s", self.compare_cache)
+            self.compare_cache.evict()
+        if self.manifest:
+            self.manifest.set_last_run(self.comparison, self._started)
+            self.manifest.save()
+        LOGGER.info("Pipelined compare over configs=%s, result=%s",
+                    self.configs, self.result)
+        return self.result
+
+
+_LEVEL_PREFIXES = {
+    settings.ImageErrorLevel.NONE: "",
+    settings.ImageErrorLevel.SLIGHT: "slight_",
+    settings.ImageErrorLevel.MODERATE: "moderate_",
+    settings.ImageErrorLevel.SEVERE: "severe_",
+}
+
+
+def _get_error_level(diff):
+    """
+    :return: the ImageErrorLevel for an average diff
+    """
     if diff > settings.ImageErrorLevel.SEVERE:
-        prefix += "severe_"
-        result = settings.ImageErrorLevel.SEVERE
+        return settings.ImageErrorLevel.SEVERE
     elif diff > settings.ImageErrorLevel.MODERATE:
-        prefix += "moderate_"
-        result = settings.ImageErrorLevel.MODERATE
+        return settings.ImageErrorLevel.MODERATE
     elif diff > settings.ImageErrorLevel.SLIGHT:
-        prefix += "slight_"
-        result = settings.ImageErrorLevel.SLIGHT
+        return settings.ImageErrorLevel.SLIGHT
+    return settings.ImageErrorLevel.NONE
+
+
+def __handle_output(pathbuilder, result_image, diff, prefix=""):
+    info = {"name": pathbuilder.tagname, "diff": diff}
+    result = _get_error_level(diff)
+    prefix += _LEVEL_PREFIXES[result]
     __write_result_image(pathbuilder=pathbuilder, result_image=result_image,
                          info=info, prefix=prefix)
     return result
 
 
-def main(build=None):
+def render_deferred(comparison="latest", basepath=output.OUTPUT_DIR,
+                    min_level=settings.ImageErrorLevel.NONE, manifest=None,
+                    compare_cache=None):
+    """
+    Renders the comparison matrix for tags that were compared without
+    rendering, using the scores stored in the CompareManifest
+    :param min_level: only render tags at or above this ImageErrorLevel
+    :return: the number of tags rendered
+    """
+    if not manifest:
+        manifest = CompareManifest(basepath)
+    num_rendered = 0
+    for tagname, row in manifest.get_tags(comparison).items():
+        if row["rendered"] or row["level"] < min_level or \
+                row["level"] == settings.ImageErrorLevel.INVALID:
+            continue
+        pathbuilder = output.create(build=row["build"], cid=row["cid"],
+                                    tagsize=row["tagsize"],
+                                    tagtype=row["tagtype"], basepath=basepath)
+        _render(pathbuilder, row["configs"], comparison, row["diff"],
+                compare_cache=compare_cache)
+        row["rendered"] = True
+        manifest.set_tag(comparison, tagname, row)
+        num_rendered += 1
+    manifest.save()
+    LOGGER.info("Rendered %s deferred '%s' compare matrices",
+                num_rendered, comparison)
+    return num_rendered
+
+
+def start_pipeline(build, executor=CompareExecutor.PROCESSES, use_cache=True,
+                   comparison="latest", render=RenderPolicy.ALWAYS):
+    """
+    Starts a ComparePipeline for a capture build, pass its captured() to
+    capture.main and close() it once capture is done
+    """
+    compare_cache = cache.CompareCache() if use_cache else None
+    return ComparePipeline(build, comparison=comparison, executor=executor,
+                           compare_cache=compare_cache, render=render,
+                           manifest=CompareManifest(),
+                           output_index=index.OutputIndex())
+
+
+def main(build=None, executor=CompareExecutor.PROCESSES, use_cache=True,
+         incremental=False, comparison="latest", render=RenderPolicy.ALWAYS):
     LOGGER.info("Starting compare for cid=%s, pids=%s...",
                 settings.DEFAULT.campaigns, settings.DEFAULT.publishers)
     output.aggregate()
@@ -209,7 +711,23 @@ def main(build=None):
     pb = output.create(build=jobname)
 
     cids = placelocal_api.get_cids_from_settings()
-    compare(pb, cids=cids)
+    compare_cache = cache.CompareCache() if use_cache else None
+    manifest = CompareManifest(pb.basepath)
+    output_index = index.OutputIndex()
+    tags = None
+    if incremental:
+        tags = get_changed_tags(
+            basepath=pb.basepath, comparison=comparison,
+            capture_build=output.CAPTURE_BUILD_PREFIX + build,
+            manifest=manifest, output_index=output_index)
+
+    # Anything captured after this will be picked up by the next run
+    started = time.time()
+    compare(pb, cids=cids, comparison=comparison, executor=executor,
+            compare_cache=compare_cache, tags=tags, render=render,
+            manifest=manifest, output_index=output_index)
+    manifest.set_last_run(comparison, started)
+    manifest.save()
     return pb
 
 
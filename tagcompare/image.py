@@ -1,8 +1,16 @@
+import io
 import math
+import os
 from PIL import Image
 from PIL import ImageDraw
 import shutil
 
+try:
+    import numpy
+except ImportError:  # pragma: no cover
+    numpy = None
+
+import cache
 import logger
 
 LOGGER = logger.Logger(__name__).get()
@@ -13,12 +21,83 @@ def compare(file1, file2):
     image2 = normalize_img(file2)
 
     result = _compare_img(image1, image2)
+    _log_compare_result(result, file1, file2)
+    return result
 
+
+def _log_compare_result(result, file1, file2):
     LOGGER.debug("compare_img result: %s", result)
     if result is False:
         # TODO: Validate image size and normalize them
         LOGGER.error("image compare failed! (%s) <> (%s)", file1, file2)
-    return result
+
+
+class ImageSet(object):
+    """A working set of images that are each decoded at most once
+    Derived data (i.e. histograms) is cached with the decoded image so it can
+    be shared between the different passes over the same set of images
+    """
+
+    def __init__(self, files):
+        """
+        :param files: a dictionary of image file paths, i.e. keyed by config
+        """
+        self._files = files
+        self._opened = {}
+        self._images = {}
+        self._histograms = {}
+        self._digests = {}
+
+    def path(self, key):
+        return self._files[key]
+
+    def exists(self, key):
+        return os.path.exists(self._files[key])
+
+    def _open(self, key):
+        # Opening only reads the header, pixels are decoded on load()
+        if key not in self._opened:
+            self._opened[key] = normalize_img(self._files[key])
+        return self._opened[key]
+
+    def get(self, key):
+        """
+        :return: the decoded PIL.Image for key, shared by all callers
+        """
+        if key not in self._images:
+            img = self._open(key)
+            img.load()
+            self._images[key] = img
+        return self._images[key]
+
+    def digest(self, key):
+        """
+        :return: the sha1 hex digest of the file contents for key
+        """
+        if key not in self._digests:
+            self._digests[key] = cache.file_digest(self._files[key])
+        return self._digests[key]
+
+    def histogram(self, key):
+        if key not in self._histograms:
+            self._histograms[key] = _get_histogram(self.get(key))
+        return self._histograms[key]
+
+    def size(self, key):
+        return self._open(key).size
+
+    def compare(self, key1, key2):
+        """Same as compare(), but reuses the decoded images and histograms
+        """
+        img1 = self._open(key1)
+        img2 = self._open(key2)
+        if img1.mode == img2.mode and img1.mode != "P":
+            result = _compare_histograms(self.histogram(key1),
+                                         self.histogram(key2))
+        else:
+            result = _compare_img(self.get(key1), self.get(key2))
+        _log_compare_result(result, self._files[key1], self._files[key2])
+        return result
 
 
 def generate_diff_img(file1, file2, diff_img_path):
@@ -72,15 +151,50 @@ def add_info(image, info):
     return result
 
 
+def _normalize_modes(images):
+    """Converts images to a common mode so that their histograms line up
+    Mixed modes are compared as RGB, which keeps the same score as comparing
+    the RGB bins of an RGBA histogram.  Palette images are always converted
+    since their histograms count palette indexes, not colors.
+    :return: the list of images, converted as needed
+    """
+    modes = set(img.mode for img in images)
+    if len(modes) == 1 and "P" not in modes:
+        return images
+    return [img if img.mode == "RGB" else img.convert("RGB")
+            for img in images]
+
+
+def _get_histogram(img):
+    if numpy is None:
+        return img.histogram()
+    return numpy.asarray(img.histogram(), dtype=numpy.int64)
+
+
 def _compare_img(img1, img2):
     """Compares two images and return a score for how similar they are
     http://stackoverflow.com/questions/1927660/
     """
-    h1 = img1.histogram()
-    h2 = img2.histogram()
+    img1, img2 = _normalize_modes([img1, img2])
+    return _compare_histograms(_get_histogram(img1), _get_histogram(img2))
+
+
+def _compare_histograms(h1, h2):
     if (len(h1) > len(h2)):
         return False
+    if numpy is None:
+        return _compare_histograms_reference(h1, h2)
 
+    h1 = numpy.asarray(h1, dtype=numpy.int64)
+    h2 = numpy.asarray(h2, dtype=numpy.int64)[:len(h1)]
+    # Integer mean of the squares, same as the reference
+    mean_square = numpy.square(h1 - h2).sum() // len(h1)
+    return int(math.sqrt(mean_square))
+
+
+def _compare_histograms_reference(h1, h2):
+    """Pure python version of _compare_histograms, used without numpy
+    """
     diff_squares = [(h1[i] - h2[i]) ** 2 for i in xrange(len(h1))]
     rms = math.sqrt(sum(diff_squares) / len(h1))
     return int(rms)
@@ -100,6 +214,53 @@ def crop(img_file, cropbox, backup=False):
     return img
 
 
+def crop_png_data(data, cropbox):
+    """Crops an encoded image in memory, i.e. a screenshot from webdriver
+    :param data: the encoded image bytes
+    :param cropbox: the (left, top, right, bottom) box to crop to, or None
+    :return: the cropped PIL.Image
+    """
+    img = Image.open(io.BytesIO(data))
+    if cropbox:
+        # TODO: validate cropbox within image
+        img = img.crop(cropbox)
+    img.load()
+    return img
+
+
+def save(img, img_file):
+    img.save(img_file, format="PNG")
+    return img_file
+
+
+def encode_png(img):
+    """
+    :return: the PNG encoded bytes for img, the same as save() writes
+    """
+    data = io.BytesIO()
+    img.save(data, format="PNG")
+    return data.getvalue()
+
+
+_PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+_PNG_END = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+
+
+def is_complete_png(img_file):
+    """Checks that a png was written completely, without decoding it
+    :return: True if the file starts with the png signature and ends with
+        the IEND chunk
+    """
+    try:
+        with open(img_file, 'rb') as f:
+            if f.read(len(_PNG_SIGNATURE)) != _PNG_SIGNATURE:
+                return False
+            f.seek(-len(_PNG_END), os.SEEK_END)
+            return f.read() == _PNG_END
+    except IOError:
+        return False
+
+
 def normalize_img(img_file, greyscale=False):
     img = Image.open(img_file)
     return img
@@ -130,11 +291,46 @@ def _get_color_distance(px1, px2):
 _DIST_MAX = 2 * 256
 
 
-def draw_visual_diff(canvas, img1, img2, position, cfgstring, overlay_mask):
-    # Algorithm computes "color distance" between matching pixels, then normalizes the
-    # output. This makes the "diff operator" commutative, but we want to overlay the
-    # "diff" against img1 so that you can see semantically what part of the image was
-    # different.
+def _get_normalized_distances(img1, img2):
+    """Vectorized version of _get_normalized_distances_reference
+    Computes the per-pixel color distance over the whole image buffers at once
+    :param img1: the base PIL.Image
+    :param img2: the PIL.Image to diff against img1
+    :return: an "L" PIL.Image of the normalized distances
+    """
+    width, height = img1.size
+    a = numpy.asarray(img1, dtype=numpy.float64)
+    # Only the region covered by img1 is compared, same as the reference
+    b = numpy.asarray(img2, dtype=numpy.float64)[:height, :width]
+    if a.ndim == 3 and b.ndim == 3:
+        # zip() in _get_color_distance stops at the shorter pixel tuple
+        channels = min(a.shape[2], b.shape[2])
+        distances = numpy.sqrt(
+            numpy.square(a[..., :channels] - b[..., :channels]).sum(axis=2))
+    else:
+        distances = numpy.abs(a - b)
+
+    min_dist = min(_DIST_MAX, distances.min())
+    max_dist = max(0.0, distances.max())
+    dist_multiplier = 1.0
+    if (max_dist - min_dist > 0.1):
+        dist_multiplier = 255.0 / (max_dist - min_dist)
+
+    # The reference stores distances in an "F" (float32) image before
+    # normalizing, and int() truncates towards zero, so do the same here.
+    distances = distances.astype(numpy.float32).astype(numpy.float64)
+    normalized = numpy.trunc(dist_multiplier * (distances - min_dist))
+    normalized = numpy.clip(normalized, 0, 255).astype(numpy.uint8)
+    return Image.fromarray(normalized, "L")
+
+
+def _get_normalized_distances_reference(img1, img2):
+    """Per-pixel reference implementation of the normalized distance image
+    Slow, only used when numpy is not available
+    :param img1: the base PIL.Image
+    :param img2: the PIL.Image to diff against img1
+    :return: an "L" PIL.Image of the normalized distances
+    """
     min_dist = _DIST_MAX
     max_dist = 0.0
     distances = Image.new("F", img1.size, 0.0)
@@ -164,6 +360,26 @@ def draw_visual_diff(canvas, img1, img2, position, cfgstring, overlay_mask):
             normalized_dist = \
                 int(dist_multiplier * (distances.getpixel(pixel) - min_dist))
             normalized_distances.putpixel(pixel, normalized_dist)
+    return normalized_distances
+
+
+def get_normalized_distances(img1, img2):
+    """Gets the normalized "color distance" between matching pixels of two images
+    :param img1: the base PIL.Image
+    :param img2: the PIL.Image to diff against img1
+    :return: an "L" PIL.Image with distances scaled to 0-255
+    """
+    if numpy is None:
+        return _get_normalized_distances_reference(img1, img2)
+    return _get_normalized_distances(img1, img2)
+
+
+def draw_visual_diff(canvas, img1, img2, position, cfgstring, overlay_mask):
+    # Algorithm computes "color distance" between matching pixels, then normalizes the
+    # output. This makes the "diff operator" commutative, but we want to overlay the
+    # "diff" against img1 so that you can see semantically what part of the image was
+    # different.
+    normalized_distances = get_normalized_distances(img1, img2)
 
     # Draw base image, then draw diff on top.
     draw_reference_copy(canvas=canvas, srcimg=img1, position=position)
@@ -0,0 +1,170 @@
+"""SQLite index of the captures and compare results in the output directory
+    - TagCapture adds a row per captured tag image
+    - compare adds a row per compared tag
+Queries go to the index instead of walking OUTPUT_DIR/build/cid/size/type/config
+"""
+import os
+import time
+import sqlite3
+
+import settings
+import logger
+import cache
+
+
+INDEX_PATH = os.path.join(settings.OUTPUT_DIR, "index.sqlite")
+LOGGER = logger.Logger(name=__name__, writefile=False).get()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    build TEXT NOT NULL,
+    cid TEXT NOT NULL,
+    tagsize TEXT NOT NULL,
+    tagtype TEXT NOT NULL,
+    config TEXT NOT NULL,
+    path TEXT NOT NULL,
+    hash TEXT,
+    timestamp REAL NOT NULL,
+    PRIMARY KEY (build, cid, tagsize, tagtype, config)
+);
+CREATE INDEX IF NOT EXISTS captures_timestamp ON captures (timestamp);
+CREATE TABLE IF NOT EXISTS compares (
+    build TEXT NOT NULL,
+    comparison TEXT NOT NULL,
+    cid TEXT NOT NULL,
+    tagsize TEXT NOT NULL,
+    tagtype TEXT NOT NULL,
+    configs TEXT NOT NULL,
+    score INTEGER NOT NULL,
+    level INTEGER NOT NULL,
+    rendered INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    PRIMARY KEY (build, comparison, cid, tagsize, tagtype)
+);
+CREATE INDEX IF NOT EXISTS compares_level ON compares (level);
+"""
+
+
+class OutputIndex(object):
+    """Index of captures and compare results
+    Every call uses its own connection, so one index can be shared by
+    capture threads, and other processes can write to the same database.
+    """
+
+    def __init__(self, dbpath=INDEX_PATH):
+        if not dbpath:
+            raise ValueError("dbpath is undefined!")
+        self.dbpath = dbpath
+        dirpath = os.path.dirname(dbpath)
+        if dirpath and not os.path.exists(dirpath):
+            os.makedirs(dirpath)
+        conn = self._connect()
+        try:
+            with conn:
+                # WAL lets readers and a writer work at the same time
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_SCHEMA)
+        finally:
+            conn.close()
+
+    def __str__(self):
+        return "OutputIndex: {}".format(self.dbpath)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.dbpath, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _query(self, sql, args=()):
+        conn = self._connect()
+        try:
+            return [dict(r) for r in conn.execute(sql, args).fetchall()]
+        finally:
+            conn.close()
+
+    def _execute(self, sql, args):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(sql, args)
+        finally:
+            conn.close()
+
+    def add_capture(self, pathbuilder, digest=None, timestamp=None):
+        """
+        Adds or replaces the row for a captured tag image
+        :param pathbuilder: pathbuilder for the capture, including config
+        :param digest: the content hash of the tag image, computed if not set
+        """
+        tagimage = pathbuilder.tagimage
+        if digest is None and os.path.exists(tagimage):
+            digest = cache.file_digest(tagimage)
+        self._execute(
+            "INSERT OR REPLACE INTO captures VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (pathbuilder.build, str(pathbuilder.cid), pathbuilder.tagsize,
+             pathbuilder.tagtype, pathbuilder.config, tagimage, digest,
+             timestamp or time.time()))
+
+    def add_compare(self, row, timestamp=None):
+        """
+        Adds or replaces the row for a compared tag
+        :param row: the result row of a compare job, see compare._run_compare_job
+        """
+        self._execute(
+            "INSERT OR REPLACE INTO compares "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (row["build"], row["comparison"], str(row["cid"]), row["tagsize"],
+             row["tagtype"], ",".join(row["configs"]), row["diff"],
+             row["level"], int(row["rendered"]), timestamp or time.time()))
+
+    @staticmethod
+    def _where(**kwargs):
+        clauses = []
+        args = []
+        for column in sorted(kwargs):
+            value = kwargs[column]
+            if value is None:
+                continue
+            if column == "since":
+                clauses.append("timestamp > ?")
+            elif column == "min_level":
+                clauses.append("level >= ?")
+            else:
+                clauses.append(column + " = ?")
+                value = str(value)
+            args.append(value)
+        if not clauses:
+            return "", args
+        return " WHERE " + " AND ".join(clauses), args
+
+    def get_captures(self, build=None, cid=None, tagsize=None, tagtype=None,
+                     config=None, since=None):
+        """
+        :param since: optional timestamp, only get captures after it
+        :return: the matching capture rows as dicts
+        """
+        where, args = OutputIndex._where(build=build, cid=cid, tagsize=tagsize,
+                                         tagtype=tagtype, config=config,
+                                         since=since)
+        return self._query("SELECT * FROM captures" + where, args)
+
+    def get_compares(self, build=None, comparison=None, min_level=None):
+        """
+        :param min_level: optional ImageErrorLevel, only get compares at or
+            above it
+        :return: the matching compare rows as dicts
+        """
+        where, args = OutputIndex._where(build=build, comparison=comparison,
+                                         min_level=min_level)
+        return self._query("SELECT * FROM compares" + where, args)
+
+    def get_tags(self, build=None, since=None):
+        """
+        Like output.get_tags, without walking the build
+        :return: a set of (cid, tagsize, tagtype) tuples
+        """
+        where, args = OutputIndex._where(build=build, since=since)
+        rows = self._query(
+            "SELECT DISTINCT cid, tagsize, tagtype FROM captures" + where, args)
+        return set((str(r["cid"]), str(r["tagsize"]), str(r["tagtype"]))
+                   for r in rows)
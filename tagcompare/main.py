@@ -1,9 +1,12 @@
 import argparse
 import sys
 import logging
+from contextlib import closing
 
 import capture
 import compare
+import output
+import webdriver
 import settings
 import logger
 import setup
@@ -55,6 +58,71 @@ def __parse_params_to_settings():
     parser = argparse.ArgumentParser()
     parser.add_argument('--capture-only', action='store_true', default=False,
                         help='Run capture only without compare')
+    parser.add_argument('--resume', default=None, metavar='BUILD',
+                        help='Resume the capture of BUILD where it stopped, '
+                             'then compare it')
+    parser.add_argument('--compare-executor',
+                        default=compare.CompareExecutor.PROCESSES,
+                        choices=[compare.CompareExecutor.SERIAL,
+                                 compare.CompareExecutor.THREADS,
+                                 compare.CompareExecutor.PROCESSES],
+                        help='How to run compare jobs (default: %(default)s)')
+    parser.add_argument('--no-compare-cache', action='store_true',
+                        default=False,
+                        help='Re-compare every tag instead of using cached results')
+    parser.add_argument('--incremental', action='store_true', default=False,
+                        help='Only compare tags captured since the last compare')
+    parser.add_argument('--pipeline', action='store_true', default=False,
+                        help='Compare each tag as soon as all its configs are '
+                             'captured, instead of after capture.  Only '
+                             'captured tags are compared, so --incremental '
+                             'does not apply')
+    parser.add_argument('--render-policy',
+                        default=compare.RenderPolicy.ALWAYS,
+                        choices=[compare.RenderPolicy.ALWAYS,
+                                 compare.RenderPolicy.FLAGGED,
+                                 compare.RenderPolicy.DEFERRED],
+                        help='When to render compare matrix images '
+                             '(default: %(default)s)')
+    parser.add_argument('--tag-readiness',
+                        default=webdriver.TagReadiness.FIXED,
+                        choices=[webdriver.TagReadiness.FIXED,
+                                 webdriver.TagReadiness.POLL],
+                        help='How to wait for tags to render before capture '
+                             '(default: %(default)s)')
+    parser.add_argument('--sessions-per-config', type=int, default=None,
+                        help='Max browser sessions to capture each config with '
+                             '(default: 1 for remote runs, --max-sessions '
+                             'spread over the configs for local runs)')
+    parser.add_argument('--max-sessions', type=int, default=None,
+                        help='Max concurrent browser sessions over all '
+                             'configs (default: {} for remote runs, the '
+                             'number of cores for local runs)'.format(
+                                 capture.CaptureManager.MAX_REMOTE_JOBS))
+    parser.add_argument('--browser-backend',
+                        default=webdriver.WebDriverType.REMOTE,
+                        choices=[webdriver.WebDriverType.REMOTE,
+                                 webdriver.WebDriverType.LOCAL],
+                        help='Capture on SauceLabs, or with headless '
+                             'browsers on this host or the local grid from '
+                             'settings (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='Max tags to display and screenshot with one '
+                             'page load (default: %(default)s)')
+    parser.add_argument('--max-retries', type=int, default=2,
+                        help='Max retries of a tag capture after a browser '
+                             'error (default: %(default)s)')
+    parser.add_argument('--quarantine-after', type=int, default=2,
+                        help='Skip the rest of a campaign once it failed on '
+                             'this many configs without any captures '
+                             '(default: %(default)s)')
+    parser.add_argument('--no-tag-cache', action='store_true', default=False,
+                        help='Fetch tags from PlaceLocal without caching them')
+    parser.add_argument('--refresh-tags', action='store_true', default=False,
+                        help='Refetch cached tags even if they are not expired')
+    parser.add_argument('--blob-store', action='store_true', default=False,
+                        help='Store captured images by content hash, so '
+                             'identical captures share one file')
     parser.add_argument('-d', '--domain',
                         default=None,
                         help='Domain, i.e. www.placelocal.com')
@@ -89,6 +157,26 @@ def __update_settings_from_args(args):
         settings.DEFAULT.loglevel = logging.DEBUG
 
 
+def __run(args, capture_args):
+    if args.pipeline and not args.capture_only:
+        build = args.resume or output.generate_build_string()
+        pipeline = compare.start_pipeline(
+            build=build, executor=args.compare_executor,
+            use_cache=not args.no_compare_cache, render=args.render_policy)
+        # Compares that were queued still run if capture fails
+        with closing(pipeline):
+            capture.main(build=build, on_captured=pipeline.captured,
+                         **capture_args)
+        return
+
+    jobname = capture.main(build=args.resume, **capture_args)
+    if not args.capture_only:
+        compare.main(build=jobname, executor=args.compare_executor,
+                     use_cache=not args.no_compare_cache,
+                     incremental=args.incremental,
+                     render=args.render_policy)
+
+
 def main():
     args = __parse_params_to_settings()
 
@@ -107,9 +195,24 @@ def main():
         print("Stopping tagcompare on user input")
         exit(0)
 
-    jobname = capture.main()
-    if not args.capture_only:
-        compare.main(build=jobname)
+    # One pool per process, its idle sessions are quit when it's closed
+    session_pool = webdriver.SessionPool()
+    capture_args = dict(readiness=args.tag_readiness,
+                        sessions_per_config=args.sessions_per_config,
+                        max_sessions=args.max_sessions,
+                        use_tag_cache=not args.no_tag_cache,
+                        refresh_tags=args.refresh_tags,
+                        use_blob_store=args.blob_store,
+                        batch_size=args.batch_size,
+                        drivertype=args.browser_backend,
+                        resume=args.resume is not None,
+                        max_retries=args.max_retries,
+                        quarantine_after=args.quarantine_after,
+                        session_pool=session_pool)
+    try:
+        __run(args, capture_args)
+    finally:
+        session_pool.close()
 
 
 if __name__ == '__main__':
@@ -4,9 +4,12 @@
     - Utility methods for getting the right path to outputs
 """
 import os
+import fcntl
 import glob
-from distutils import dir_util
+import json
 import shutil
+import threading
+import time
 
 import enum
 
@@ -16,6 +19,7 @@ import logger
 
 OUTPUT_DIR = settings.OUTPUT_DIR
 DEFAULT_BUILD_NAME = "default"
+CAPTURE_BUILD_PREFIX = "capture_"
 DEFAULT_BUILD_PATH = os.path.join(OUTPUT_DIR, DEFAULT_BUILD_NAME)
 LOGGER = logger.Logger(name=__name__, writefile=False).get()
 
@@ -31,12 +35,20 @@ class ResultParts(enum.IntEnum):
 
 
 _NUM_PARTS = len(ResultParts)
+# Plain ints, enum member lookups are slow in the PathBuilder hot paths
+_BUILD = int(ResultParts.BUILD)
+_CID = int(ResultParts.CID)
+_TAGSIZE = int(ResultParts.TAGSIZE)
+_TAGTYPE = int(ResultParts.TAGTYPE)
+_CONFIG = int(ResultParts.CONFIG)
 
 
 class PathBuilder(object):
-    """Class to store & build paths/partial paths to outputs of tagcompare
+    """Immutable record of the parts of a path to outputs of tagcompare
+    Use clone() to get a PathBuilder with different parts.  Derived paths are
+    computed once per object, so they are cheap to use in loops.
     """
-    # TODO: Consider making this class immutable
+    __slots__ = ("_parts", "_basepath", "_paths")
 
     def __init__(self, parts, basepath=OUTPUT_DIR):
         if not basepath:
@@ -46,127 +58,135 @@ class PathBuilder(object):
         if len(parts) != _NUM_PARTS:
             raise ValueError("array doesn't have %s parts!" % _NUM_PARTS)
 
-        self._parts = parts
-        self.basepath = basepath
+        self._parts = tuple([str(p) if p else p for p in parts])
+        self._basepath = basepath
+        self._paths = {}
 
-    def __set_property_value(self, value, partindex):
-        if value:
-            value = str(value)
-        self._parts[partindex] = value
+    @classmethod
+    def _make(cls, parts, basepath):
+        """Makes a PathBuilder from parts that are already validated"""
+        pathbuilder = object.__new__(cls)
+        pathbuilder._parts = parts
+        pathbuilder._basepath = basepath
+        pathbuilder._paths = {}
+        return pathbuilder
+
+    def __reduce__(self):
+        return PathBuilder, (self._parts, self._basepath)
 
     """
     Properties
     """
 
+    @property
+    def basepath(self):
+        return self._basepath
+
     @property
     def build(self):
-        """
-        Read-only property - can only be set on init or internally
-        :return:
-        """
-        return self._parts[ResultParts.BUILD]
+        return self._parts[_BUILD]
 
     @property
     def cid(self):
-        return self._parts[ResultParts.CID]
-
-    @cid.setter
-    def cid(self, value):
-        self.__set_property_value(value, partindex=ResultParts.CID)
+        return self._parts[_CID]
 
     @property
     def tagsize(self):
-        return self._parts[ResultParts.TAGSIZE]
-
-    @tagsize.setter
-    def tagsize(self, value):
-        self.__set_property_value(value, partindex=ResultParts.TAGSIZE)
+        return self._parts[_TAGSIZE]
 
     @property
     def tagtype(self):
-        return self._parts[ResultParts.TAGTYPE]
-
-    @tagtype.setter
-    def tagtype(self, value):
-        self.__set_property_value(value, partindex=ResultParts.TAGTYPE)
+        return self._parts[_TAGTYPE]
 
     @property
     def config(self):
-        return self._parts[ResultParts.CONFIG]
+        return self._parts[_CONFIG]
 
-    @config.setter
-    def config(self, value):
-        self.__set_property_value(value, partindex=ResultParts.CONFIG)
+    @property
+    def parts(self):
+        """
+        The parts, i.e. for pickling
+        :return: a tuple of the parts indexed by ResultParts
+        """
+        return self._parts
 
     @property
     def path(self):
         """Gets the output path for a given config, cid and tagsize
         Returns partial paths if optional parameters aren't provided
         """
-        return self._getpath(allow_partial=True)
+        paths = self._paths
+        if "path" not in paths:
+            paths["path"] = self._getpath(allow_partial=True)
+        return paths["path"]
 
     @property
     def tagname(self):
-        result = str.format("{}-{}-{}",
-                            self.cid, self.tagsize, self.tagtype)
-        return result
+        paths = self._paths
+        if "tagname" not in paths:
+            paths["tagname"] = "{}-{}-{}".format(
+                self.cid, self.tagsize, self.tagtype)
+        return paths["tagname"]
 
     @property
     def _tagpath(self):
         """Gets the tag path (i.e. without the config name)
         """
-        #
-        tagparts = self._parts[:]
-        tagparts[ResultParts.CONFIG] = None
-        return self._getpath(count=_NUM_PARTS - 1,
-                             allow_partial=False)
+        paths = self._paths
+        if "tagpath" not in paths:
+            paths["tagpath"] = self._getpath(count=_NUM_PARTS - 1,
+                                             allow_partial=False)
+        return paths["tagpath"]
 
     @property
     def tagimage(self):
-        imagename = "{}-{}.png".format(self.config, self.tagname)
-        result = os.path.join(self._getpath(allow_partial=False),
-                              imagename)
-        return result
+        paths = self._paths
+        if "tagimage" not in paths:
+            imagename = "{}-{}.png".format(self.config, self.tagname)
+            paths["tagimage"] = os.path.join(
+                self._getpath(allow_partial=False), imagename)
+        return paths["tagimage"]
 
     @property
     def taghtml(self):
-        result = os.path.join(self._tagpath,
-                              self.tagname + ".html")
-        return result
+        paths = self._paths
+        if "taghtml" not in paths:
+            paths["taghtml"] = os.path.join(self._tagpath,
+                                            self.tagname + ".html")
+        return paths["taghtml"]
 
     @property
     def buildpath(self):
-        result = os.path.join(self.basepath, str(self.build))
-        return result
+        return os.path.join(self.basepath, str(self.build))
 
     @property
     def cidpath(self):
-        result = os.path.join(self.buildpath, str(self.cid))
-        return result
+        return os.path.join(self.buildpath, str(self.cid))
 
     """
     Functions
     """
 
     def _getpath(self, count=_NUM_PARTS, allow_partial=False):
-        result = self.basepath
-        for i in range(0, count):
-            p = self._parts[i]
-            if not p:
-                if not allow_partial:
-                    raise ValueError("part {} is not set!".format(i))
-                return result
-            p = str(p)
-            result = os.path.join(result, p)
-
-        LOGGER.debug("_getpath result: %s", result)
-        return result
+        parts = self._parts[:count]
+        if None in parts or "" in parts:
+            if not allow_partial:
+                raise ValueError("part {} is not set!".format(
+                    [bool(p) for p in parts].index(False)))
+            parts = parts[:[bool(p) for p in parts].index(False)]
+        return os.path.join(self._basepath, *parts)
 
     def __eq__(self, other):
         if not isinstance(other, PathBuilder):
             return False
         return self.path == other.path
 
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.path)
+
     def __str__(self):
         return str("{}-{}".format(
             self.build, self.tagname)) \
@@ -176,19 +196,13 @@ class PathBuilder(object):
               cid=None, tagsize=None, tagtype=None, basepath=None):
         """Clones the object with default values from self.  Can override specifics
         """
-        original_parts = self._parts
-        new_parts = create(
-            build=build, config=config, cid=cid, tagsize=tagsize,
-            tagtype=tagtype)._parts
-        result_parts = original_parts[:]
-
-        if not basepath:
-            basepath = self.basepath
-        for i in range(0, _NUM_PARTS):
-            p = new_parts[i]
-            if p:
-                result_parts[i] = p
-        return PathBuilder(parts=result_parts, basepath=basepath)
+        old = self._parts
+        parts = (str(build) if build else old[_BUILD],
+                 str(cid) if cid else old[_CID],
+                 str(tagsize) if tagsize else old[_TAGSIZE],
+                 str(tagtype) if tagtype else old[_TAGTYPE],
+                 str(config) if config else old[_CONFIG])
+        return PathBuilder._make(parts, basepath or self._basepath)
 
     def pathexists(self):
         return os.path.exists(self.path)
@@ -219,11 +233,11 @@ Factory methods
 def create(build, config=None, cid=None, tagsize=None, tagtype=None,
            basepath=OUTPUT_DIR):
     parts = [None] * _NUM_PARTS
-    parts[ResultParts.BUILD] = build
-    parts[ResultParts.CID] = cid
-    parts[ResultParts.TAGSIZE] = tagsize
-    parts[ResultParts.TAGTYPE] = tagtype
-    parts[ResultParts.CONFIG] = config
+    parts[_BUILD] = build
+    parts[_CID] = cid
+    parts[_TAGSIZE] = tagsize
+    parts[_TAGTYPE] = tagtype
+    parts[_CONFIG] = config
     return PathBuilder(parts=parts, basepath=basepath)
 
 
@@ -264,6 +278,25 @@ def get_all_paths(buildname, basedir=OUTPUT_DIR):
     return child_dirs
 
 
+def get_tags(buildname, basedir=OUTPUT_DIR, since=None):
+    """
+    Gets the tags that have captures in a build
+    :param since: optional timestamp, only get tags with a tag image modified
+        after it
+    :return: a set of (cid, tagsize, tagtype) tuples
+    """
+    tags = set()
+    for dirpath in get_all_paths(buildname, basedir=basedir):
+        pb = create_from_path(dirpath, basepath=basedir)
+        if since is not None:
+            tagimage = pb.tagimage
+            if not os.path.exists(tagimage) or \
+                    os.path.getmtime(tagimage) <= since:
+                continue
+        tags.add((pb.cid, pb.tagsize, pb.tagtype))
+    return tags
+
+
 """
 Static helper methods:
 """
@@ -295,15 +328,132 @@ def _split_pathstr(pathstr, count):
     return allparts
 
 
-def aggregate(outputdir=OUTPUT_DIR, buildname=DEFAULT_BUILD_NAME):
+class AggregateMode(object):
+    """How captures are materialised in the aggregate build.  Files are
+    copied when the mode isn't supported, i.e. across filesystems
     """
-    Aggregates the captures from various campaigns to the 'default'
-    :return:
+    # Hardlinks, aggregating is metadata only
+    HARDLINK = "HARDLINK"
+    # Copy-on-write clones, i.e. on btrfs or xfs
+    REFLINK = "REFLINK"
+    SYMLINK = "SYMLINK"
+    COPY = "COPY"
+
+
+class AggregateManifest(object):
+    """Index of the latest capture of every tag and config, kept in the
+    aggregate directory.  Builds are indexed once, and captures are recorded
+    as they are written, so aggregation only touches what changed.
+    """
+    FILENAME = ".manifest.json"
+
+    def __init__(self, aggregate_path):
+        self.filepath = os.path.join(aggregate_path, AggregateManifest.FILENAME)
+        self._lock = threading.Lock()
+        self._data = self._load()
+
+    def _load(self):
+        data = {"builds": {}, "tags": {}}
+        if os.path.exists(self.filepath):
+            try:
+                with open(self.filepath, 'r') as f:
+                    data.update(json.load(f))
+            except ValueError:
+                LOGGER.warn("Invalid aggregate manifest at %s, reindexing",
+                            self.filepath)
+        return data
+
+    @staticmethod
+    def _tagkey(pathbuilder):
+        return "/".join(str(p) for p in pathbuilder.parts[_CID:])
+
+    def is_indexed(self, buildname):
+        return buildname in self._data["builds"]
+
+    def set_indexed(self, buildname):
+        with self._lock:
+            self._data["builds"][buildname] = time.time()
+
+    def record(self, pathbuilder, timestamp=None):
+        """
+        Records a capture if it's the latest one for its tag and config
+        :param pathbuilder: pathbuilder for the capture, including config
+        :param timestamp: when it was captured, the mtime of the tag image if
+            not set.  Set it for captures that can share their file with
+            older ones, i.e. from the blob store.
+        :return: True if it's the latest capture
+        """
+        tagimage = pathbuilder.tagimage
+        if not os.path.exists(tagimage):
+            return False
+        if timestamp is None:
+            timestamp = os.path.getmtime(tagimage)
+        entry = {"build": pathbuilder.build, "mtime": timestamp}
+        key = AggregateManifest._tagkey(pathbuilder)
+        with self._lock:
+            latest = self._data["tags"].get(key)
+            if latest and (latest["mtime"], latest["build"]) >= \
+                    (entry["mtime"], entry["build"]):
+                return False
+            self._data["tags"][key] = entry
+        return True
+
+    def resolve(self, pathbuilder):
+        """
+        :return: the pathbuilder of the latest capture for a tag and config,
+            None if there is none
+        """
+        entry = self._data["tags"].get(AggregateManifest._tagkey(pathbuilder))
+        if not entry:
+            return None
+        return pathbuilder.clone(build=entry["build"])
+
+    def index_build(self, buildname, basedir=OUTPUT_DIR):
+        """
+        Records all the captures of a build
+        :return: list of pathbuilders for the captures that are the latest
+        """
+        latest = []
+        for dirpath in get_all_paths(buildname, basedir=basedir):
+            pb = create_from_path(dirpath, basepath=basedir)
+            if self.record(pb):
+                latest.append(pb)
+        self.set_indexed(buildname)
+        return latest
+
+    def save(self):
+        """Saves the manifest, merged with changes saved by other runs"""
+        with self._lock:
+            saved = self._load()
+            saved["builds"].update(self._data["builds"])
+            for key, entry in self._data["tags"].items():
+                other = saved["tags"].get(key)
+                if not other or (entry["mtime"], entry["build"]) > \
+                        (other["mtime"], other["build"]):
+                    saved["tags"][key] = entry
+            self._data = saved
+            dirpath = os.path.dirname(self.filepath)
+            if not os.path.exists(dirpath):
+                os.makedirs(dirpath)
+            tmppath = self.filepath + ".tmp"
+            with open(tmppath, 'w') as f:
+                json.dump(self._data, f)
+            os.rename(tmppath, self.filepath)
+
+
+def aggregate(outputdir=OUTPUT_DIR, buildname=DEFAULT_BUILD_NAME,
+              manifest=None, mode=AggregateMode.HARDLINK):
+    """
+    Aggregates the captures from various campaigns to the 'default'.
+    Only builds that aren't in the AggregateManifest yet are scanned, and
+    only the captures that are newer than the aggregated ones are copied.
+    :param manifest: optional AggregateManifest for the aggregate directory
+    :param mode: the AggregateMode for materialising the captures
+    :return: the aggregate path
     """
     if not os.path.exists(outputdir):
         raise ValueError("outputdir does not exist at %s!" % outputdir)
 
-    # Aggregate all the capture job data
     outputdir = str(outputdir).rstrip('/')
     buildpaths = glob.glob(outputdir + '/*/')
     aggregate_path = os.path.join(outputdir, buildname)
@@ -311,23 +461,109 @@ def aggregate(outputdir=OUTPUT_DIR, buildname=DEFAULT_BUILD_NAME):
     if not os.path.exists(aggregate_path):
         LOGGER.debug("Creating path for aggregates at %s", aggregate_path)
         os.makedirs(aggregate_path)
+    if not manifest:
+        manifest = AggregateManifest(aggregate_path)
 
     LOGGER.info("Aggregating build data to %s", aggregate_path)
-    # Workaround bug with dir_util
-    # See http://stackoverflow.com/questions/9160227/
-    dir_util._path_created = {}
+    latest = []
     for buildpath in buildpaths:
-        if str(buildpath).endswith(DEFAULT_BUILD_NAME + "/"):
-            # Don't do this for the default build
-            LOGGER.debug("Skipping default path: %s", buildpath)
+        build = os.path.basename(buildpath.rstrip('/'))
+        if build in (DEFAULT_BUILD_NAME, buildname) or \
+                manifest.is_indexed(build):
             continue
+        LOGGER.debug("Indexing build %s", build)
+        latest += manifest.index_build(build, basedir=outputdir)
+
+    for pb in latest:
+        _aggregate_files(pb, pb.clone(build=buildname), mode=mode,
+                         replace=True)
+    manifest.save()
+    LOGGER.info("Aggregated %s new captures", len(latest))
+    return aggregate_path
 
-        sourcepath = os.path.join(outputdir, buildpath)
-        LOGGER.debug("Copying from %s to %s", buildpath,
-                     aggregate_path)
 
-        dir_util.copy_tree(sourcepath, aggregate_path, update=1)
-    return aggregate_path
+def aggregate_tag(pathbuilder, buildname=DEFAULT_BUILD_NAME, manifest=None,
+                  mode=AggregateMode.HARDLINK, timestamp=None):
+    """
+    Aggregates the captures of a single tag and config to the 'default',
+    so it can be compared without aggregating the whole output
+    :param pathbuilder: pathbuilder for the captured tag, including config
+    :param manifest: optional AggregateManifest to record the capture in,
+        it's only aggregated if it's the latest one
+    :param timestamp: when it was captured, see AggregateManifest.record
+    :return: the pathbuilder for the aggregated tag
+    """
+    aggregate_pb = pathbuilder.clone(build=buildname)
+    if not os.path.exists(pathbuilder.path):
+        return aggregate_pb
+    if manifest and not manifest.record(pathbuilder, timestamp=timestamp):
+        return aggregate_pb
+    # Once the manifest picked the capture, the files are replaced
+    # regardless of their mtimes
+    _aggregate_files(pathbuilder, aggregate_pb, mode=mode,
+                     replace=manifest is not None)
+    return aggregate_pb
+
+
+def _aggregate_files(pathbuilder, aggregate_pb, mode=AggregateMode.HARDLINK,
+                     replace=False):
+    if mode not in _LINKERS:
+        raise ValueError('Unsupported `mode`!  see AggregateMode')
+    sourcepath = pathbuilder.path
+    aggregate_pb.create()
+    for filename in os.listdir(sourcepath):
+        _copy_if_newer(os.path.join(sourcepath, filename),
+                       os.path.join(aggregate_pb.path, filename), mode=mode,
+                       replace=replace)
+    if os.path.exists(pathbuilder.taghtml):
+        _copy_if_newer(pathbuilder.taghtml, aggregate_pb.taghtml, mode=mode,
+                       replace=replace)
+
+
+def _copy_if_newer(src, dst, mode=AggregateMode.HARDLINK, replace=False):
+    """
+    :param replace: replace dst even if it's newer than src, unless they
+        are the same file
+    """
+    if os.path.exists(dst):
+        if os.path.samefile(src, dst):
+            return False
+        if not replace and os.path.getmtime(dst) >= os.path.getmtime(src):
+            return False
+    # Link to a temp name and rename so an existing file is replaced
+    # atomically, readers never see a missing or partial file
+    tmppath = "{}.{}.tmp".format(dst, threading.current_thread().ident)
+    try:
+        _LINKERS[mode](src, tmppath)
+    except (OSError, IOError) as e:
+        if mode != AggregateMode.COPY:
+            LOGGER.debug("Could not %s %s, copying instead: %s",
+                         mode, src, e)
+        if os.path.lexists(tmppath):
+            os.remove(tmppath)
+        shutil.copy2(src, tmppath)
+    os.rename(tmppath, dst)
+    return True
+
+
+def _reflink(src, dst):
+    """Clones the file's data blocks, on filesystems that support it"""
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+    shutil.copystat(src, dst)
+
+
+def _symlink(src, dst):
+    os.symlink(os.path.abspath(src), dst)
+
+
+_FICLONE = 0x40049409
+_LINKERS = {
+    AggregateMode.HARDLINK: os.link,
+    AggregateMode.REFLINK: _reflink,
+    AggregateMode.SYMLINK: _symlink,
+    AggregateMode.COPY: shutil.copy2,
+}
 
 
 def generate_build_string(prefix=None):
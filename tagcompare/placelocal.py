@@ -1,21 +1,61 @@
 from multiprocessing.pool import ThreadPool
 import json
+import Queue
+import sys
 from urllib import urlencode
 import time
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 
 import settings
 import logger
+import cache
 
 TIMESTAMP = time.strftime("%Y%m%d-%H%M%S")
 LOGGER = logger.Logger(__name__).get()
 
+# Threads used to fetch tags, the connection pool is sized to match
+NUM_FETCH_THREADS = 10
+# (connect, read) timeouts in seconds
+REQUEST_TIMEOUT = (10, 60)
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+RETRY_STATUSES = (500, 502, 503, 504)
+
+
+def create_session(pool_size=NUM_FETCH_THREADS, retries=MAX_RETRIES,
+                   backoff=RETRY_BACKOFF):
+    """
+    Creates a requests.Session that keeps connections alive and retries
+    connection errors and 5xx responses with exponential backoff
+    :param pool_size: max connections kept open per host
+    :param retries: max retries per request, 0 to disable
+    :param backoff: backoff factor, sleeps backoff * 2^(retry - 1) seconds
+    :return: the session
+    """
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=RETRY_STATUSES,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
 
 class PlaceLocalApi:
     API_PREFIX = "api/v2"
 
-    def __init__(self, domain=None, request_headers=None, validate=True):
+    def __init__(self, domain=None, request_headers=None, validate=True,
+                 timeout=REQUEST_TIMEOUT, retries=MAX_RETRIES,
+                 backoff=RETRY_BACKOFF, tag_cache=None, refresh_tags=False):
+        """
+        :param tag_cache: optional cache.TagCache for campaign tags
+        :param refresh_tags: refetch tags even if they are in tag_cache
+        """
         if not domain:
             domain = settings.DEFAULT.domain
         if not request_headers:
@@ -23,40 +63,83 @@ class PlaceLocalApi:
         self._domain = domain
         self._request_headers = request_headers
         self._validate = validate
+        self._timeout = timeout
+        self._tag_cache = tag_cache
+        self._refresh_tags = refresh_tags
+        self._session = create_session(pool_size=NUM_FETCH_THREADS,
+                                       retries=retries, backoff=backoff)
+
+    def close(self):
+        self._session.close()
+
+    def _url(self, route, prefix=API_PREFIX):
+        return str.format("https://{}/{}/{}", self._domain, prefix, route)
 
     def put(self, route, data=None, prefix=API_PREFIX):
-        url = str.format("https://{}/{}/{}", self._domain,
-                         prefix, route)
-        r = requests.put(url, data=data, headers=self._request_headers)
+        url = self._url(route, prefix)
+        r = self._session.put(url, data=data, headers=self._request_headers,
+                              timeout=self._timeout)
         self.__validate_response(r, url)
         return r
 
     def get(self, route, prefix=API_PREFIX):
-        url = str.format("https://{}/{}/{}", self._domain,
-                         prefix, route)
-        r = requests.get(
-            url, headers=self._request_headers)
+        url = self._url(route, prefix)
+        r = self._session.get(
+            url, headers=self._request_headers, timeout=self._timeout)
         self.__validate_response(r, url)
         return PlaceLocalApi._get_response_data(r)
 
+    def get_cached(self, route, key, prefix=API_PREFIX):
+        """
+        Gets route through the tag cache.  Fresh entries are returned as is,
+        expired ones are revalidated with If-None-Match/If-Modified-Since
+        :param key: the cache key for the route
+        :return: the response data
+        """
+        tag_cache = self._tag_cache
+        entry = None if self._refresh_tags else tag_cache.get(key)
+        if tag_cache.is_fresh(entry):
+            return entry['tags']
+
+        headers = dict(self._request_headers)
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        url = self._url(route, prefix)
+        r = self._session.get(url, headers=headers, timeout=self._timeout)
+        if r.status_code == 304 and entry:
+            LOGGER.debug("Tags not modified for %s", url)
+            return tag_cache.touch(key, entry)['tags']
+
+        self.__validate_response(r, url)
+        data = PlaceLocalApi._get_response_data(r)
+        if data:
+            tag_cache.set(key, data, etag=r.headers.get('ETag'),
+                          last_modified=r.headers.get('Last-Modified'))
+        return data
+
     def get_tags_for_campaigns(self, cids, ispreview=1):
         """
         Gets a set of tags for multiple campaigns:
 
-        :param cids: a list of campaign ids
+        :param cids: campaign ids, can be an iterator like iter_all_cids so
+            tags are fetched while the cids are still being found
         :param ispreview: change to 1 to get preview tags, 0 by default
         :return: a dictionary of tags with the cid as key
         """
         if not cids:
             raise ValueError("cids not defined!")
-        LOGGER.debug(
-            "Get tags for %s campaigns: %s...", len(cids), cids)
 
-        tp = ThreadPool(processes=10)
+        tp = ThreadPool(processes=NUM_FETCH_THREADS)
         results = {}
         for cid in cids:
+            if cid in results:
+                continue
             results[cid] = tp.apply_async(func=self.__get_tags,
                                           args=(cid, ispreview))
+        LOGGER.debug(
+            "Get tags for %s campaigns: %s...", len(results), results.keys())
         all_tags = {}
         for cid in results:
             tags = results[cid].get()
@@ -69,9 +152,12 @@ class PlaceLocalApi:
         return all_tags
 
     def get_cids_from_settings(self, settings_obj=settings.DEFAULT):
+        return list(self.iter_cids_from_settings(settings_obj))
+
+    def iter_cids_from_settings(self, settings_obj=settings.DEFAULT):
         cids = settings_obj.campaigns
         pids = settings_obj.publishers
-        return self.get_all_cids(cids, pids)
+        return self.iter_all_cids(cids, pids)
 
     def submit_campaign(self, cid):
         route = "campaign/{}/submit".format(cid)
@@ -135,7 +221,12 @@ class PlaceLocalApi:
              "animationtime": settings.TAG_ANIMATION_TIME,
              "usetagmacros": 0})
         route += qp
-        data = self.get(route)
+        if self._tag_cache:
+            key = cache.TagCache.make_key(self._domain, cid, ispreview,
+                                          settings.TAG_ANIMATION_TIME)
+            data = self.get_cached(route, key)
+        else:
+            data = self.get(route)
         if not data:
             LOGGER.warning("No tags found for cid %s, tags data: %s", cid,
                            data)
@@ -158,20 +249,25 @@ class PlaceLocalApi:
             pids.append(p['id'])
         return pids
 
+    def _expand_publisher(self, pid):
+        """
+        :return: the publishers of a super publisher, or just pid if it has
+            none
+        """
+        return self._get_pids_from_publisher(pid) or [pid]
+
     def _get_all_pids(self, pids):
         """
         Expand potential super publishers to get publishers from them
         :param pids:
         :return:
         """
-        all_pids = []
-        for pid in pids:
-            newpids = self._get_pids_from_publisher(pid)
-            if not newpids:
-                all_pids.append(pid)
-            else:
-                all_pids += newpids
-        result = list(set(all_pids))  # unique list
+        pool = ThreadPool(processes=NUM_FETCH_THREADS)
+        try:
+            expanded = pool.map(self._expand_publisher, set(pids))
+        finally:
+            pool.terminate()
+        result = list(set(p for newpids in expanded for p in newpids))
         LOGGER.debug("_get_all_pids: %s", result)
         return result
 
@@ -182,16 +278,60 @@ class PlaceLocalApi:
         :param pids: publisher or superpub ids, this is confusing - I know
         :return: a list of campaign ids
         """
+        return list(self.iter_all_cids(cids, pids))
+
+    def iter_all_cids(self, cids=None, pids=None):
+        """
+        Like get_all_cids, but yields unique campaign ids as they are found.
+        Publishers are expanded and their campaigns fetched concurrently.
+        :return: an iterator of campaign ids
+        """
         if cids:
-            return cids
+            return iter(cids)
 
         if not pids:
             raise ValueError("pids must be specified if there are no cids!")
+        return self.__iter_cids_for_pids(pids)
 
-        cids = []
-        all_pids = self._get_all_pids(pids)
-        for pid in all_pids:
-            new_cids = self.__get_active_campaigns(pid)
-            if new_cids:
-                cids += new_cids
-        return cids
+    @staticmethod
+    def __run(results, func, arg):
+        """Runs func(arg) in a pool worker and puts the outcome in results"""
+        try:
+            results.put((func, func(arg), None))
+        except Exception:
+            results.put((func, None, sys.exc_info()))
+
+    def __iter_cids_for_pids(self, pids):
+        results = Queue.Queue()
+        pool = ThreadPool(processes=NUM_FETCH_THREADS)
+        seen_pids = set()
+        seen_cids = set()
+        pending = 0
+        try:
+            for pid in set(pids):
+                pool.apply_async(func=self.__run,
+                                 args=(results, self._expand_publisher, pid))
+                pending += 1
+            while pending:
+                func, found, exc_info = results.get()
+                pending -= 1
+                if exc_info:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if func == self._expand_publisher:
+                    for pid in found:
+                        if pid in seen_pids:
+                            continue
+                        seen_pids.add(pid)
+                        pool.apply_async(
+                            func=self.__run,
+                            args=(results, self.__get_active_campaigns, pid))
+                        pending += 1
+                    continue
+                for cid in found:
+                    if cid not in seen_cids:
+                        seen_cids.add(cid)
+                        yield cid
+        finally:
+            pool.terminate()
+        LOGGER.debug("Found %s campaigns for %s publishers",
+                     len(seen_cids), len(seen_pids))
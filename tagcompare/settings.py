@@ -33,6 +33,7 @@ class Env(object):
     SAUCE_KEY = "SAUCE_KEY"
     PL_SECRET = "PL_SECRET"
     PL_SERVICE_ID = "PL_SERVICE_ID"
+    GRID_URL = "GRID_URL"
 
 # Used by tests to access special conditions
 TEST_MODE = False
@@ -214,6 +215,16 @@ class Settings(object):
             return value
         return self._saucelabs['key']
 
+    def get_local_grid_url(self, env=Env.GRID_URL):
+        """
+        :return: the url of a local Selenium grid, i.e.
+            http://localhost:4444/wd/hub, None to launch browsers directly
+        """
+        value = os.environ.get(env)
+        if value:
+            return value
+        return self._settings.get('local', {}).get('grid_url')
+
     def get_placelocal_headers(self,
                                id_env=Env.PL_SERVICE_ID,
                                secret_env=Env.PL_SECRET):
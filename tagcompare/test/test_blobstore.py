@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from tagcompare import blobstore
+from tagcompare import cache
+
+
+@pytest.fixture
+def blob_store(tmpdir):
+    return blobstore.BlobStore(directory=str(tmpdir.join("blobs")))
+
+
+def test_blobstore_invalid():
+    with pytest.raises(ValueError):
+        blobstore.BlobStore(directory=None)
+
+
+def test_put_dedupes(tmpdir, blob_store):
+    path1 = str(tmpdir.join("build1-chrome.png"))
+    path2 = str(tmpdir.join("build2-firefox.png"))
+    digest = blob_store.put("same pixels", path1)
+    assert blob_store.put("same pixels", path2) == digest
+    assert digest == cache.file_digest(path1)
+    assert os.path.samefile(path1, path2)
+    assert os.path.samefile(path1, blob_store.blobpath(digest))
+
+    # Replacing an output doesn't change the blob or the other outputs
+    other = blob_store.put("other pixels", path2)
+    assert other != digest
+    with open(path1) as f:
+        assert f.read() == "same pixels"
+    with open(path2) as f:
+        assert f.read() == "other pixels"
+    assert not os.path.exists(path2 + ".tmp")
+
+
+def test_put_keeps_blob_mtime(tmpdir, blob_store):
+    path1 = str(tmpdir.join("1.png"))
+    digest = blob_store.put("pixels", path1)
+    os.utime(blob_store.blobpath(digest), (1000, 1000))
+    blob_store.put("pixels", str(tmpdir.join("2.png")))
+    assert os.path.getmtime(path1) == 1000, \
+        "Earlier captures sharing the blob must keep their mtime!"
+
+
+def test_gc(tmpdir, blob_store):
+    path1 = str(tmpdir.join("1.png"))
+    path2 = str(tmpdir.join("2.png"))
+    blob_store.put("pixels", path1)
+    blob_store.put("other pixels", path2)
+    assert blob_store.gc() == 0
+    os.remove(path2)
+    assert blob_store.gc() == 1
+    with open(path1) as f:
+        assert f.read() == "pixels"
+
+
+def test_gc_skips_temp_files(tmpdir, blob_store):
+    blob_store.put("pixels", str(tmpdir.join("1.png")))
+    # A blob that another put is still writing
+    os.makedirs(os.path.join(blob_store.directory, "ab"))
+    tmppath = os.path.join(blob_store.directory, "ab", ".tmpXYZ")
+    with open(tmppath, 'w') as f:
+        f.write("partial")
+    assert blob_store.gc() == 0
+    assert os.path.exists(tmppath)
@@ -0,0 +1,91 @@
+import os
+
+import pytest
+from PIL import Image
+
+from tagcompare import cache
+
+
+@pytest.fixture
+def compare_cache(tmpdir):
+    return cache.CompareCache(directory=str(tmpdir.join("compare")))
+
+
+def test_make_key():
+    assert cache.make_key(1, "a", "b") == cache.make_key(1, "a", "b")
+    assert cache.make_key(1, "a", "b") != cache.make_key(1, "b", "a")
+    assert cache.make_key(1, "ab") != cache.make_key(1, "a", "b")
+    assert cache.make_key(1, "a") != cache.make_key(2, "a")
+
+
+def test_file_digest(tmpdir):
+    f1 = tmpdir.join("f1")
+    f1.write("some content")
+    f2 = tmpdir.join("f2")
+    f2.write("some content")
+    assert cache.file_digest(str(f1)) == cache.file_digest(str(f2))
+    f2.write("other content")
+    assert cache.file_digest(str(f1)) != cache.file_digest(str(f2))
+
+
+def test_score(compare_cache):
+    key = cache.make_key("score")
+    assert compare_cache.get_score(key) is None
+    assert compare_cache.misses == 1
+    compare_cache.set_score(key, 214)
+    assert compare_cache.get_score(key) == 214
+    assert compare_cache.hits == 1
+    assert str(compare_cache)
+
+
+def test_tile(compare_cache):
+    key = cache.make_key("tile")
+    tile = Image.new("RGBA", (10, 10), (1, 2, 3, 4))
+    assert compare_cache.get_tile(key) is None
+    compare_cache.set_tile(key, tile)
+    cached = compare_cache.get_tile(key)
+    assert cached.size == tile.size
+    assert list(cached.getdata()) == list(tile.getdata())
+
+    no_tiles = cache.CompareCache(directory=compare_cache.directory,
+                                  cache_tiles=False)
+    assert no_tiles.get_tile(key) is None, "Tiles should not be cached!"
+
+
+def test_evict(compare_cache):
+    keys = [cache.make_key(i) for i in range(5)]
+    for i, key in enumerate(keys):
+        compare_cache.set_score(key, 100)
+        # Oldest first
+        path = compare_cache._entrypath(key, ".score")
+        os.utime(path, (i, i))
+    assert compare_cache.size() == 15
+    assert compare_cache.evict(max_size=9) == 2
+    assert compare_cache.get_score(keys[0]) is None
+    assert compare_cache.get_score(keys[1]) is None
+    assert compare_cache.get_score(keys[2]) == 100
+    assert compare_cache.evict(max_size=9) == 0
+
+
+def test_invalid_directory():
+    with pytest.raises(ValueError):
+        cache.CompareCache(directory=None)
+
+
+def test_tag_cache(tmpdir):
+    tag_cache = cache.TagCache(directory=str(tmpdir.join("tags")), ttl=60)
+    key = tag_cache.make_key("www.placelocal.com", 1, 1, 1)
+    assert key != tag_cache.make_key("www.placelocal.com", 1, 0, 1)
+    assert tag_cache.get(key) is None
+    assert not tag_cache.is_fresh(None)
+
+    tags = {"http_ad_tags": {"skyscraper": {"iframe": "<iframe></iframe>"}}}
+    tag_cache.set(key, tags, etag='"abc"')
+    entry = tag_cache.get(key)
+    assert entry['tags'] == tags
+    assert entry['etag'] == '"abc"'
+    assert tag_cache.is_fresh(entry)
+
+    entry['fetched'] -= 120
+    assert not tag_cache.is_fresh(entry)
+    assert tag_cache.is_fresh(tag_cache.touch(key, entry))
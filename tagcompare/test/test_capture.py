@@ -1,8 +1,15 @@
 import os
+import threading
+import time
 
 import pytest
+from PIL import Image
 
 from tagcompare import capture
+from tagcompare import image
+from tagcompare import webdriver
+from tagcompare.webdriver import WebDriverType
+from selenium.common.exceptions import WebDriverException
 from tagcompare.capture import TagCapture
 from tagcompare import output
 
@@ -49,6 +56,608 @@ def test_capture_configs():
     assert "http://fonts.googleapis.com" in str(errors[0]['message'])
 
 
+TEST_TAGS = {
+    1: {"skyscraper": {"iframe": "<iframe></iframe>",
+                       "script": "<script></script>"}},
+    2: {"skyscraper": {"iframe": "<iframe></iframe>",
+                       "script": "<script></script>"},
+        "medium_rectangle": {"iframe": "<iframe></iframe>",
+                             "script": "<script></script>"}}
+}
+
+
+def test_get_capture_units():
+    units = capture.get_capture_units(
+        TEST_TAGS, tagsizes=["skyscraper", "medium_rectangle"],
+        tagtypes=["iframe", "script"])
+    assert len(units) == 6
+    assert (1, "medium_rectangle", "iframe") not in units
+    assert (2, "medium_rectangle", "script") in units
+
+
+class MockTagCapture(object):
+    """Records the units captured and the number of concurrent sessions"""
+    lock = threading.Lock()
+    live = 0
+    max_live = 0
+    closed = 0
+    captured = []
+
+    def __init__(self, configname):
+        self.configname = configname
+        with MockTagCapture.lock:
+            MockTagCapture.live += 1
+            MockTagCapture.max_live = max(MockTagCapture.max_live,
+                                          MockTagCapture.live)
+
+    def capture_batch(self, tags, pathbuilder, units, capture_existing=False):
+        time.sleep(0.01)
+        with MockTagCapture.lock:
+            MockTagCapture.captured.extend(
+                (pathbuilder.config,) + unit for unit in units)
+        return [[]] * len(units)
+
+    def close(self):
+        with MockTagCapture.lock:
+            MockTagCapture.live -= 1
+            MockTagCapture.closed += 1
+
+
+def test_capture_sessions_per_config(monkeypatch):
+    monkeypatch.setattr(
+        capture.TagCapture, "from_config",
+        classmethod(lambda cls, configname, buildname, **kwargs:
+                    MockTagCapture(configname)))
+    captured = []
+    cm = capture.CaptureManager(domain="test", sessions_per_config=3,
+                                max_sessions=4, on_captured=captured.append)
+    monkeypatch.setattr(cm.placelocal_api, "get_tags_for_campaigns",
+                        lambda cids: TEST_TAGS)
+    configs = ["chrome", "firefox", "safari"]
+    pb = output.create(build="capture_test")
+    errors = cm._capture_tags_for_configs(
+        cids=[1, 2], pathbuilder=pb, configs=configs,
+        tagsizes=["skyscraper", "medium_rectangle"],
+        tagtypes=["iframe", "script"])
+
+    assert errors == []
+    assert len(MockTagCapture.captured) == 6 * len(configs)
+    assert len(set(MockTagCapture.captured)) == 6 * len(configs)
+    assert MockTagCapture.live == 0
+    assert sorted((p.config, int(p.cid), p.tagsize, p.tagtype)
+                  for p in captured) == sorted(MockTagCapture.captured)
+    assert MockTagCapture.max_live <= 4
+
+
+class MockSession(object):
+    def __init__(self, configname, opened):
+        self.configname = configname
+        opened.append(configname)
+
+    def close(self):
+        pass
+
+
+def test_capture_scheduler_longest_backlog():
+    opened = []
+    scheduler = capture.CaptureScheduler(
+        open_session=lambda c: MockSession(c, opened),
+        sessions_per_config=1, max_sessions=1)
+    scheduler.add("chrome", range(2))
+    scheduler.add("ie11", range(5))
+    scheduler.add("safari", range(3))
+    assert scheduler.queue_depth() == 10
+    assert scheduler.queue_depth("ie11") == 5
+
+    captured = []
+    scheduler.run(lambda session, c, units: captured.extend(
+        (c, unit) for unit in units))
+    assert opened == ["ie11", "safari", "chrome"]
+    assert len(captured) == 10
+    assert scheduler.dispatched == 10
+    assert scheduler.queue_depth() == 0
+
+
+def test_capture_scheduler_shares_queue():
+    lock = threading.Lock()
+    per_session = {}
+
+    def capture_units(session, configname, units):
+        time.sleep(0.05 if configname == "slow" else 0.001)
+        with lock:
+            per_session[id(session)] = per_session.get(id(session), 0) + 1
+        return ["error"] * len(units)
+
+    scheduler = capture.CaptureScheduler(
+        open_session=lambda c: MockSession(c, []),
+        sessions_per_config=3, max_sessions=4)
+    scheduler.add("slow", range(12))
+    scheduler.add("fast", range(12))
+    errors = scheduler.run(capture_units)
+    assert len(errors) == 24
+    assert sum(per_session.values()) == 24
+    # Sessions of the slow config took turns on its queue
+    assert len(per_session) >= 4
+
+
+def test_capture_scheduler_session_failure():
+    def open_session(configname):
+        if configname == "broken":
+            raise Exception("Could not start session")
+        return MockSession(configname, [])
+
+    scheduler = capture.CaptureScheduler(open_session=open_session,
+                                         sessions_per_config=2,
+                                         max_sessions=2)
+    scheduler.add("broken", range(4))
+    scheduler.add("chrome", range(3))
+    captured = []
+    scheduler.run(lambda session, c, units: captured.extend(
+        (c, unit) for unit in units))
+    assert [c for c, _ in captured] == ["chrome"] * 3
+    assert scheduler.queue_depth() == 0
+
+
+def test_capture_scheduler_second_session_failure():
+    opened = []
+
+    def open_session(configname):
+        opened.append(configname)
+        if len(opened) > 1:
+            raise Exception("Could not start session")
+        return MockSession(configname, [])
+
+    def capture_units(session, configname, units):
+        # Keeps the first session busy while the second one fails
+        time.sleep(0.05)
+        captured.extend(units)
+
+    captured = []
+    scheduler = capture.CaptureScheduler(open_session=open_session,
+                                         sessions_per_config=2,
+                                         max_sessions=2)
+    scheduler.add("chrome", range(4))
+    scheduler.run(capture_units)
+    assert len(opened) <= 2, "A failed open should not be retried!"
+    assert sorted(captured) == range(4)
+
+
+def test_capture_scheduler_batches():
+    batches = []
+    scheduler = capture.CaptureScheduler(
+        open_session=lambda c: MockSession(c, []),
+        sessions_per_config=1, max_sessions=1, batch_size=4)
+    scheduler.add("chrome", range(10))
+    scheduler.run(lambda session, c, units: batches.append(units))
+    assert batches == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    assert scheduler.dispatched == 10
+
+
+class MockBatchDriver(object):
+    """Lays out tags side by side in a 100x50 window"""
+
+    def __init__(self):
+        self.num_pages = 0
+        self.num_screenshots = 0
+        self.num_slots = 0
+
+    def get(self, url):
+        self.num_pages += 1
+
+    def execute_script(self, script):
+        return True
+
+    def get_log(self, logname):
+        return []
+
+    def find_elements_by_class_name(self, name):
+        return [MockSlot(i) for i in xrange(self.num_slots)]
+
+    def get_screenshot_as_png(self):
+        self.num_screenshots += 1
+        return image.encode_png(Image.new('RGB', (100, 50), (255, 0, 0)))
+
+
+class MockSlot(object):
+    def __init__(self, i):
+        self.i = i
+
+    def find_element_by_tag_name(self, tagtype):
+        # Slots are 30px wide, from the fourth on they are cut off
+        element = MockSlot(self.i)
+        element.location = {'x': self.i * 30, 'y': 0}
+        element.size = {'width': 25, 'height': 20}
+        return element
+
+
+def test_capture_batch(tmpdir, monkeypatch):
+    driver = MockBatchDriver()
+    tc = TagCapture("chrome", driver, wait_for_load=False, batch_size=4)
+    captured_one = []
+    monkeypatch.setattr(
+        tc, "capture_unit",
+        lambda tags, pb, unit, capture_existing=False:
+        captured_one.append(unit) or [])
+    pb = output.create(build="capture_test", config="chrome",
+                       basepath=str(tmpdir))
+    units = capture.get_capture_units(
+        TEST_TAGS, tagsizes=["skyscraper", "medium_rectangle"],
+        tagtypes=["iframe", "script"])
+    driver.num_slots = len(units)
+    results = tc.capture_batch(TEST_TAGS, pb, units)
+
+    assert driver.num_pages == 1
+    assert driver.num_screenshots == 1
+    assert results == [[]] * len(units)
+    # The tags outside of the screenshot are captured on their own
+    assert captured_one == units[3:]
+    for unit in units[:3]:
+        cid, tagsize, tagtype = unit
+        p = pb.clone(cid=cid, tagsize=tagsize, tagtype=tagtype)
+        assert os.path.exists(p.tagimage)
+        assert os.path.exists(p.taghtml)
+
+
+class MockFailingDriver(MockBatchDriver):
+    """Fails every page load after the first max_pages"""
+
+    def __init__(self, drivertype, capabilities=None, max_pages=0):
+        MockBatchDriver.__init__(self)
+        self.max_pages = max_pages
+        self.quit_called = False
+
+    def get(self, url):
+        MockBatchDriver.get(self, url)
+        if self.num_pages > self.max_pages:
+            raise WebDriverException("session is gone")
+
+    @property
+    def current_url(self):
+        if self.num_pages > self.max_pages:
+            raise WebDriverException("session is gone")
+        return "about:blank"
+
+    def find_element_by_tag_name(self, tagtype):
+        return MockSlot(0).find_element_by_tag_name(tagtype)
+
+    def quit(self):
+        self.quit_called = True
+
+
+def test_capture_unit_recycles_session(tmpdir):
+    drivers = []
+
+    def setup(drivertype, capabilities=None):
+        drivers.append(MockFailingDriver(drivertype, capabilities,
+                                         max_pages=1))
+        return drivers[-1]
+
+    pool = webdriver.SessionPool(setup=setup)
+    driver = MockFailingDriver(WebDriverType.PHANTOM_JS)
+    tc = TagCapture("phantomjs", driver, wait_for_load=False,
+                    drivertype=WebDriverType.PHANTOM_JS, session_pool=pool,
+                    retry_policy=capture.RetryPolicy(backoff=0))
+    pb = output.create(build="capture_test", config="phantomjs",
+                       basepath=str(tmpdir))
+    unit = (1, "skyscraper", "iframe")
+    assert tc.capture_unit(TEST_TAGS, pb, unit) == []
+    assert len(drivers) == 1, "The failed session should be replaced!"
+    assert driver.quit_called
+
+    # The replacement fails too, without another session the unit fails
+    def setup_fails(drivertype, capabilities=None):
+        raise WebDriverException("no sessions left")
+
+    drivers[0].max_pages = 0
+    tc._session_pool = webdriver.SessionPool(setup=setup_fails)
+    assert tc.capture_unit(TEST_TAGS, pb, unit) is False
+
+    tc = TagCapture("phantomjs", MockFailingDriver(None), wait_for_load=False,
+                    retry_policy=capture.RetryPolicy(backoff=0))
+    assert tc.capture_unit(TEST_TAGS, pb, unit) is False, \
+        "Sessions can't be replaced without a drivertype!"
+
+
+def test_retry_policy_backoff():
+    sleeps = []
+    policy = capture.RetryPolicy(backoff=1, max_backoff=3,
+                                 sleep=sleeps.append)
+    for retry in xrange(3):
+        policy.wait(retry)
+    assert sleeps == [1, 2, 3]
+    assert policy.summary()['retries'] == 3
+
+    with pytest.raises(ValueError):
+        capture.RetryPolicy(max_retries=-1)
+    with pytest.raises(ValueError):
+        capture.RetryPolicy(recycle_after=0)
+    with pytest.raises(ValueError):
+        capture.RetryPolicy(quarantine_after=0)
+
+
+def test_retry_policy_quarantine():
+    policy = capture.RetryPolicy(quarantine_after=2)
+    policy.record(1, "chrome", captured=False)
+    policy.record(1, "chrome", captured=False)
+    assert not policy.is_quarantined(1), "Only chrome failed!"
+    policy.record(1, "firefox", captured=False)
+    assert policy.is_quarantined(1)
+    assert policy.is_quarantined("1")
+
+    # Campaigns that were captured anywhere are not quarantined
+    policy.record(2, "chrome", captured=True)
+    policy.record(2, "firefox", captured=False)
+    policy.record(2, "safari", captured=False)
+    assert not policy.is_quarantined(2)
+    assert policy.summary() == {'retries': 0, 'recycled': 0, 'failed': 5,
+                                'quarantined': ["1"], 'skipped': 2}
+
+
+class MockFlakyDriver(MockBatchDriver):
+    """Fails the first num_failures page loads, but keeps responding"""
+
+    def __init__(self, num_failures=0):
+        MockBatchDriver.__init__(self)
+        self.num_failures = num_failures
+        self.current_url = "about:blank"
+
+    def get(self, url):
+        MockBatchDriver.get(self, url)
+        if self.num_pages <= self.num_failures:
+            raise WebDriverException("flaky grid")
+
+    def find_element_by_tag_name(self, tagtype):
+        return MockSlot(0).find_element_by_tag_name(tagtype)
+
+    def quit(self):
+        pass
+
+
+def test_capture_unit_retries(tmpdir):
+    pool = webdriver.SessionPool(
+        setup=lambda drivertype, capabilities=None: MockFlakyDriver())
+    policy = capture.RetryPolicy(max_retries=2, backoff=0, recycle_after=2)
+    pb = output.create(build="capture_test", config="phantomjs",
+                       basepath=str(tmpdir))
+    unit = (1, "skyscraper", "iframe")
+
+    def capture_unit(num_failures):
+        tc = TagCapture("phantomjs", MockFlakyDriver(num_failures),
+                        wait_for_load=False,
+                        drivertype=WebDriverType.PHANTOM_JS,
+                        session_pool=pool, retry_policy=policy)
+        return tc.capture_unit(TEST_TAGS, pb, unit, capture_existing=True)
+
+    assert capture_unit(1) == []
+    assert pool.created == 0, "A session that responds is kept!"
+    assert capture_unit(2) == []
+    assert pool.created == 1, "The session is replaced after 2 failures!"
+    summary = policy.summary()
+    assert summary['retries'] == 3
+    assert summary['recycled'] == 1
+    assert summary['failed'] == 0
+
+
+def test_capture_batch_records_captures(tmpdir):
+    policy = capture.RetryPolicy(max_retries=0, backoff=0)
+    units = capture.get_capture_units(
+        TEST_TAGS, tagsizes=["skyscraper", "medium_rectangle"],
+        tagtypes=["iframe", "script"])
+    for configname in ["chrome", "firefox"]:
+        driver = MockBatchDriver()
+        driver.num_slots = len(units)
+        tc = TagCapture(configname, driver, wait_for_load=False,
+                        batch_size=len(units), retry_policy=policy)
+        # The units below the fold fail on their own
+        tc.capture_unit = lambda tags, pb, unit, capture_existing=False: \
+            policy.record(unit[0], pb.config, captured=False) or False
+        pb = output.create(build="capture_test", config=configname,
+                           basepath=str(tmpdir))
+        results = tc.capture_batch(TEST_TAGS, pb, units)
+        assert results[:3] == [[]] * 3
+        assert results[3:] == [False] * 3
+    assert units[3][0] == 2
+    assert not policy.is_quarantined(2), \
+        "Campaigns captured in a batch must not be quarantined!"
+
+
+def test_capture_journal(tmpdir):
+    pb = output.create(build="capture_test", config="chrome", cid=1,
+                       tagsize="skyscraper", tagtype="iframe",
+                       basepath=str(tmpdir))
+    journal = capture.CaptureJournal(pb.buildpath)
+    assert not journal.is_done(pb)
+    pb.create()
+    with open(pb.tagimage, 'wb') as f:
+        f.write(image.encode_png(Image.new('RGB', (10, 10))))
+    digest = journal.record(pb)
+    assert digest
+    assert journal.is_done(pb)
+
+    # A run that died in the middle of a line and of an image
+    with open(journal.filepath, 'a') as f:
+        f.write('{"unit": ["chrome", "2", "sky')
+    other_pb = pb.clone(cid=2)
+    other_pb.create()
+    with open(other_pb.tagimage, 'wb') as f:
+        f.write(image.encode_png(Image.new('RGB', (10, 10)))[:20])
+    assert journal.record(other_pb) is None, "Image is incomplete!"
+
+    resumed = capture.CaptureJournal(pb.buildpath, resume=True)
+    assert len(resumed) == 1
+    assert resumed.is_done(pb)
+    assert not resumed.is_done(other_pb)
+
+    with open(pb.tagimage, 'wb') as f:
+        f.write(image.encode_png(Image.new('RGB', (10, 10), (255, 0, 0))))
+    assert not resumed.is_done(pb), "Image changed since it was journaled!"
+
+    assert len(capture.CaptureJournal(pb.buildpath)) == 0, \
+        "The journal should start over unless resumed!"
+
+
+def test_capture_batch_resume(tmpdir):
+    pb = output.create(build="capture_test", config="chrome",
+                       basepath=str(tmpdir))
+    units = capture.get_capture_units(
+        TEST_TAGS, tagsizes=["skyscraper", "medium_rectangle"],
+        tagtypes=["iframe"])
+    journal = capture.CaptureJournal(pb.buildpath)
+    driver = MockBatchDriver()
+    driver.num_slots = len(units)
+    tc = TagCapture("chrome", driver, wait_for_load=False, batch_size=4,
+                    journal=journal)
+    assert tc.capture_batch(TEST_TAGS, pb, units,
+                            capture_existing=True) == [[]] * len(units)
+    assert len(journal) == len(units)
+
+    # Truncate one of the images, only that one is captured again
+    cid, tagsize, tagtype = units[1]
+    partial_pb = pb.clone(cid=cid, tagsize=tagsize, tagtype=tagtype)
+    with open(partial_pb.tagimage, 'rb') as f:
+        data = f.read()
+    with open(partial_pb.tagimage, 'wb') as f:
+        f.write(data[:len(data) // 2])
+
+    journal = capture.CaptureJournal(pb.buildpath, resume=True)
+    driver = MockBatchDriver()
+    driver.num_slots = 1
+    tc = TagCapture("chrome", driver, wait_for_load=False, batch_size=4,
+                    journal=journal)
+    captured_one = []
+    tc.capture_unit = lambda tags, pb, unit, capture_existing=False: \
+        captured_one.append(unit) or []
+    results = tc.capture_batch(TEST_TAGS, pb, units, capture_existing=True)
+    assert results == [None, [], None]
+    assert captured_one == [units[1]]
+
+
+def test_capture_resume_invalid(tmpdir, monkeypatch):
+    create = output.create
+    monkeypatch.setattr(output, "create", lambda build, **kwargs: create(
+        build, basepath=str(tmpdir), **kwargs))
+    cm = capture.CaptureManager(domain="test")
+    with pytest.raises(ValueError) as e:
+        cm.capture(resume=True)
+    assert "build must be defined" in str(e.value)
+    with pytest.raises(ValueError) as e:
+        cm.capture(build="missing", resume=True)
+    assert "No capture to resume" in str(e.value)
+    assert str(tmpdir) in str(e.value)
+
+
+class MockPooledDriver(object):
+    live = []
+    max_live = 0
+
+    def __init__(self, drivertype, capabilities=None):
+        self.current_url = "about:blank"
+        self.scripts = []
+        MockPooledDriver.live.append(self)
+        MockPooledDriver.max_live = max(MockPooledDriver.max_live,
+                                        len(MockPooledDriver.live))
+
+    def execute_script(self, script):
+        self.scripts.append(script)
+
+    def quit(self):
+        MockPooledDriver.live.remove(self)
+
+
+def test_capture_manager_reuses_sessions(monkeypatch):
+    monkeypatch.setattr(
+        capture.TagCapture, "capture_batch",
+        lambda self, tags, pb, units, capture_existing=False:
+        [[]] * len(units))
+    monkeypatch.setattr(MockPooledDriver, "live", [])
+    monkeypatch.setattr(MockPooledDriver, "max_live", 0)
+    pool = webdriver.SessionPool(setup=MockPooledDriver)
+
+    def run(build, configs, max_sessions):
+        cm = capture.CaptureManager(domain="test", session_pool=pool,
+                                    max_sessions=max_sessions)
+        monkeypatch.setattr(cm.placelocal_api, "get_tags_for_campaigns",
+                            lambda cids: TEST_TAGS)
+        cm._capture_tags_for_configs(
+            cids=[1, 2], pathbuilder=output.create(build=build),
+            configs=configs, tagsizes=["skyscraper"], tagtypes=["iframe"])
+
+    run("build1", ["chrome"], 1)
+    run("build2", ["chrome"], 1)
+    assert pool.created == 1
+    assert pool.reused == 1, \
+        "The second run should reuse the session of the first!"
+
+    # Idle sessions of finished configs count against max_sessions
+    run("build3", ["firefox", "ie11"], 1)
+    assert MockPooledDriver.max_live == 1
+    pool.close()
+    assert not MockPooledDriver.live
+
+
+def test_check_local_configs():
+    all_configs = {
+        "phantomjs": {"enabled": True},
+        "chrome": {"enabled": True, "capabilities": {"browserName": "chrome"}},
+        "firefox": {"enabled": True,
+                    "capabilities": {"browserName": "firefox",
+                                     "version": "42.0"}},
+        "ie11": {"enabled": True,
+                 "capabilities": {"browserName": "internet explorer"}}
+    }
+    capture.check_local_configs(["phantomjs", "chrome", "firefox"],
+                                all_configs=all_configs)
+    with pytest.raises(ValueError) as e:
+        capture.check_local_configs(["chrome", "ie11"],
+                                    all_configs=all_configs)
+    assert "ie11" in str(e.value)
+
+
+def test_save_replaces_linked_file(tmpdir):
+    blob = str(tmpdir.join("blob.png"))
+    Image.new("RGB", (10, 10), (255, 0, 0)).save(blob, format="PNG")
+    output_path = str(tmpdir.join("tag.png"))
+    os.link(blob, output_path)
+
+    tc = TagCapture("chrome", None)
+    assert tc._save(Image.new("RGB", (10, 10), (0, 0, 255)),
+                    output_path) is None
+    assert Image.open(output_path).getpixel((0, 0)) == (0, 0, 255)
+    assert Image.open(blob).getpixel((0, 0)) == (255, 0, 0), \
+        "Captures must not be written into a shared blob!"
+
+
+def test_capture_invalid_batch_size():
+    with pytest.raises(ValueError):
+        TagCapture("chrome", None, batch_size=0)
+    with pytest.raises(ValueError):
+        capture.CaptureManager(domain="test", batch_size=0)
+
+
+def test_capture_manager_invalid_sessions():
+    with pytest.raises(ValueError):
+        capture.CaptureManager(domain="test", sessions_per_config=0)
+    with pytest.raises(ValueError):
+        capture.CaptureManager(domain="test", max_sessions=0)
+    with pytest.raises(ValueError):
+        capture.CaptureManager(domain="test",
+                               drivertype=WebDriverType.PHANTOM_JS)
+
+
+def test_capture_manager_sessions_per_config():
+    configs = ["chrome", "firefox"]
+    cm = capture.CaptureManager(domain="test")
+    assert cm._get_sessions_per_config(configs) == 1
+    cm = capture.CaptureManager(domain="test", max_sessions=16,
+                                drivertype=WebDriverType.LOCAL)
+    assert cm._get_sessions_per_config(configs) == 8
+    assert cm._get_sessions_per_config(configs + ["safari"]) == 6
+    cm = capture.CaptureManager(domain="test", max_sessions=16,
+                                sessions_per_config=2,
+                                drivertype=WebDriverType.LOCAL)
+    assert cm._get_sessions_per_config(configs) == 2
+
+
 def test_capture_tag():
     tc = tagcapture_phantom()
     tag_htmls = {
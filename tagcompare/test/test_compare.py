@@ -1,5 +1,11 @@
+import os
+import pickle
+import shutil
+
 import pytest
 from tagcompare import compare
+from tagcompare import cache
+from tagcompare import index
 
 from tagcompare import output
 from tagcompare import settings
@@ -28,6 +34,300 @@ def test_compare():
     pb.rmbuild()
 
 
+@pytest.mark.integration
+def test_compare_executors():
+    testpath = settings.Test.TEST_ASSETS_DIR
+    cids = [477944]
+    results = []
+    for executor in [compare.CompareExecutor.SERIAL,
+                     compare.CompareExecutor.THREADS,
+                     compare.CompareExecutor.PROCESSES]:
+        pb = output.create(build="testexecutor", basepath=testpath)
+        result = compare.compare(pb=pb, cids=cids, comparison="latest",
+                                 executor=executor, processes=2)
+        pb.rmbuild()
+        results.append(result)
+    for result in results:
+        assert result.total == results[0].total, "Totals should match!"
+        assert result.result == results[0].result, "Results should match!"
+
+
+@pytest.mark.integration
+def test_compare_matrix_cached(tmpdir):
+    testpath = settings.Test.TEST_ASSETS_DIR
+    pb = output.create(basepath=testpath, build="testcache", cid=477944,
+                       tagsize="medium_rectangle", tagtype="iframe")
+    configs = ["chrome", "firefox", "ie11"]
+    expected = compare._get_compare_matrix(pb, configs)
+
+    compare_cache = cache.CompareCache(directory=str(tmpdir))
+    for i in range(2):
+        result = compare._get_compare_matrix(pb, configs,
+                                             compare_cache=compare_cache)
+        assert list(result.getdata()) == list(expected.getdata()), \
+            "Cached matrix should match the uncached one!"
+    assert compare_cache.misses == 6
+    assert compare_cache.hits == 6
+
+    diff = compare._compare_configs_internal(pb, configs,
+                                             compare_cache=compare_cache)
+    cached_diff = compare._compare_configs_internal(pb, configs,
+                                                    compare_cache=compare_cache)
+    assert diff == cached_diff
+    assert diff == compare._compare_configs_internal(pb, configs)
+
+
+def test_compare_tags_filter():
+    testpath = settings.Test.TEST_ASSETS_DIR
+    pb = output.create(build="testtags", basepath=testpath)
+    result = compare.compare(pb=pb, cids=[477944], comparison="latest",
+                             executor=compare.CompareExecutor.SERIAL,
+                             tags=set())
+    assert result.total == 0, "No tags should have been compared!"
+    assert not pb.pathexists()
+
+
+def test_compare_manifest(tmpdir):
+    basepath = str(tmpdir)
+    manifest = compare.CompareManifest(basepath)
+    assert manifest.last_run("latest") is None
+    assert compare.get_changed_tags(basepath, "latest",
+                                    manifest=manifest) is None, \
+        "Everything should be compared without a previous run!"
+
+    manifest.set_last_run("latest", 1000)
+    manifest.save()
+    manifest = compare.CompareManifest(basepath)
+    assert manifest.last_run("latest") == 1000
+    assert manifest.last_run("chrome_beta") is None
+
+    pb = output.create(build=output.DEFAULT_BUILD_NAME, cid=1, tagsize="s",
+                       tagtype="t", config="chrome", basepath=basepath)
+    pb.create()
+    open(pb.tagimage, 'w').close()
+    os.utime(pb.tagimage, (500, 500))
+    assert compare.get_changed_tags(basepath, "latest") == set()
+    os.utime(pb.tagimage, (1500, 1500))
+    assert compare.get_changed_tags(basepath, "latest") == {("1", "s", "t")}
+
+    capture_pb = pb.clone(build="capture_test", cid=2)
+    capture_pb.create()
+    changed = compare.get_changed_tags(basepath, "latest",
+                                       capture_build="capture_test")
+    assert changed == {("1", "s", "t"), ("2", "s", "t")}
+
+
+def test_compare_output_index(tmpdir):
+    basepath = str(tmpdir)
+    output_index = index.OutputIndex(dbpath=str(tmpdir.join("index.sqlite")))
+    manifest = compare.CompareManifest(basepath)
+    manifest.set_last_run("latest", 1000)
+
+    pb = output.create(build="capture_test", cid=1, tagsize="s", tagtype="t",
+                       config="chrome", basepath=basepath)
+    output_index.add_capture(pb, timestamp=500)
+    output_index.add_capture(pb.clone(build=output.DEFAULT_BUILD_NAME,
+                                      cid=2), timestamp=1500)
+    output_index.add_capture(pb.clone(build="capture_old", cid=3),
+                             timestamp=500)
+    changed = compare.get_changed_tags(basepath, "latest",
+                                       capture_build="capture_test",
+                                       manifest=manifest,
+                                       output_index=output_index)
+    assert changed == {("1", "s", "t"), ("2", "s", "t")}
+
+    testpath = settings.Test.TEST_ASSETS_DIR
+    compare_pb = output.create(build="testindex", basepath=testpath)
+    result = compare.compare(pb=compare_pb, cids=[477944],
+                             sizes=["medium_rectangle"],
+                             executor=compare.CompareExecutor.SERIAL,
+                             render=compare.RenderPolicy.DEFERRED,
+                             output_index=output_index)
+    assert result.total == 1
+    rows = output_index.get_compares(build="testindex")
+    assert len(rows) == 1
+    assert rows[0]["tagsize"] == "medium_rectangle"
+    assert not rows[0]["rendered"]
+
+
+def test_create_pool_invalid():
+    with pytest.raises(ValueError):
+        compare._create_pool(executor="badexecutor")
+    assert compare._create_pool(compare.CompareExecutor.SERIAL) is None
+
+
+def test_run_compare_jobs_terminates_pool():
+    class FakePool(object):
+        def __init__(self):
+            self.calls = []
+
+        def imap_unordered(self, func, jobs):
+            for _ in jobs:
+                raise ValueError("worker failed")
+                yield
+
+        def terminate(self):
+            self.calls.append("terminate")
+
+        def close(self):
+            self.calls.append("close")
+
+        def join(self):
+            self.calls.append("join")
+
+    pool = FakePool()
+    with pytest.raises(ValueError):
+        compare._run_compare_jobs([{}], pool, compare.CompareResult())
+    assert pool.calls == ["terminate", "join"]
+
+    pool.imap_unordered = lambda func, jobs: iter([])
+    pool.calls = []
+    compare._run_compare_jobs([], pool, compare.CompareResult())
+    assert pool.calls == ["close", "join"]
+
+
+def test_compare_job_roundtrip():
+    pb = output.create(build="jobbuild", cid=1, tagsize="s", tagtype="t",
+                       basepath="jobbase")
+    job = compare._make_compare_job(pb, ["chrome", "firefox"], "latest")
+    job = pickle.loads(pickle.dumps(job))
+    assert output.PathBuilder(parts=list(job["parts"]),
+                              basepath=job["basepath"]) == pb
+    assert job["configs"] == ("chrome", "firefox")
+    assert job["comparison"] == "latest"
+    assert job["cache_args"] is None
+    assert job["render"] == compare.RenderPolicy.ALWAYS
+
+    compare_cache = cache.CompareCache(directory="jobcache", max_size=10)
+    job = compare._make_compare_job(pb, ["chrome"], "latest", compare_cache,
+                                    render=compare.RenderPolicy.DEFERRED)
+    job = pickle.loads(pickle.dumps(job))
+    assert cache.CompareCache(*job["cache_args"]).args == compare_cache.args
+    assert job["render"] == compare.RenderPolicy.DEFERRED
+
+
+def test_get_error_level():
+    levels = settings.ImageErrorLevel
+    assert compare._get_error_level(0) == levels.NONE
+    assert compare._get_error_level(100) == levels.NONE
+    assert compare._get_error_level(101) == levels.SLIGHT
+    assert compare._get_error_level(251) == levels.MODERATE
+    assert compare._get_error_level(9999) == levels.SEVERE
+
+
+def test_should_render():
+    levels = settings.ImageErrorLevel
+    policy = compare.RenderPolicy
+    assert compare._should_render(levels.NONE, policy.ALWAYS)
+    assert not compare._should_render(levels.INVALID, policy.ALWAYS)
+    assert not compare._should_render(levels.NONE, policy.FLAGGED)
+    assert compare._should_render(levels.SLIGHT, policy.FLAGGED)
+    assert compare._should_render(levels.SEVERE, policy.FLAGGED)
+    assert not compare._should_render(levels.SEVERE, policy.DEFERRED)
+    with pytest.raises(ValueError):
+        compare._should_render(levels.NONE, "badpolicy")
+
+
+@pytest.mark.integration
+def test_render_deferred(tmpdir):
+    testpath = settings.Test.TEST_ASSETS_DIR
+    pb = output.create(build="testdeferred", basepath=testpath)
+    manifest = compare.CompareManifest(str(tmpdir))
+    result = compare.compare(pb=pb, cids=[477944], comparison="latest",
+                             sizes=["medium_rectangle", "leaderboard"],
+                             executor=compare.CompareExecutor.SERIAL,
+                             render=compare.RenderPolicy.DEFERRED,
+                             manifest=manifest)
+    assert result.total == 2
+    assert not pb.pathexists(), "Nothing should have been rendered yet!"
+
+    rows = manifest.get_tags("latest")
+    assert len(rows) == 2
+    row = rows["477944-medium_rectangle-iframe"]
+    assert row["build"] == "testdeferred"
+    assert row["configs"] == ["chrome", "firefox", "ie11", "safari"]
+    assert not row["rendered"]
+
+    try:
+        rendered = compare.render_deferred(comparison="latest",
+                                           basepath=testpath,
+                                           manifest=manifest)
+        assert rendered == 2
+        assert pb.pathexists(), "Deferred tags should have been rendered!"
+        assert compare.render_deferred(comparison="latest", basepath=testpath,
+                                       manifest=manifest) == 0
+    finally:
+        pb.rmbuild()
+
+
+def test_compare_pipeline(tmpdir):
+    testpath = settings.Test.TEST_ASSETS_DIR
+    basepath = str(tmpdir)
+    configs = ["chrome", "firefox"]
+    manifest = compare.CompareManifest(basepath)
+    pipeline = compare.ComparePipeline(
+        "testpipeline", configs=configs, basepath=basepath,
+        executor=compare.CompareExecutor.THREADS, processes=2,
+        render=compare.RenderPolicy.DEFERRED, manifest=manifest)
+
+    for tagsize in ["medium_rectangle", "leaderboard"]:
+        for cfg in configs:
+            source = output.create(build=output.DEFAULT_BUILD_NAME,
+                                   config=cfg, cid=477944, tagsize=tagsize,
+                                   tagtype="iframe", basepath=testpath)
+            pb = source.clone(build="capture_testpipeline", basepath=basepath)
+            shutil.copytree(source.path, pb.path)
+            output.aggregate_tag(pb)
+            pipeline.captured(pb)
+            assert pb.clone(build=output.DEFAULT_BUILD_NAME).pathexists()
+        assert pipeline.num_queued == 1 if tagsize == "medium_rectangle" \
+            else 2
+    # Only one config captured, it still gets compared on close
+    source = output.create(build=output.DEFAULT_BUILD_NAME, config="chrome",
+                           cid=477944, tagsize="halfpage", tagtype="iframe",
+                           basepath=testpath)
+    pipeline.captured(source.clone(build="capture_testpipeline",
+                                   basepath=basepath))
+    assert pipeline.num_queued == 2
+
+    result = pipeline.close()
+    assert result.total == 3
+    assert result.result[settings.ImageErrorLevel.INVALID] == 1
+    assert len(manifest.get_tags("latest")) == 3
+    assert manifest.last_run("latest")
+
+
+def test_compare_pipeline_job_failure(tmpdir, monkeypatch):
+    def run_compare_job(job):
+        tagsize = output.PathBuilder(parts=list(job["parts"])).tagsize
+        if tagsize == "leaderboard":
+            raise ValueError("compare failed")
+        return {"comparison": job["comparison"], "tagname": tagsize}
+
+    monkeypatch.setattr(compare, "_run_compare_job", run_compare_job)
+    monkeypatch.setattr(
+        compare, "_merge_compare_row",
+        lambda row, result, compare_cache, manifest, output_index:
+        manifest.set_tag(row["comparison"], row["tagname"], row))
+    basepath = str(tmpdir)
+    manifest = compare.CompareManifest(basepath)
+    pipeline = compare.ComparePipeline(
+        "testpipeline", configs=["chrome"], basepath=basepath,
+        executor=compare.CompareExecutor.THREADS, processes=2,
+        manifest=manifest)
+    for tagsize in ["medium_rectangle", "leaderboard"]:
+        pipeline.captured(output.create(
+            build="capture_testpipeline", config="chrome", cid=1,
+            tagsize=tagsize, tagtype="iframe", basepath=basepath))
+    with pytest.raises(ValueError):
+        pipeline.close()
+
+    # The rows merged before the failure are saved, without a last run
+    manifest = compare.CompareManifest(basepath)
+    assert list(manifest.get_tags("latest")) == ["medium_rectangle"]
+    assert manifest.last_run("latest") is None
+
+
 @pytest.mark.integration
 def test_compare_configs():
     """
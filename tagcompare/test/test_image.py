@@ -21,3 +21,91 @@ def test_generate_diff_img():
         "There should be a result image in test folder!"
     print "diff image test passed!"
     os.remove(result_img)
+
+
+TAG_ASSETS = os.path.join(os.path.dirname(os.path.realpath(__file__)), "assets",
+                          "default", "477944", "medium_rectangle", "iframe")
+
+
+def __tag_asset(config):
+    return os.path.join(TAG_ASSETS, config,
+                        config + "-477944-medium_rectangle-iframe.png")
+
+
+def test_normalized_distances_matches_reference():
+    img1 = image.normalize_img(__tag_asset("chrome"))
+    img2 = image.normalize_img(__tag_asset("firefox"))
+
+    expected = image._get_normalized_distances_reference(img1, img2)
+    result = image.get_normalized_distances(img1, img2)
+    assert result.mode == "L"
+    assert result.size == img1.size
+    assert list(result.getdata()) == list(expected.getdata()), \
+        "Vectorized distances should match the reference implementation!"
+
+
+def test_imageset():
+    files = {"chrome": __tag_asset("chrome"),
+             "firefox": __tag_asset("firefox"),
+             "missing": __tag_asset("missing")}
+    images = image.ImageSet(files)
+    assert images.exists("chrome")
+    assert not images.exists("missing")
+    assert images.get("chrome") is images.get("chrome"), \
+        "Images should only be decoded once!"
+    assert images.histogram("chrome") is images.histogram("chrome")
+    assert images.size("chrome") == (300, 250)
+    assert images.compare("chrome", "firefox") == \
+        image.compare(files["chrome"], files["firefox"])
+
+
+def test_compare_img_modes():
+    rgba = image.normalize_img(__tag_asset("firefox"))
+    assert rgba.mode == "RGBA"
+    rgb = rgba.convert("RGB")
+    assert image._compare_img(rgba, rgb) == 0, \
+        "Mixed modes should be compared on the same bins!"
+    assert image._compare_img(rgb, rgba) == 0
+
+    modes = [img.mode for img in image._normalize_modes([rgba, rgb])]
+    assert modes == ["RGB", "RGB"]
+    modes = [img.mode for img in image._normalize_modes([rgba, rgba])]
+    assert modes == ["RGBA", "RGBA"]
+    palette = rgb.convert("P")
+    modes = [img.mode for img in image._normalize_modes([palette, palette])]
+    assert modes == ["RGB", "RGB"]
+
+
+def test_compare_histograms_matches_reference():
+    img1 = image.normalize_img(__tag_asset("chrome"))
+    img2 = image.normalize_img(__tag_asset("firefox"))
+    h1 = img1.histogram()
+    h2 = img2.histogram()
+    expected = image._compare_histograms_reference(h1, h2)
+    assert image._compare_histograms(h1, h2) == expected
+    assert image._compare_img(img1, img2) == expected
+    assert image._compare_histograms(h2, h1) is False
+
+
+def test_encode_png(tmpdir):
+    img = image.normalize_img(__tag_asset("chrome"))
+    filepath = str(tmpdir.join("saved.png"))
+    image.save(img, filepath)
+    with open(filepath, 'rb') as f:
+        assert image.encode_png(img) == f.read()
+
+
+def test_is_complete_png(tmpdir):
+    filepath = str(tmpdir.join("saved.png"))
+    image.save(image.normalize_img(__tag_asset("chrome")), filepath)
+    assert image.is_complete_png(filepath)
+
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    with open(filepath, 'wb') as f:
+        f.write(data[:len(data) // 2])
+    assert not image.is_complete_png(filepath), "png was cut off!"
+    with open(filepath, 'wb') as f:
+        f.write(data[:4])
+    assert not image.is_complete_png(filepath)
+    assert not image.is_complete_png(str(tmpdir.join("missing.png")))
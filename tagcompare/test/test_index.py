@@ -0,0 +1,73 @@
+import pytest
+
+from tagcompare import index
+from tagcompare import output
+from tagcompare import cache
+from tagcompare import settings
+
+
+@pytest.fixture
+def output_index(tmpdir):
+    return index.OutputIndex(dbpath=str(tmpdir.join("index.sqlite")))
+
+
+def __capture(basepath, build, cid, config, content="png"):
+    pb = output.create(build=build, config=config, cid=cid,
+                       tagsize="skyscraper", tagtype="iframe",
+                       basepath=basepath)
+    pb.create()
+    with open(pb.tagimage, 'w') as f:
+        f.write(content)
+    return pb
+
+
+def test_index_invalid():
+    with pytest.raises(ValueError):
+        index.OutputIndex(dbpath=None)
+
+
+def test_captures(tmpdir, output_index):
+    basepath = str(tmpdir)
+    pb = __capture(basepath, "build1", 1, "chrome")
+    output_index.add_capture(pb, timestamp=1000)
+    output_index.add_capture(__capture(basepath, "build1", 1, "firefox"),
+                             timestamp=1000)
+    output_index.add_capture(__capture(basepath, "build2", 2, "chrome"),
+                             timestamp=2000)
+
+    rows = output_index.get_captures(build="build1", config="chrome")
+    assert len(rows) == 1
+    assert rows[0]["cid"] == "1"
+    assert rows[0]["path"] == pb.tagimage
+    assert rows[0]["hash"] == cache.file_digest(pb.tagimage)
+    assert len(output_index.get_captures(cid=1)) == 2
+
+    assert output_index.get_tags(build="build1") == {
+        ("1", "skyscraper", "iframe")}
+    assert output_index.get_tags(since=1500) == {("2", "skyscraper", "iframe")}
+    assert len(output_index.get_tags()) == 2
+
+    # Captures are replaced, i.e. when re-capturing a build
+    output_index.add_capture(pb, timestamp=3000)
+    assert len(output_index.get_captures(build="build1")) == 2
+    assert output_index.get_tags(since=2500) == {("1", "skyscraper", "iframe")}
+
+
+def test_compares(output_index):
+    row = {"build": "compare_build1", "comparison": "latest", "cid": "1",
+           "tagsize": "skyscraper", "tagtype": "iframe",
+           "configs": ["chrome", "firefox"], "diff": 3,
+           "level": int(settings.ImageErrorLevel.SLIGHT), "rendered": False}
+    output_index.add_compare(row)
+    output_index.add_compare(dict(row, cid="2", diff=0,
+                                  level=int(settings.ImageErrorLevel.NONE)))
+
+    rows = output_index.get_compares(comparison="latest")
+    assert len(rows) == 2
+    flagged = output_index.get_compares(
+        min_level=settings.ImageErrorLevel.SLIGHT)
+    assert len(flagged) == 1
+    assert flagged[0]["cid"] == "1"
+    assert flagged[0]["score"] == 3
+    assert flagged[0]["configs"] == "chrome,firefox"
+    assert not output_index.get_compares(build="compare_build2")
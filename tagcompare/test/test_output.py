@@ -1,5 +1,7 @@
 import os
+import pickle
 import shutil
+import time
 
 import pytest
 
@@ -81,27 +83,81 @@ def test_get_all_paths():
     assert paths, "Could not get paths from get_all_paths!"
 
 
+def test_get_tags():
+    assetsdir = settings.Test.TEST_ASSETS_DIR
+    tags = output.get_tags(buildname="default", basedir=assetsdir)
+    assert ("477944", "medium_rectangle", "iframe") in tags
+    assert ("477944", "halfpage", "iframe") in tags
+
+    tags = output.get_tags(buildname="default", basedir=assetsdir,
+                           since=time.time() + 60)
+    assert not tags, "No tags should have been modified in the future!"
+
+
+def test_aggregate_tag(tmpdir):
+    pb = output.create(build="capture_test", config="chrome", cid=1,
+                       tagsize="skyscraper", tagtype="iframe",
+                       basepath=str(tmpdir))
+    aggregate_pb = output.aggregate_tag(pb)
+    assert aggregate_pb.build == output.DEFAULT_BUILD_NAME
+    assert not aggregate_pb.pathexists(), "Nothing was captured!"
+
+    pb.create()
+    with open(pb.tagimage, 'w') as f:
+        f.write("png")
+    with open(pb.taghtml, 'w') as f:
+        f.write("html")
+    aggregate_pb = output.aggregate_tag(pb)
+    with open(aggregate_pb.tagimage) as f:
+        assert f.read() == "png"
+    assert os.path.exists(aggregate_pb.taghtml)
+    other_pb = aggregate_pb.clone(config="firefox")
+    assert not other_pb.pathexists()
+
+
 def test_pathbuilder_path():
     pathbuilder = __get_pathbuilder()
     __assert_correct_path(pathbuilder)
 
     # Test we will get the right path after changing params
-    pathbuilder.tagsize = "testsize1"
+    pathbuilder = pathbuilder.clone(tagsize="testsize1")
     __validate_pathbuilder_params(pathbuilder, tagsize="testsize1")
     __assert_correct_path(pathbuilder)
     # Check that using a int instead of str for cid is OK
-    pathbuilder.cid = 999999
+    pathbuilder = pathbuilder.clone(cid=999999)
     __validate_pathbuilder_params(pathbuilder, cid="999999")
     __assert_correct_path(pathbuilder)
-    pathbuilder.config = "testconfig"
+    pathbuilder = pathbuilder.clone(config="testconfig")
     __validate_pathbuilder_params(pathbuilder, config="testconfig")
     __assert_correct_path(pathbuilder)
-    pathbuilder.tagtype = "testtype1"
+    pathbuilder = pathbuilder.clone(tagtype="testtype1")
     __validate_pathbuilder_params(pathbuilder, tagtype="testtype1")
     __assert_correct_path(pathbuilder)
 
+
+def test_pathbuilder_immutable():
+    pathbuilder = __get_pathbuilder()
+    for attr in ["build", "cid", "tagsize", "tagtype", "config", "basepath"]:
+        with pytest.raises(AttributeError):
+            setattr(pathbuilder, attr, "testvalue")
     with pytest.raises(AttributeError):
-        pathbuilder.build = "testbuild1"
+        pathbuilder.newattr = "testvalue"
+
+    # Derived paths are computed once
+    assert pathbuilder.tagimage is pathbuilder.tagimage
+    assert pathbuilder.path is pathbuilder.path
+    clone = pathbuilder.clone(config="otherconfig")
+    assert clone.tagimage != pathbuilder.tagimage
+    assert clone.taghtml == pathbuilder.taghtml
+    assert {pathbuilder: 1}[pathbuilder.clone()] == 1
+
+
+def test_pathbuilder_pickle():
+    pathbuilder = __get_pathbuilder()
+    for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+        copy = pickle.loads(pickle.dumps(pathbuilder, protocol))
+        assert copy == pathbuilder
+        assert copy.basepath == pathbuilder.basepath
 
 
 def test_aggregate():
@@ -119,6 +175,108 @@ def test_aggregate():
         output.aggregate(outputdir="invalid/path")
 
 
+def __write_capture(basepath, build, content, mtime, config="chrome"):
+    pb = output.create(build=build, config=config, cid=1,
+                       tagsize="skyscraper", tagtype="iframe",
+                       basepath=basepath)
+    pb.create()
+    with open(pb.tagimage, 'w') as f:
+        f.write(content)
+    os.utime(pb.tagimage, (mtime, mtime))
+    return pb
+
+
+def test_aggregate_manifest(tmpdir):
+    basepath = str(tmpdir)
+    now = time.time()
+    old_pb = __write_capture(basepath, "build1", "old", now - 60)
+    new_pb = __write_capture(basepath, "build2", "new", now - 30)
+
+    aggregate_path = output.aggregate(outputdir=basepath)
+    default_pb = old_pb.clone(build=output.DEFAULT_BUILD_NAME)
+    with open(default_pb.tagimage) as f:
+        assert f.read() == "new"
+
+    manifest = output.AggregateManifest(aggregate_path)
+    assert manifest.is_indexed("build1") and manifest.is_indexed("build2")
+    assert manifest.resolve(default_pb).build == "build2"
+    assert manifest.resolve(default_pb.clone(config="firefox")) is None
+
+    # Indexed builds aren't scanned again
+    shutil.rmtree(new_pb.buildpath)
+    output.aggregate(outputdir=basepath, manifest=manifest)
+    assert manifest.resolve(default_pb).build == "build2"
+
+    # Older captures aren't aggregated over newer ones
+    older_pb = __write_capture(basepath, "build3", "older", now - 120)
+    output.aggregate_tag(older_pb, manifest=manifest)
+    with open(default_pb.tagimage) as f:
+        assert f.read() == "new"
+    newest_pb = __write_capture(basepath, "build4", "newest", now)
+    output.aggregate_tag(newest_pb, manifest=manifest)
+    with open(default_pb.tagimage) as f:
+        assert f.read() == "newest"
+    manifest.save()
+    assert output.AggregateManifest(aggregate_path).resolve(
+        default_pb).build == "build4"
+
+
+def test_aggregate_tag_timestamp(tmpdir):
+    basepath = str(tmpdir)
+    now = time.time()
+    pb = __write_capture(basepath, "build1", "capture", now - 60)
+    aggregate_path = output.aggregate(outputdir=basepath)
+    manifest = output.AggregateManifest(aggregate_path)
+
+    # A capture linked to an older file, i.e. a blob from an earlier build
+    blobpath = str(tmpdir.join("blob.png"))
+    with open(blobpath, 'w') as f:
+        f.write("blob")
+    os.utime(blobpath, (now - 600, now - 600))
+    new_pb = pb.clone(build="build2")
+    new_pb.create()
+    os.link(blobpath, new_pb.tagimage)
+    output.aggregate_tag(new_pb, manifest=manifest, timestamp=now)
+    default_pb = pb.clone(build=output.DEFAULT_BUILD_NAME)
+    with open(default_pb.tagimage) as f:
+        assert f.read() == "blob"
+    assert manifest.resolve(default_pb).build == "build2"
+    assert os.path.getmtime(pb.tagimage) == pytest.approx(now - 60)
+
+
+@pytest.mark.parametrize("mode", [output.AggregateMode.HARDLINK,
+                                  output.AggregateMode.REFLINK,
+                                  output.AggregateMode.SYMLINK,
+                                  output.AggregateMode.COPY])
+def test_aggregate_modes(tmpdir, mode):
+    basepath = str(tmpdir)
+    pb = __write_capture(basepath, "build1", "capture", time.time() - 60)
+    aggregate_pb = output.aggregate_tag(pb, mode=mode)
+    with open(aggregate_pb.tagimage) as f:
+        assert f.read() == "capture"
+    is_same_file = os.path.samefile(pb.tagimage, aggregate_pb.tagimage)
+    assert is_same_file == (mode in (output.AggregateMode.HARDLINK,
+                                     output.AggregateMode.SYMLINK))
+    assert os.path.islink(aggregate_pb.tagimage) == \
+        (mode == output.AggregateMode.SYMLINK)
+
+    # Newer captures replace the aggregated file
+    new_pb = __write_capture(basepath, "build2", "new", time.time())
+    output.aggregate_tag(new_pb, mode=mode)
+    with open(aggregate_pb.tagimage) as f:
+        assert f.read() == "new"
+    with open(pb.tagimage) as f:
+        assert f.read() == "capture"
+    assert not [filename for filename in os.listdir(aggregate_pb.path)
+                if filename.endswith(".tmp")]
+
+
+def test_aggregate_mode_invalid(tmpdir):
+    pb = __write_capture(str(tmpdir), "build1", "capture", time.time())
+    with pytest.raises(ValueError):
+        output.aggregate_tag(pb, mode="invalid")
+
+
 def test_parse_path():
     pathbuilder = __get_pathbuilder()
     pathbuilder.create()
@@ -242,8 +400,7 @@ def test_pathbuilder_get_path():
     assert pb.path == pb2.path, "first path part should wins!"
     with pytest.raises(ValueError):
         pb._getpath(allow_partial=False)
-    pb3 = __get_pathbuilder()
-    pb3.tagsize = None
+    pb3 = __get_pathbuilder(tagsize=None)
     __validate_pathbuilder_params(pb3, tagsize=None)
     with pytest.raises(ValueError):
         print(pb3._getpath(allow_partial=False))
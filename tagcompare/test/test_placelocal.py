@@ -4,6 +4,8 @@ import json
 import pytest
 
 from tagcompare import settings
+from tagcompare import cache
+from tagcompare import placelocal
 from tagcompare.placelocal import PlaceLocalApi
 
 
@@ -22,6 +24,114 @@ def test_invalid_requests():
         PlApiInvalid().get('bad/route')
 
 
+class MockResponse(object):
+    def __init__(self, data, status_code=200, headers=None):
+        self.status_code = status_code
+        self.text = json.dumps({"status_code": status_code, "data": data})
+        self.headers = headers or {}
+
+
+def test_session_pool():
+    api = PlaceLocalApi(domain='www.placelocalqa.com', retries=5, backoff=1)
+    adapter = api._session.get_adapter("https://www.placelocalqa.com/api")
+    assert adapter._pool_maxsize == placelocal.NUM_FETCH_THREADS
+    assert adapter.max_retries.total == 5
+    assert adapter.max_retries.backoff_factor == 1
+    assert 503 in adapter.max_retries.status_forcelist
+
+
+def test_get_uses_session(monkeypatch):
+    api = PlaceLocalApi(domain='www.placelocalqa.com', timeout=7)
+    requests_made = []
+
+    def mock_get(url, headers=None, timeout=None):
+        requests_made.append((url, timeout))
+        return MockResponse({"campaigns": []})
+
+    monkeypatch.setattr(api._session, "get", mock_get)
+    assert api.get("campaign/1") == {"campaigns": []}
+    assert requests_made == [
+        ("https://www.placelocalqa.com/api/v2/campaign/1", 7)]
+
+
+PUBLICATIONS = {1: [10, 11], 3: [11, 12]}
+CAMPAIGNS = {10: [100, 101], 11: [101, 102], 12: [], 2: [200]}
+
+
+def mock_api(monkeypatch, fail_pid=None):
+    api = PlaceLocalApi(domain='www.placelocalqa.com')
+
+    def mock_get(route, prefix=None):
+        kind, pid = route.split("/")[:2]
+        pid = int(pid)
+        if pid == fail_pid:
+            raise AssertionError("Invalid response!")
+        if kind == "publisher":
+            return {"publications": [
+                {"id": p} for p in PUBLICATIONS.get(pid, [])]}
+        return {"campaigns": [{"id": c} for c in CAMPAIGNS[pid]]}
+
+    monkeypatch.setattr(api, "get", mock_get)
+    return api
+
+
+def test_iter_all_cids(monkeypatch):
+    api = mock_api(monkeypatch)
+    cids = api.iter_all_cids(pids=[1, 2, 3, 3])
+    assert not isinstance(cids, list)
+    cids = list(cids)
+    assert sorted(cids) == [100, 101, 102, 200]
+    assert sorted(api.get_all_cids(pids=[1, 2, 3])) == sorted(cids)
+    assert sorted(api._get_all_pids([1, 2, 3])) == [2, 10, 11, 12]
+
+
+def test_iter_all_cids_error(monkeypatch):
+    api = mock_api(monkeypatch, fail_pid=11)
+    with pytest.raises(AssertionError):
+        api.get_all_cids(pids=[1, 2])
+
+
+def test_get_tags_for_campaigns_iterator(monkeypatch):
+    api = PlaceLocalApi(domain='www.placelocalqa.com')
+    monkeypatch.setattr(
+        api, "get", lambda route, prefix=None: {"http_ad_tags": route})
+    tags = api.get_tags_for_campaigns(cids=iter([1, 2, 1]))
+    assert sorted(tags.keys()) == [1, 2]
+
+
+def test_tag_cache(monkeypatch, tmpdir):
+    tag_cache = cache.TagCache(directory=str(tmpdir), ttl=60)
+    api = PlaceLocalApi(domain='www.placelocalqa.com', tag_cache=tag_cache)
+    tags = {"http_ad_tags": {"skyscraper": {"iframe": "<iframe></iframe>"}}}
+    requests_made = []
+
+    def mock_get(url, headers=None, timeout=None):
+        requests_made.append(headers)
+        if headers.get('If-None-Match') == '"v1"':
+            return MockResponse(None, status_code=304)
+        return MockResponse(tags, headers={'ETag': '"v1"'})
+
+    monkeypatch.setattr(api._session, "get", mock_get)
+    expected = {1: tags["http_ad_tags"], 2: tags["http_ad_tags"]}
+    assert api.get_tags_for_campaigns(cids=[1, 2]) == expected
+    assert len(requests_made) == 2
+
+    # Fresh entries don't hit the API
+    assert api.get_tags_for_campaigns(cids=[1, 2]) == expected
+    assert len(requests_made) == 2
+
+    # Expired entries are revalidated
+    tag_cache.ttl = 0
+    assert api.get_tags_for_campaigns(cids=[1]) == {1: tags["http_ad_tags"]}
+    assert len(requests_made) == 3
+    assert requests_made[-1]['If-None-Match'] == '"v1"'
+
+    # Forced refresh doesn't send conditional headers
+    api._refresh_tags = True
+    assert api.get_tags_for_campaigns(cids=[1]) == {1: tags["http_ad_tags"]}
+    assert 'If-None-Match' not in requests_made[-1]
+
+
 def __read_json_file(jsonfile):
     with open(jsonfile) as f:
         return json.load(f)
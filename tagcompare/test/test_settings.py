@@ -127,6 +127,15 @@ def test_saucelabs():
         assert key == expected_key, "Did not get sauce key from env!"
 
 
+def test_get_local_grid_url(monkeypatch):
+    new_settings = createSettings()
+    assert new_settings.get_local_grid_url(env=None) is None, \
+        "There should be no local grid by default!"
+    grid_url = "http://localhost:4444/wd/hub"
+    monkeypatch.setenv(settings.Env.GRID_URL, grid_url)
+    assert new_settings.get_local_grid_url() == grid_url
+
+
 def test_get_placelocal_headers():
     headers1 = SETTINGS.get_placelocal_headers(id_env=None, secret_env=None)
     expected_headers = {
@@ -1,6 +1,9 @@
 import os
+import io
+import time
 
 import pytest
+from PIL import Image
 
 from tagcompare import webdriver
 from tagcompare import settings
@@ -12,8 +15,16 @@ class MockWebDriver():
     """Mock WebDriver class for testing
     """
 
-    def __init__(self, throws=False):
+    def __init__(self, throws=False, ready=True, animated=False):
         self.__throws = throws
+        self.__ready = ready
+        self.__animated = animated
+        self.num_screenshots = 0
+
+    def execute_script(self, script):
+        if self.__throws:
+            raise WebDriverException()
+        return self.__ready
 
     def get_log(self, logname):
         if self.__throws:
@@ -21,6 +32,24 @@ class MockWebDriver():
         else:
             return [{'level': 'SEVERE', 'message': 'got some errors!'}]
 
+    def get_screenshot_as_png(self):
+        self.num_screenshots += 1
+        # Animated pages render a different frame every time
+        color = (self.num_screenshots % 256, 0, 0) if self.__animated \
+            else (255, 0, 0)
+        data = io.BytesIO()
+        Image.new('RGB', (200, 100), color).save(data, format='PNG')
+        return data.getvalue()
+
+
+class MockWebElement():
+    """Mock WebElement class for testing
+    """
+
+    def __init__(self, x, y, width, height):
+        self.location = {'x': x, 'y': y}
+        self.size = {'width': width, 'height': height}
+
 
 def test_check_browser_errors():
     good_driver = MockWebDriver()
@@ -31,6 +60,67 @@ def test_check_browser_errors():
     assert not logs, 'There should be no browser logs!'
 
 
+def test_screenshot_element_in_memory(tmpdir):
+    element = MockWebElement(x=10, y=20, width=30, height=40)
+    img = webdriver.screenshot_element(MockWebDriver(), element)
+    assert img.size == (30, 40), "Screenshot should be cropped to the element!"
+    assert not tmpdir.listdir(), "Nothing should have been written!"
+
+    screenshot_path = str(tmpdir.join('element'))
+    img = webdriver.screenshot_element(MockWebDriver(), element,
+                                       output_path=screenshot_path)
+    saved = Image.open(screenshot_path + '.png')
+    assert saved.size == img.size
+    assert saved.getpixel((0, 0)) == (255, 0, 0)
+
+
+def test_screenshot_elements():
+    driver = MockWebDriver()
+    elements = [MockWebElement(x=0, y=0, width=30, height=40),
+                MockWebElement(x=50, y=20, width=100, height=40),
+                MockWebElement(x=150, y=80, width=100, height=40)]
+    images = webdriver.screenshot_elements(driver, elements)
+    assert driver.num_screenshots == 1
+    assert images[0].size == (30, 40)
+    assert images[1].size == (100, 40)
+    assert images[2] is None, "Element outside the screenshot can't be cropped!"
+
+
+def test_make_batch_script():
+    script = webdriver._make_batch_script(["<iframe></iframe>", "<b></b>"])
+    assert script.count(webdriver.BATCH_SLOT_CLASS) == 2
+    assert script.index("iframe") < script.index("<b>")
+
+
+def test_wait_until_static():
+    driver = MockWebDriver()
+    assert webdriver.wait_until_static(driver, timeout=5, poll_interval=0.01)
+    assert driver.num_screenshots == 2, "Should stop after 2 stable frames!"
+
+    # Pages that can't be checked only rely on the frames
+    driver = MockWebDriver(throws=True)
+    assert webdriver.wait_until_static(driver, timeout=5, poll_interval=0.01)
+
+
+def test_wait_until_static_timeout():
+    driver = MockWebDriver(animated=True)
+    assert not webdriver.wait_until_static(driver, timeout=0.1,
+                                           poll_interval=0.01)
+    driver = MockWebDriver(ready=False)
+    assert not webdriver.wait_until_static(driver, timeout=0.1,
+                                           poll_interval=0.01)
+    assert driver.num_screenshots == 0, \
+        "No frames should be checked before the page is ready!"
+
+
+def test_wait_until_static_min_wait():
+    driver = MockWebDriver()
+    start = time.time()
+    assert webdriver.wait_until_static(driver, timeout=5, min_wait=0.2,
+                                       poll_interval=0.01)
+    assert time.time() - start >= 0.2, "Should wait at least min_wait!"
+
+
 def test_setup_webdriver_exceptions():
     with pytest.raises(ValueError):
         webdriver.setup_webdriver(drivertype=None)
@@ -41,6 +131,158 @@ def test_setup_webdriver_exceptions():
                                   capabilities=None)
 
 
+class MockSessionDriver(object):
+    def __init__(self, drivertype, capabilities=None):
+        self.capabilities = capabilities
+        self.healthy = True
+        self.quit_called = False
+        self.scripts = []
+
+    def execute_script(self, script):
+        self.scripts.append(script)
+
+    @property
+    def current_url(self):
+        if not self.healthy:
+            raise WebDriverException("session is gone")
+        return "about:blank"
+
+    def quit(self):
+        self.quit_called = True
+
+
+def test_session_pool_reuse():
+    pool = webdriver.SessionPool(setup=MockSessionDriver)
+    caps = {"browserName": "chrome", "build": "build1", "name": "chrome"}
+    driver = pool.acquire(WebDriverType.REMOTE, caps)
+    pool.release(driver, commands=5)
+    # Sessions of another build can use the same session
+    other_caps = dict(caps, build="build2")
+    assert pool.acquire(WebDriverType.REMOTE, other_caps) is driver
+    assert pool.acquire(WebDriverType.REMOTE, other_caps) is not driver
+    firefox = pool.acquire(WebDriverType.REMOTE, {"browserName": "firefox"})
+    assert firefox is not driver
+    assert pool.created == 3
+    assert pool.reused == 1
+
+    pool.release(driver)
+    pool.release(firefox)
+    pool.close()
+    assert driver.quit_called and firefox.quit_called
+
+
+def test_session_pool_quits_idle_sessions():
+    pool = webdriver.SessionPool(setup=MockSessionDriver)
+    chrome = pool.acquire(WebDriverType.REMOTE, {"browserName": "chrome"})
+    pool.release(chrome)
+    firefox = pool.acquire(WebDriverType.REMOTE, {"browserName": "firefox"})
+    assert chrome.quit_called, "Idle sessions count against the session cap!"
+    assert not firefox.quit_called
+    assert pool.acquire(WebDriverType.REMOTE,
+                        {"browserName": "chrome"}) is not chrome
+
+
+def test_session_pool_relabel():
+    pool = webdriver.SessionPool(setup=MockSessionDriver)
+    caps = {"browserName": "chrome", "build": "build1", "name": "chrome"}
+    driver = pool.acquire(WebDriverType.REMOTE, caps)
+    pool.release(driver)
+    assert pool.acquire(WebDriverType.REMOTE, dict(caps)) is driver
+    assert driver.scripts == [], "Labels did not change!"
+    pool.release(driver)
+    assert pool.acquire(WebDriverType.REMOTE,
+                        dict(caps, build="build2")) is driver
+    assert driver.scripts == ["sauce:job-build=build2"]
+
+
+def test_session_pool_recycle():
+    pool = webdriver.SessionPool(max_commands=10, setup=MockSessionDriver)
+    caps = {"browserName": "chrome"}
+    driver = pool.acquire(WebDriverType.REMOTE, caps)
+    pool.release(driver)
+    driver.healthy = False
+    replacement = pool.acquire(WebDriverType.REMOTE, caps)
+    assert replacement is not driver, "Unhealthy sessions can't be reused!"
+    assert driver.quit_called
+
+    pool.release(replacement, commands=10)
+    assert replacement.quit_called, "Sessions expire after max_commands!"
+    assert pool.acquire(WebDriverType.REMOTE, caps) is not replacement
+
+    pool = webdriver.SessionPool(max_age=0, setup=MockSessionDriver)
+    driver = pool.acquire(WebDriverType.REMOTE, caps)
+    time.sleep(0.01)
+    pool.release(driver)
+    assert driver.quit_called, "Sessions expire after max_age!"
+
+
+class MockLocalDriver(object):
+    def __init__(self, command_executor=None, desired_capabilities=None,
+                 options=None):
+        self.command_executor = command_executor
+        self.desired_capabilities = desired_capabilities
+        self.options = options
+
+    def set_window_size(self, width, height):
+        self.window_size = (width, height)
+
+    def implicitly_wait(self, seconds):
+        pass
+
+
+def test_setup_local_webdriver(monkeypatch):
+    monkeypatch.setattr(webdriver.webdriver, "Chrome", MockLocalDriver)
+    monkeypatch.setattr(webdriver.webdriver, "Firefox", MockLocalDriver)
+    monkeypatch.setattr(webdriver.webdriver, "Remote", MockLocalDriver)
+    monkeypatch.setattr(settings.DEFAULT, "get_local_grid_url",
+                        lambda: None)
+    driver = webdriver.setup_webdriver(
+        WebDriverType.LOCAL, capabilities={"browserName": "chrome",
+                                           "platform": "Windows 7"})
+    assert '--headless' in driver.options.arguments
+    assert driver.command_executor is None
+    assert driver.window_size == (1920, 1080)
+    driver = webdriver.setup_webdriver(
+        WebDriverType.LOCAL, capabilities={"browserName": "firefox"})
+    assert driver.options.headless
+
+    grid_url = "http://localhost:4444/wd/hub"
+    monkeypatch.setattr(settings.DEFAULT, "get_local_grid_url",
+                        lambda: grid_url)
+    driver = webdriver.setup_webdriver(
+        WebDriverType.LOCAL, capabilities={"browserName": "chrome"})
+    assert driver.command_executor == grid_url
+    assert driver.desired_capabilities["browserName"] == "chrome"
+
+    with pytest.raises(ValueError):
+        webdriver.setup_webdriver(WebDriverType.LOCAL,
+                                  capabilities={"browserName": "safari"})
+
+
+class MockRemoteDriver(MockLocalDriver):
+    session_id = "mocksession"
+    current_url = "about:blank"
+
+    def quit(self):
+        pass
+
+
+def test_session_pool_reuse_remote(monkeypatch):
+    monkeypatch.setattr(webdriver.webdriver, "Remote", MockRemoteDriver)
+    monkeypatch.setattr(settings.DEFAULT, "get_saucelabs_user",
+                        lambda: "user")
+    monkeypatch.setattr(settings.DEFAULT, "get_saucelabs_key",
+                        lambda: "key")
+    pool = webdriver.SessionPool()
+    caps = {"browserName": "chrome", "name": "chrome"}
+    driver = pool.acquire(WebDriverType.REMOTE, caps)
+    assert driver.desired_capabilities["public"] == "share"
+    assert "public" not in caps, "Setup must not update shared capabilities!"
+    pool.release(driver)
+    assert pool.acquire(WebDriverType.REMOTE, caps) is driver
+    assert pool.created == 1
+
+
 def test_phantomjs_screenshot_tag():
     testdriver = webdriver.setup_webdriver(
         WebDriverType.PHANTOM_JS, screenshot_on_exception=True)
@@ -1,5 +1,8 @@
 import json
 import time
+import hashlib
+import threading
+import multiprocessing
 
 from selenium.common.exceptions import WebDriverException
 from selenium import webdriver
@@ -28,16 +31,62 @@ class ScreenshotListener(AbstractEventListener):
         LOGGER.error("Exception screenshot saved as '%s'" % screenshot_name)
 
 
+DEFAULT_SESSION_MAX_AGE = 30 * 60
+DEFAULT_SESSION_MAX_COMMANDS = 1000
+# Capabilities that only label a session, sessions that differ in these
+# can be shared and are relabeled when they are reused
+_SESSION_LABEL_CAPS = ('name', 'build')
+# SauceLabs job annotations, see _relabel_session
+_SAUCE_LABEL_SCRIPTS = {'name': "sauce:job-name={}",
+                        'build': "sauce:job-build={}"}
+
+
+# Local headless browsers are sized to the cores of the capture host
+LOCAL_MAX_SESSIONS = max(1, multiprocessing.cpu_count())
+# The browserNames that can run headless on the capture host
+LOCAL_BROWSERS = ('chrome', 'firefox')
+_WINDOW_SIZE = (1920, 1080)
+
+
 class WebDriverType(object):
     PHANTOM_JS = "PHANTOM_JS"
     REMOTE = "REMOTE"
+    # Headless browsers on the capture host, or a local Selenium grid
+    LOCAL = "LOCAL"
+
+
+class TagReadiness(object):
+    """How display_tag decides that a tag is ready for a screenshot"""
+    # Sleep for the animation time plus wait_time
+    FIXED = "FIXED"
+    # Poll until images and fonts are loaded and the frame stops changing,
+    # with the FIXED sleep time as the upper bound
+    POLL = "POLL"
+
+
+# Every tag on a page from display_tags is wrapped in a slot with this class
+BATCH_SLOT_CLASS = "tagcompare-slot"
+_BATCH_SLOT_STYLE = "display:inline-block;vertical-align:top;" \
+    "margin:0 8px 8px 0;"
+
+
+# The tag's iframe is cross-origin, so only the top document can be checked
+_PAGE_READY_SCRIPT = """
+return document.readyState === 'complete' &&
+    Array.prototype.every.call(document.images, function(img) {
+        return img.complete;
+    }) &&
+    (!document.fonts || document.fonts.status === 'loaded');
+"""
 
 
 def setup_webdriver(drivertype, capabilities=None, screenshot_on_exception=False):
-    if drivertype is WebDriverType.PHANTOM_JS:
+    if drivertype == WebDriverType.PHANTOM_JS:
         driver = __setup_phantomjs_webriver(screenshot_on_exception)
-    elif drivertype is WebDriverType.REMOTE:
+    elif drivertype == WebDriverType.REMOTE:
         driver = __setup_remote_webdriver(capabilities=capabilities)
+    elif drivertype == WebDriverType.LOCAL:
+        driver = __setup_local_webdriver(capabilities=capabilities)
     else:
         raise ValueError('Unsupported `drivertype`!  see WebDriverType')
 
@@ -49,7 +98,7 @@ def __setup_phantomjs_webriver(screenshot_on_exception=False):
     driver = webdriver.PhantomJS()
     if screenshot_on_exception:
         driver = EventFiringWebDriver(driver, ScreenshotListener())
-    driver.set_window_size(1920, 1080)
+    driver.set_window_size(*_WINDOW_SIZE)
     return driver
 
 
@@ -57,8 +106,9 @@ def __setup_remote_webdriver(capabilities):
     if not capabilities:
         raise ValueError("capabilities must be defined for remote runs!")
 
-    # Update capabilities
-    capabilities['public'] = 'share'
+    # Copy before updating, the capabilities are shared with settings and
+    # SessionPool keys
+    capabilities = dict(capabilities, public='share')
     user = settings.DEFAULT.get_saucelabs_user()
     key = settings.DEFAULT.get_saucelabs_key()
     remote_webdriver_url = "http://{}:{}@ondemand.saucelabs.com:80/wd/hub".format(
@@ -72,6 +122,197 @@ def __setup_remote_webdriver(capabilities):
     return driver
 
 
+class SessionPool(object):
+    """Keeps browser sessions alive between uses
+    Sessions are keyed by driver type and capabilities.  A released session
+    is handed out again to the next acquire with the same key while it is
+    younger than max_age, has run fewer than max_commands and passes a
+    health check.  Idle sessions count against the concurrency limit of the
+    caller, so they are quit before a session with another key is opened.
+    Create one pool per process and pass it to every capture.
+    """
+
+    def __init__(self, max_age=DEFAULT_SESSION_MAX_AGE,
+                 max_commands=DEFAULT_SESSION_MAX_COMMANDS, setup=None):
+        """
+        :param max_age: max seconds a session is kept alive
+        :param max_commands: max commands a session runs before it's replaced,
+            counted by the callers of release()
+        :param setup: callable(drivertype, capabilities) that starts a
+            session, setup_webdriver by default
+        """
+        self.max_age = max_age
+        self.max_commands = max_commands
+        self._setup = setup or setup_webdriver
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._sessions = {}
+        self.created = 0
+        self.reused = 0
+        self.recycled = 0
+
+    def __str__(self):
+        return "SessionPool (created={}, reused={}, recycled={})".format(
+            self.created, self.reused, self.recycled)
+
+    @staticmethod
+    def make_key(drivertype, capabilities=None):
+        caps = dict(capabilities or {})
+        for label in _SESSION_LABEL_CAPS:
+            caps.pop(label, None)
+        return json.dumps([drivertype, caps], sort_keys=True)
+
+    def acquire(self, drivertype, capabilities=None):
+        """
+        :return: a healthy warm session for the capabilities, or a new one
+        """
+        key = SessionPool.make_key(drivertype, capabilities)
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                driver = idle.pop() if idle else None
+            if driver is None:
+                break
+            if self._is_usable(driver):
+                self._relabel(driver, drivertype, capabilities)
+                with self._lock:
+                    self.reused += 1
+                return driver
+            self.discard(driver)
+
+        # Keeps live sessions within the sessions in use plus this one
+        self._quit_idle(exclude=key)
+        driver = self._setup(drivertype, capabilities=capabilities)
+        with self._lock:
+            self._sessions[driver] = [key, time.time(), 0,
+                                      _get_labels(capabilities)]
+            self.created += 1
+        return driver
+
+    def _relabel(self, driver, drivertype, capabilities):
+        labels = _get_labels(capabilities)
+        with self._lock:
+            session = self._sessions[driver]
+            changed = dict((k, v) for k, v in labels.items()
+                           if session[3].get(k) != v)
+            session[3] = labels
+        if changed and drivertype == WebDriverType.REMOTE:
+            _relabel_session(driver, changed)
+
+    def release(self, driver, commands=0):
+        """
+        Returns a session to the pool, expired sessions are quit
+        :param commands: the number of commands run since it was acquired
+        """
+        with self._lock:
+            session = self._sessions.get(driver)
+            if session:
+                session[2] += commands
+        if not session or self._is_expired(driver):
+            self.discard(driver)
+            return
+        with self._lock:
+            self._idle.setdefault(session[0], []).append(driver)
+
+    def discard(self, driver):
+        """Quits a session, i.e. after a WebDriverException"""
+        with self._lock:
+            if self._sessions.pop(driver, None):
+                self.recycled += 1
+        try:
+            driver.quit()
+        except Exception as e:
+            LOGGER.debug("Could not quit session %s: %s", driver, e)
+
+    def _quit_idle(self, exclude=None):
+        """Quits the idle sessions of every key but exclude"""
+        with self._lock:
+            keys = [k for k in self._idle if k != exclude]
+            drivers = [d for k in keys for d in self._idle.pop(k)]
+        for driver in drivers:
+            self.discard(driver)
+
+    def close(self):
+        """Quits all the idle sessions"""
+        self._quit_idle()
+        LOGGER.debug("Closed %s", self)
+
+    def _is_expired(self, driver):
+        with self._lock:
+            _, created, commands, _ = self._sessions[driver]
+        return time.time() - created > self.max_age or \
+            commands >= self.max_commands
+
+    def _is_usable(self, driver):
+        return not self._is_expired(driver) and is_session_alive(driver)
+
+
+def _get_labels(capabilities):
+    capabilities = capabilities or {}
+    return dict((k, capabilities[k]) for k in _SESSION_LABEL_CAPS
+                if capabilities.get(k) is not None)
+
+
+def _relabel_session(driver, labels):
+    """Updates the job name and build of a reused SauceLabs session, so its
+    job shows up under the current run
+    """
+    for label, value in labels.items():
+        try:
+            driver.execute_script(
+                _SAUCE_LABEL_SCRIPTS[label].format(value))
+        except WebDriverException as e:
+            LOGGER.debug("Could not set %s of session %s: %s",
+                         label, driver, e)
+
+
+def is_session_alive(driver):
+    """
+    Health check for a session with a cheap command
+    :return: False if the session does not respond
+    """
+    try:
+        driver.current_url
+    except WebDriverException as e:
+        LOGGER.debug("Session %s failed its health check: %s", driver, e)
+        return False
+    return True
+
+
+def __setup_local_webdriver(capabilities):
+    """
+    Starts a headless browser for the browserName of capabilities, on the
+    local grid if one is set in settings, on this host otherwise.  The rest
+    of the capabilities, i.e. the platform, only apply to remote runs.
+    """
+    browsername = (capabilities or {}).get('browserName', 'chrome')
+    if browsername == 'chrome':
+        options = webdriver.ChromeOptions()
+        options.add_argument('--headless')
+        options.add_argument('--disable-gpu')
+        options.add_argument('--window-size={},{}'.format(*_WINDOW_SIZE))
+        launch = webdriver.Chrome
+    elif browsername == 'firefox':
+        options = webdriver.FirefoxOptions()
+        options.headless = True
+        launch = webdriver.Firefox
+    else:
+        raise ValueError("Unsupported browserName for local runs: {}, "
+                         "see LOCAL_BROWSERS".format(browsername))
+
+    grid_url = settings.DEFAULT.get_local_grid_url()
+    if grid_url:
+        driver = webdriver.Remote(
+            command_executor=grid_url,
+            desired_capabilities=options.to_capabilities())
+        LOGGER.debug("Starting %s on local grid %s", browsername, grid_url)
+    else:
+        driver = launch(options=options)
+        LOGGER.debug("Starting local headless %s", browsername)
+    driver.set_window_size(*_WINDOW_SIZE)
+    return driver
+
+
 def check_browser_errors(driver):
     """
     Checks browser for errors, returns a list of errors
@@ -103,11 +344,68 @@ def wait_until_element_disappears(driver, locator):
         return
 
 
-def display_tag(driver, tag, wait_for_load=True, wait_time=3):
+def _is_page_ready(driver):
+    try:
+        return bool(driver.execute_script(_PAGE_READY_SCRIPT))
+    except WebDriverException as e:
+        LOGGER.debug("Could not check if page is ready: %s", e)
+        return True
+
+
+def _get_frame_digest(driver):
+    img = image.crop_png_data(driver.get_screenshot_as_png(), cropbox=None)
+    return hashlib.sha1(img.tobytes()).hexdigest()
+
+
+def wait_until_static(driver, timeout, min_wait=0, poll_interval=0.25,
+                      stable_frames=2):
+    """
+    Polls until the page has loaded its images and fonts and the rendered
+    frame stops changing
+    :param timeout: the maximum time to wait in seconds
+    :param min_wait: the minimum time to wait in seconds, i.e. the animation
+        time after which the tag is on its final frame
+    :param stable_frames: number of identical consecutive frames needed
+    :return: True if the page became static, False on timeout
+    """
+    start = time.time()
+    frames = []
+    while True:
+        if _is_page_ready(driver):
+            frames = (frames + [_get_frame_digest(driver)])[-stable_frames:]
+            elapsed = time.time() - start
+            if len(frames) == stable_frames and len(set(frames)) == 1 and \
+                    elapsed >= min_wait:
+                LOGGER.debug("Page static after %.2fs", elapsed)
+                return True
+        if time.time() - start + poll_interval > timeout:
+            LOGGER.debug("Page not static after %ss", timeout)
+            return False
+        time.sleep(poll_interval)
+
+
+def display_tag(driver, tag, wait_for_load=True, wait_time=3,
+                readiness=TagReadiness.FIXED):
     driver.get("about:blank")  # Clear the page first
     script = _make_script(tag)
     driver.execute_script(script)
+    return _wait_for_tags(driver, wait_for_load, wait_time, readiness)
+
+
+def display_tags(driver, tags, wait_for_load=True, wait_time=3,
+                 readiness=TagReadiness.FIXED):
+    """
+    Displays several tags on one page, each in its own slot, so they load
+    and animate together and a single wait covers all of them
+    :param tags: list of tag html, see find_batch_elements for the elements
+    :return: list of browser errors over all the tags
+    """
+    driver.get("about:blank")  # Clear the page first
+    driver.execute_script(_make_batch_script(tags))
+    return _wait_for_tags(driver, wait_for_load, wait_time, readiness)
 
+
+def _wait_for_tags(driver, wait_for_load, wait_time, readiness):
     if wait_for_load:
         # TODO: implementation is specific to PaperG creatives
         # Wait until the load spinner goes away
@@ -116,8 +414,14 @@ def display_tag(driver, tag, wait_for_load=True, wait_time=3):
                                       locator=load_spinner_locator)
 
         # Account for animation time and add some buffer for good measure
-        time.sleep(settings.TAG_ANIMATION_TIME)
-        time.sleep(wait_time)
+        max_wait = settings.TAG_ANIMATION_TIME + wait_time
+        if readiness == TagReadiness.POLL:
+            wait_until_static(driver, timeout=max_wait,
+                              min_wait=settings.TAG_ANIMATION_TIME)
+        elif readiness == TagReadiness.FIXED:
+            time.sleep(max_wait)
+        else:
+            raise ValueError('Unsupported `readiness`!  see TagReadiness')
 
     errors = check_browser_errors(driver)
     return errors
@@ -129,9 +433,31 @@ def _make_script(tag):
     return script
 
 
-def screenshot_element(driver, element, output_path):
-    """Take a screenshot of a specific webelement
+def _make_batch_script(tags):
+    # The margin keeps the crops of neighbouring tags apart
+    slots = ["<div class=\"{}\" style=\"{}\">{}</div>".format(
+        BATCH_SLOT_CLASS, _BATCH_SLOT_STYLE, tag) for tag in tags]
+    script = "document.body.style.margin='0';" \
+        "document.body.innerHTML={};".format(json.dumps("".join(slots)))
+    LOGGER.debug("_make_batch_script: %s", script)
+    return script
+
+
+def find_batch_elements(driver, tagtypes):
+    """
+    Finds the tag elements on a page from display_tags
+    :param tagtypes: the tag type of each slot, in the order of the tags
+    :return: list of webelements in the order of the tags
     """
+    slots = driver.find_elements_by_class_name(BATCH_SLOT_CLASS)
+    if len(slots) != len(tagtypes):
+        raise ValueError("Found {} tag slots, expected {}".format(
+            len(slots), len(tagtypes)))
+    return [slot.find_element_by_tag_name(tagtype)
+            for slot, tagtype in zip(slots, tagtypes)]
+
+
+def _get_cropbox(element):
     size = element.size
     location = element.location
 
@@ -139,16 +465,50 @@ def screenshot_element(driver, element, output_path):
     top = location['y']
     right = location['x'] + size['width']
     bottom = location['y'] + size['height']
-    cropbox = (left, top, right, bottom)
+    return (left, top, right, bottom)
+
 
-    f = _screenshot(driver, output_path)
-    img = image.crop(f, cropbox)
+def screenshot_element(driver, element, output_path=None):
+    """Take a screenshot of a specific webelement
+    The window screenshot is decoded and cropped in memory, so only the
+    element's image gets encoded and written
+    :param output_path: where to save the png, None to skip writing it
+    :return: the cropped PIL.Image, which can be handed to compare directly
+    """
+    cropbox = _get_cropbox(element)
+    img = image.crop_png_data(driver.get_screenshot_as_png(), cropbox)
+    if output_path:
+        output_path = _get_png_path(output_path)
+        LOGGER.debug("saving screenshot to %s", output_path)
+        image.save(img, output_path)
     return img
 
 
-def _screenshot(driver, output_path):
+def screenshot_elements(driver, elements):
+    """Crops several webelements out of one window screenshot
+    :return: list of cropped PIL.Images in the order of elements, None for
+        the elements that are not entirely inside the screenshot, i.e. below
+        the fold
+    """
+    screenshot = image.crop_png_data(driver.get_screenshot_as_png(),
+                                     cropbox=None)
+    width, height = screenshot.size
+    images = []
+    for element in elements:
+        left, top, right, bottom = cropbox = _get_cropbox(element)
+        if left < 0 or top < 0 or right > width or bottom > height or \
+                right <= left or bottom <= top:
+            LOGGER.debug("Element at %s is outside of the %sx%s screenshot",
+                         cropbox, width, height)
+            images.append(None)
+            continue
+        img = screenshot.crop(cropbox)
+        img.load()
+        images.append(img)
+    return images
+
+
+def _get_png_path(output_path):
     if not output_path.endswith('.png'):
         output_path += ".png"
-    LOGGER.debug("capturing screenshot to %s", output_path)
-    driver.get_screenshot_as_file(output_path)
     return output_path
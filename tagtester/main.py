@@ -12,6 +12,8 @@ from tagcompare import settings
 from tagcompare import capture
 from tagcompare import image
 from tagcompare import logger
+from tagcompare import cache
+from tagcompare import webdriver
 
 import tests
 
@@ -33,12 +35,16 @@ class TagTester(object):
         # Get config options
         self.test = self.get_test(self.args.test_config)
         self.logger.info('Test config: %s', self.test)
-        self.placelocal = placelocal.PlaceLocalApi(domain=self.test['domain'])
+        self.placelocal = placelocal.PlaceLocalApi(
+            domain=self.test['domain'], tag_cache=cache.TagCache(),
+            refresh_tags=self.args.refresh_tags or self.args.resubmit)
         pids = self.test.get('pids')
         cids = self.test.get('cids')
         all_cids = self.placelocal.get_all_cids(
             pids=pids, cids=cids)
         self.cids = all_cids
+        # One pool per tester, its idle sessions are quit when it's closed
+        self.session_pool = webdriver.SessionPool()
 
     def get_test(self, testname):
         assert testname in tests.tests, "No test with name %s!" % (testname)
@@ -74,13 +80,13 @@ class TagTester(object):
         browser_configs = self.test.get('configs') or ['chrome']
         preview = self.test.get('preview') or 1
 
+        tags = self.placelocal.get_tags_for_campaigns(
+            cids=self.cids, ispreview=preview)
         for bc in browser_configs:
-            tags = self.placelocal.get_tags_for_campaigns(
-                cids=self.cids, ispreview=preview)
-            pb.config = bc
-            with closing(capture.TagCapture.from_config(bc)) as tagcapture:
+            with closing(capture.TagCapture.from_config(
+                    bc, session_pool=self.session_pool)) as tagcapture:
                 browser_errors = tagcapture.capture_tags(
-                    tags=tags, pathbuilder=pb,
+                    tags=tags, pathbuilder=pb.clone(config=bc),
                     tagsizes=test_sizes,
                     tagtypes=test_types)
 
@@ -162,6 +168,10 @@ class TagTester(object):
             '-c', '--skip-capture', action='store_true', default=False,
             help='Skips capture')
 
+        parser.add_argument(
+            '--refresh-tags', action='store_true', default=False,
+            help='Refetch tags even if they are cached')
+
         parser.add_argument('--verbose', action='store_true', default=False,
                             help='Enable verbose logging for debugging')
         args = parser.parse_args()
@@ -201,4 +211,5 @@ class TagTester(object):
 
 if __name__ == '__main__':
     tagtester = TagTester()
-    tagtester.run()
+    with closing(tagtester.session_pool):
+        tagtester.run()